@@ -22,9 +22,9 @@ from . import DSBase
 from .DSBase import Composable
 
 class SampleBasic(DSBase.Sample, DSBase.SampleWithTransform):
-    def __init__(self, data, loader:Composable, transform:Composable) -> None:
+    def __init__(self, data, loader:Composable | str, transform:Composable) -> None:
         self.data = data
-        self.loader = auto_compose(loader)
+        self.loader = auto_compose(DSBase.resolve_loader(loader))
         self.transform = auto_compose(transform)
 
         self.preloaded = None
@@ -47,16 +47,16 @@ class DSBasic(DSBase.DS, DSBase.DSWithTransform):
         self.iter_cursor = 0
         self.last_accessed = []
 
-    def add_sample(self, data, loader: Composable = None, transform: Composable = None):
+    def add_sample(self, data, loader: Composable | str = None, transform: Composable = None):
         self.samples.append(SampleBasic(data=data, loader = loader, transform = transform))
 
-    def add_samples(self, data: Iterable, loader: Composable = None,transform: Composable = None):
+    def add_samples(self, data: Iterable, loader: Composable | str = None,transform: Composable = None):
         self.samples.extend([SampleBasic(data=d, loader = loader, transform = transform) for d in data])
 
     def add_folder(
         self,
         path: str,
-        loader: Optional[Callable] = None,
+        loader: Composable | str = None,
         transform: Optional[Callable] = None,
         recursive: bool = True,
         extensions: Optional[list[str]] = None,
@@ -72,7 +72,7 @@ class DSBasic(DSBase.DS, DSBase.DSWithTransform):
     def from_folder(
         cls,
         path: str,
-        loader: Optional[Callable] = None,
+        loader: Composable | str = None,
         transform: Optional[Callable] = None,
         recursive: bool = True,
         extensions: Optional[list[str]] = None,
@@ -92,7 +92,7 @@ class DSBasic(DSBase.DS, DSBase.DSWithTransform):
 
     def add_external_dataset(self,
         dataset,
-        loader: Optional[Callable] = None,
+        loader: Composable | str = None,
         transform: Optional[Callable] = None,
         n_elems=None,
         smart_get0 = True
@@ -117,7 +117,7 @@ class DSBasic(DSBase.DS, DSBase.DSWithTransform):
     @classmethod
     def from_external_dataset(cls,
         dataset,
-        loader: Optional[Callable] = None,
+        loader: Composable | str = None,
         transform: Optional[Callable] = None,
         n_elems=None,
         smart_get0 = True,
@@ -171,7 +171,7 @@ class SampleClassification(DSBase.Sample, DSBase.SampleWithTransform, DSBase.Sam
     def __init__(
         self,
         data,
-        loader: Composable,
+        loader: Composable | str,
         transform: Composable,
         target: Callable | str | int,
         target_encoder: Optional[Callable],
@@ -181,7 +181,7 @@ class SampleClassification(DSBase.Sample, DSBase.SampleWithTransform, DSBase.Sam
         # assign label, call on data if callable
         self.set_target(target)
 
-        self.loader = auto_compose(loader)
+        self.loader = auto_compose(DSBase.resolve_loader(loader))
         self.transform = auto_compose(transform)
         self.target_encoder = identity_kwargs_if_none(target_encoder)
 
@@ -263,7 +263,7 @@ class DSClassification(DSBase.DS, DSBase.DSWithTransform, DSBase.DSWithTargets,
     def add_sample(
         self,
         data,
-        loader: Composable = None,
+        loader: Composable | str = None,
         transform: Composable = None,
         target: Callable | Any = ...,
         target_encoder: Optional[Callable] = auto_index,
@@ -282,7 +282,7 @@ class DSClassification(DSBase.DS, DSBase.DSWithTransform, DSBase.DSWithTargets,
     def add_samples(
         self,
         data: Iterable,
-        loader: Composable = None,
+        loader: Composable | str = None,
         transform: Composable = None,
         target: Callable | Any = ...,
         target_encoder: Optional[Callable] = auto_index,
@@ -303,7 +303,7 @@ class DSClassification(DSBase.DS, DSBase.DSWithTransform, DSBase.DSWithTargets,
     def add_folder(
         self,
         path: str,
-        loader: Composable = None,
+        loader: Composable | str = None,
         transform: Composable = None,
         target: Callable | Any = ...,
         target_encoder: Optional[Callable] = auto_index,
@@ -328,7 +328,7 @@ class DSClassification(DSBase.DS, DSBase.DSWithTransform, DSBase.DSWithTargets,
     def from_folder(
         cls,
         path: str,
-        loader: Composable = None,
+        loader: Composable | str = None,
         transform: Composable = None,
         target: Callable | Any = ...,
         target_encoder: Optional[Callable] = auto_index,
@@ -358,7 +358,7 @@ class DSClassification(DSBase.DS, DSBase.DSWithTransform, DSBase.DSWithTargets,
     def add_external_dataset(
         self,
         dataset,
-        loader: Composable = None,
+        loader: Composable | str = None,
         transform: Composable = None,
         target: Callable | Any | DSBase.AutoTargetFromDataset = DSBase.AutoTargetFromDataset(),
         target_encoder: Optional[Callable] = auto_index,
@@ -401,7 +401,7 @@ class DSClassification(DSBase.DS, DSBase.DSWithTransform, DSBase.DSWithTargets,
 
         # create samples
         if smart_get0:
-            loader = DSBase.smart_compose(get0, auto_compose(loader))
+            loader = DSBase.smart_compose(get0, auto_compose(DSBase.resolve_loader(loader)))
         samples = [ItemUnderIndex(obj=dataset, index=i) for i in range(n_elems)]
 
         self.add_samples(
@@ -415,7 +415,7 @@ class DSClassification(DSBase.DS, DSBase.DSWithTransform, DSBase.DSWithTargets,
     @classmethod
     def from_external_dataset(cls,
         dataset,
-        loader: Composable = None,
+        loader: Composable | str = None,
         transform: Composable = None,
         target: Callable | Any | DSBase.AutoTargetFromDataset = DSBase.AutoTargetFromDataset(),
         target_encoder: Optional[Callable] = auto_index,
@@ -551,14 +551,14 @@ class SampleToTarget(DSBase.Sample):
     def __init__(
         self,
         data,
-        loader: Composable,
+        loader: Composable | str,
         transform_init: Composable,
         transform_sample: Composable,
         transform_target: Composable,
     ) -> None:
 
         self.data = data
-        self.loader = auto_compose(loader)
+        self.loader = auto_compose(DSBase.resolve_loader(loader))
         self.transform_init = auto_compose(transform_init)
         self.transform_sample = auto_compose(transform_sample)
         self.transform_target = auto_compose(transform_target)
@@ -628,7 +628,7 @@ class DSToTarget(DSBase.DS):
     def add_sample(
         self,
         data,
-        loader: Composable = None,
+        loader: Composable | str = None,
         transform_init: Composable = None,
         transform_sample: Composable = None,
         transform_target: Composable = None,
@@ -646,7 +646,7 @@ class DSToTarget(DSBase.DS):
     def add_samples(
         self,
         data,
-        loader: Composable = None,
+        loader: Composable | str = None,
         transform_init: Composable = None,
         transform_sample: Composable = None,
         transform_target: Composable = None,
@@ -667,7 +667,7 @@ class DSToTarget(DSBase.DS):
     def add_folder(
         self,
         path: str,
-        loader: Composable = None,
+        loader: Composable | str = None,
         transform_init: Composable = None,
         transform_sample: Composable = None,
         transform_target: Composable = None,
@@ -692,7 +692,7 @@ class DSToTarget(DSBase.DS):
     def from_folder(
         cls,
         path: str,
-        loader: Composable = None,
+        loader: Composable | str = None,
         transform_init: Composable = None,
         transform_sample: Composable = None,
         transform_target: Composable = None,
@@ -716,7 +716,7 @@ class DSToTarget(DSBase.DS):
 
     def add_external_dataset(self,
         dataset,
-        loader: Composable = None,
+        loader: Composable | str = None,
         transform_init: Composable = None,
         transform_sample: Composable = None,
         transform_target: Composable = None,
@@ -746,7 +746,7 @@ class DSToTarget(DSBase.DS):
     @classmethod
     def from_external_dataset(cls,
         dataset,
-        loader: Composable = None,
+        loader: Composable | str = None,
         transform_init: Composable = None,
         transform_sample: Composable = None,
         transform_target: Composable = None,
@@ -800,13 +800,13 @@ class DSToTarget(DSBase.DS):
 # __________________________ REGRESSION _____________________________
 
 class SampleRegression(DSBase.Sample, DSBase.SampleWithNumericTarget, DSBase.SampleWithTransform):
-    def __init__(self, data, loader: Composable, transform: Composable, target: Callable | float | int| torch.Tensor, target_dtype = torch.float32) -> None:
+    def __init__(self, data, loader: Composable | str, transform: Composable, target: Callable | float | int| torch.Tensor, target_dtype = torch.float32) -> None:
         self.data = data
 
         # assign label, call on data if callable
         self.set_target(torch.tensor(target, dtype=target_dtype))
 
-        self.loader = auto_compose(loader)
+        self.loader = auto_compose(DSBase.resolve_loader(loader))
         self.transform = auto_compose(transform)
 
         self.preloaded = None
@@ -852,18 +852,18 @@ class DSRegression(DSBase.DS, DSBase.DSWithTargets, DSBase.DSWithTransform):
             ds.samples = self.samples.copy()
         return ds
 
-    def add_sample(self, data, loader: Composable = None, transform: Composable = None, target:Callable|float|int|EllipsisType = ...):
+    def add_sample(self, data, loader: Composable | str = None, transform: Composable = None, target:Callable|float|int|EllipsisType = ...):
         if target is ...: raise ValueError("Target must be specified")
         self.samples.append(SampleRegression(data=data, target=target, loader=loader, transform=transform, target_dtype=self.target_dtype))
 
-    def add_samples(self, data:Iterable, loader: Composable = None,transform: Composable = None, target:Callable|float|int|EllipsisType = ...):
+    def add_samples(self, data:Iterable, loader: Composable | str = None,transform: Composable = None, target:Callable|float|int|EllipsisType = ...):
         if target is ...: raise ValueError("Target must be specified")
         self.samples.extend([SampleRegression(data=d, loader=loader, transform=transform, target = target, target_dtype=self.target_dtype) for d in data])
 
     def add_folder(
         self,
         path: str,
-        loader: Composable = None,
+        loader: Composable | str = None,
         transform: Composable = None,
         target:Callable|float|int|EllipsisType = ...,
         recursive: bool = True,
@@ -881,7 +881,7 @@ class DSRegression(DSBase.DS, DSBase.DSWithTargets, DSBase.DSWithTransform):
     def from_folder(
         cls,
         path: str,
-        loader: Composable = None,
+        loader: Composable | str = None,
         transform: Composable = None,
         target:Callable|float|int|EllipsisType = ...,
         recursive: bool = True,
@@ -904,7 +904,7 @@ class DSRegression(DSBase.DS, DSBase.DSWithTargets, DSBase.DSWithTransform):
 
     def add_external_dataset(self,
         dataset,
-        loader: Composable = None,
+        loader: Composable | str = None,
         transform: Composable = None,
         target:Callable|float|int|DSBase.AutoTargetFromDataset = DSBase.AutoTargetFromDataset(),
         n_elems=None,
@@ -954,7 +954,7 @@ class DSRegression(DSBase.DS, DSBase.DSWithTargets, DSBase.DSWithTransform):
     @classmethod
     def from_external_dataset(cls,
         dataset,
-        loader: Composable = None,
+        loader: Composable | str = None,
         transform: Composable = None,
         target:Callable|float|int|DSBase.AutoTargetFromDataset = DSBase.AutoTargetFromDataset(),
         n_elems=None,
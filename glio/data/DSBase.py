@@ -20,6 +20,14 @@ from ..python_tools import (
 from ..plot import Figure
 Composable = Optional[Callable | Sequence[Callable]]
 
+def resolve_loader(loader: Composable | str) -> Composable:
+    """Loader names from `loaders.array.LOADERS`, e.g. `mmap`, are replaced with the loader function, including names inside sequences of loaders."""
+    if isinstance(loader, str):
+        from ..loaders.array import LOADERS
+        return LOADERS[loader]
+    if isinstance(loader, Sequence): return [resolve_loader(i) for i in loader] # type:ignore
+    return loader
+
 class ExhaustingIteratorDataset(ExhaustingIterator, torch.utils.data.IterableDataset): pass # pylint: disable=W0223
 
 class CacheRepeatIteratorDataset(torch.utils.data.IterableDataset): # pylint: disable=W0223
@@ -67,9 +75,9 @@ def smart_compose(old:Callable, new:Callable):
 
 class Sample(ABC):
     @abstractmethod
-    def __init__(self, data, loader: Composable) -> None:
+    def __init__(self, data, loader: Composable | str) -> None:
         self.data = data
-        self.loader: Callable = auto_compose(loader)
+        self.loader: Callable = auto_compose(resolve_loader(loader))
 
     @abstractmethod
     def __call__(self) -> Any | tuple: ...
@@ -87,12 +95,12 @@ class Sample(ABC):
         self.preloaded = None
 
     @final
-    def set_loader(self, loader: Composable):
-        self.loader = auto_compose(loader)
+    def set_loader(self, loader: Composable | str):
+        self.loader = auto_compose(resolve_loader(loader))
 
     @final
-    def add_loader(self, loader: Composable):
-        self.loader = smart_compose(self.loader, auto_compose(loader))
+    def add_loader(self, loader: Composable | str):
+        self.loader = smart_compose(self.loader, auto_compose(resolve_loader(loader)))
 
 class DS(ABC, torch.utils.data.Dataset):
     @abstractmethod
@@ -135,13 +143,13 @@ class DS(ABC, torch.utils.data.Dataset):
         random.shuffle(self.samples)
 
     @final
-    def set_loader(self, loader: Composable, sample_filter:Optional[Callable] = None):
+    def set_loader(self, loader: Composable | str, sample_filter:Optional[Callable] = None):
         for sample in self.samples:
             if sample_filter is None or sample_filter(sample):
                 sample.set_loader(loader)
 
     @final
-    def add_loader(self, loader: Composable, sample_filter:Optional[Callable] = None):
+    def add_loader(self, loader: Composable | str, sample_filter:Optional[Callable] = None):
         for sample in self.samples:
             if sample_filter is None or sample_filter(sample):
                 sample.add_loader(loader)
@@ -1,9 +1,10 @@
 from typing import Any
 import random
 import torch
-import joblib
 from glio.torch_tools import one_hot_mask
-from glio.python_tools import SliceContainer, reduce_dim
+from glio.python_tools import reduce_dim
+from glio.datasets import mri_preloaded
+from glio.datasets.mri_preloaded import SliceTable
 
 PATH = r"E:\dataset\RHUH-GBM"
 RHUH_HIST140_TRAIN = rf"{PATH}/rhuh hist140 train.joblib"
@@ -16,23 +17,16 @@ RHUH_HIST140_NOADC_TEST = rf"{PATH}/rhuh hist140 noadc test.joblib"
 RHUH_NOHIST140_NOADC_TRAIN = rf"{PATH}/rhuh nohist140 noadc train.joblib"
 RHUH_NOHIST140_NOADC_TEST = rf"{PATH}/rhuh nohist140 noadc test.joblib"
 
-def get_ds_2d(path) -> list[tuple[torch.Tensor, torch.Tensor]]:
-    ds:list[list[tuple[SliceContainer,SliceContainer]]] = joblib.load(path)
-    return [(i[0](), i[1]()) for j in ds for i in j]
+def get_ds_2d(path, cache = True) -> SliceTable:
+    """Loads a joblib file with `SliceContainer` lists, samples are `(image, seg)` slices."""
+    return mri_preloaded.get_ds_2d(path, cache)
 
 def loader_2d(sample:tuple[torch.Tensor, torch.Tensor]) -> tuple[torch.Tensor, torch.Tensor]:
     return sample[0].to(torch.float32), one_hot_mask(sample[1], 4)
 
-def get_ds_around(path, around=1) -> list[tuple[list[torch.Tensor],torch.Tensor]]:
-    ds:list[list[tuple[SliceContainer,SliceContainer]]] = joblib.load(path)
-    res = []
-    for slices in ds:
-        for i in range(around, len(slices) - around):
-            stack = slices[i - around : i + around + 1]
-            images = [s[0]() for s in stack]
-            seg = slices[i][1]()
-            res.append((images, seg))
-    return res
+def get_ds_around(path, around=1, cache = True) -> SliceTable:
+    """Loads a joblib file with `SliceContainer` lists, samples are `([image slices], seg)` with `around` neighbouring slices on each side."""
+    return mri_preloaded.get_ds_around(path, around, cache)
 
 def loader_around(sample:tuple[list[torch.Tensor],torch.Tensor]) -> tuple[torch.Tensor, torch.Tensor]:
     return torch.cat(sample[0], 0).to(torch.float32), one_hot_mask(sample[1], 4)
@@ -1,6 +1,7 @@
 """Whatever"""
 import random
-from typing import Optional, Sequence
+import concurrent.futures
+from typing import Optional, Sequence, Callable, Any
 import numpy as np
 import polars as pl
 
@@ -219,6 +220,97 @@ class DistributionLabeled:
 
         return dsets
 
+
+def volume_stats(image, seg = None, num_classes:Optional[int] = None, percentiles:Sequence[float] = (0.5, 1, 5, 25, 50, 75, 95, 99, 99.5),
+                 bins = 64, hist_range:Optional[tuple[float, float]] = None) -> list[dict[str, Any]]:
+    """Statistics of a C* `image` and optional * integer `seg`, computed for all channels at once. Returns one row per channel.
+
+    Each row has shape, per-channel mean/std/min/max, `p{q}` percentiles, a `bins` histogram (over `hist_range`, or over min-max of the channel if None),
+    and if `seg` is given, `voxels_class{k}` voxel counts, `mean_class{k}` mean channel intensity and `hist_class{k}` histogram inside each class."""
+    image = np.asarray(image)
+    nchannels = image.shape[0]
+    flat = image.reshape(nchannels, -1).astype(np.float32, copy=False)
+
+    cmin, cmax = flat.min(1), flat.max(1)
+    pvals = np.percentile(flat, percentiles, axis=1) # (len(percentiles), C)
+
+    # histograms of all channels with a single bincount by offsetting bin indexes by channel
+    low, high = (cmin, cmax) if hist_range is None else (np.full(nchannels, hist_range[0]), np.full(nchannels, hist_range[1]))
+    width = (high - low)
+    width[width == 0] = 1
+    raw_bin_idx = np.clip(((flat - low[:, None]) / width[:, None] * bins).astype(np.int64), 0, bins - 1)
+    bin_idx = raw_bin_idx + (np.arange(nchannels) * bins)[:, None]
+    hists = np.bincount(bin_idx.ravel(), minlength=nchannels * bins).reshape(nchannels, bins)
+
+    rows = [{
+        "channel": c,
+        "shape": list(image.shape[1:]),
+        "mean": float(flat[c].mean()),
+        "std": float(flat[c].std()),
+        "min": float(cmin[c]),
+        "max": float(cmax[c]),
+        **{f"p{q}": float(pvals[i, c]) for i, q in enumerate(percentiles)},
+        "hist": hists[c].tolist(),
+        "hist_low": float(low[c]),
+        "hist_high": float(high[c]),
+    } for c in range(nchannels)]
+
+    if seg is not None:
+        seg_flat = np.asarray(seg).reshape(-1).astype(np.int64)
+        if num_classes is None: num_classes = int(seg_flat.max()) + 1
+        counts = np.bincount(seg_flat, minlength=num_classes)[:num_classes]
+        # per-class sums of all channels with a single weighted bincount
+        class_idx = (seg_flat[None, :] + (np.arange(nchannels) * num_classes)[:, None]).ravel()
+        sums = np.bincount(class_idx, weights=flat.ravel(), minlength=nchannels * num_classes)[:nchannels * num_classes].reshape(nchannels, num_classes)
+        means = sums / np.where(counts == 0, 1, counts)[None, :]
+        # class-conditional histograms with a single bincount by offsetting bin indexes by channel and class
+        class_bin_idx = (class_idx.reshape(nchannels, -1) * bins + raw_bin_idx).ravel()
+        class_hists = np.bincount(class_bin_idx, minlength=nchannels * num_classes * bins)[:nchannels * num_classes * bins].reshape(nchannels, num_classes, bins)
+        for c, row in enumerate(rows):
+            row.update({f"voxels_class{k}": int(counts[k]) for k in range(num_classes)})
+            row.update({f"mean_class{k}": float(means[c, k]) if counts[k] > 0 else None for k in range(num_classes)})
+            row.update({f"hist_class{k}": class_hists[c, k].tolist() for k in range(num_classes)})
+
+    return rows
+
+def _study_stats(study_idx:int, study, loader:Optional[Callable], kwargs:dict) -> list[dict[str, Any]]:
+    """Runs in a worker process."""
+    if loader is not None: study = loader(study)
+    if isinstance(study, (list, tuple)): image, seg = study
+    else: image, seg = study, None
+    rows = volume_stats(image, seg, **kwargs)
+    for row in rows: row["study"] = study_idx
+    return rows
+
+def cohort_stats(studies:Sequence, loader:Optional[Callable] = None, source:Optional[str] = None, n_workers:Optional[int] = None,
+                 num_classes:Optional[int] = None, percentiles:Sequence[float] = (0.5, 1, 5, 25, 50, 75, 95, 99, 99.5),
+                 bins = 64, hist_range:Optional[tuple[float, float]] = None) -> pl.LazyFrame:
+    """Computes `volume_stats` for every study in a process pool and returns a lazy frame with one row per study and channel.
+
+    `studies` can be anything `loader` accepts (e.g. paths), `loader` must return a C* image or a `(image, seg)` tuple, and must be picklable.
+    `n_workers` of `0` or `1` runs in the calling process. `source` is added as a column so that frames from different datasets can be concatenated and compared.
+    Use the same `hist_range` and `num_classes` for all studies so that histograms and class columns line up."""
+    kwargs = dict(num_classes=num_classes, percentiles=percentiles, bins=bins, hist_range=hist_range)
+    if n_workers is not None and n_workers <= 1:
+        results = [_study_stats(i, s, loader, kwargs) for i, s in enumerate(studies)]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=n_workers) as executor:
+            results = list(executor.map(_study_stats, range(len(studies)), studies, [loader] * len(studies), [kwargs] * len(studies)))
+
+    rows = [row for study_rows in results for row in study_rows]
+    # without `num_classes` each study has as many class columns as its own segmentation, fill the rest
+    n_classes = max((int(k[len("voxels_class"):]) + 1 for row in rows for k in row if k.startswith("voxels_class")), default=0)
+    for row in rows:
+        if "voxels_class0" not in row: continue
+        for k in range(n_classes):
+            row.setdefault(f"voxels_class{k}", 0)
+            row.setdefault(f"mean_class{k}", None)
+            row.setdefault(f"hist_class{k}", [0] * bins)
+    df = pl.DataFrame(rows, infer_schema_length=None)
+    if n_classes > 0: df = df.with_columns(pl.col(f"mean_class{k}").cast(pl.Float64) for k in range(n_classes))
+    if source is not None: df = df.with_columns(source=pl.lit(source))
+    return df.lazy()
+
 if __name__ == "__main__":
     test_ds = DistributionLabeled(['x','y'])
     test_ds.add_uniform(100, 'cls1', [[0,1],[0,1]])
@@ -1,5 +1,10 @@
-from typing import Any
+from typing import Any, Optional
+from collections.abc import Sequence
+import hashlib
+import operator
 import random
+import os
+import numpy as np
 import torch
 import joblib
 from glio.torch_tools import one_hot_mask
@@ -33,23 +38,21 @@ BRATS_TEST = r"E:\dataset\BRaTS2024-GoAT\brats2024-96 v2 test.joblib"
 BRATSGLI_0_400 = r"E:\dataset\BraTS-GLI\brats-gli full 0-400.joblib"
 BRATSGLI_400_500 = r"E:\dataset\BraTS-GLI\brats-gli full 400-500.joblib"
 
-def get_ds_2d(path) -> list[tuple[torch.Tensor, torch.Tensor]]:
-    ds:list[list[tuple[SliceContainer,SliceContainer]]] = joblib.load(path)
-    return [(i[0](), i[1]()) for j in ds for i in j]
+def get_ds_2d(path, cache = True, cache_dir:Optional[str] = None) -> "SliceTable":
+    """Loads a joblib file with `SliceContainer` lists or `(image, seg)` studies, samples are `(image, seg)` slices.
+
+    Slices are indexed lazily, see `get_slice_table`."""
+    return get_slice_table(path, 0, cache, cache_dir)
 
 def loader_2d(sample:tuple[torch.Tensor, torch.Tensor]) -> tuple[torch.Tensor, torch.Tensor]:
     return sample[0].to(torch.float32), one_hot_mask(sample[1], 4)
 
-def get_ds_around(path, around=1) -> list[tuple[list[torch.Tensor],torch.Tensor]]:
-    ds:list[list[tuple[SliceContainer,SliceContainer]]] = joblib.load(path)
-    res = []
-    for slices in ds:
-        for i in range(around, len(slices) - around):
-            stack = slices[i - around : i + around + 1]
-            images = [s[0]() for s in stack]
-            seg = slices[i][1]()
-            res.append((images, seg))
-    return res
+def get_ds_around(path, around=1, cache = True, cache_dir:Optional[str] = None) -> "SliceTable":
+    """Loads a joblib file with `SliceContainer` lists or `(image, seg)` studies,
+    samples are `([image slices], seg)` with `around` neighbouring slices on each side.
+
+    Slices are indexed lazily, see `get_slice_table`."""
+    return get_slice_table(path, around, cache, cache_dir)
 
 
 def loader_around(sample:tuple[list[torch.Tensor],torch.Tensor], num_classes=4) -> tuple[torch.Tensor, torch.Tensor]:
@@ -64,6 +67,115 @@ def loader_around_seq(sample:tuple[list[torch.Tensor],torch.Tensor], num_classes
 def loader_around_seq_fix(sample:tuple[list[torch.Tensor],torch.Tensor], num_classes=4) -> tuple[torch.Tensor, torch.Tensor]:
     return torch.stack(reduce_dim(list(zip(*sample[0]))), 0).to(torch.float32)[:,:96,:96], one_hot_mask(sample[1], num_classes)[:,:96,:96]
 
+def _slice_coord(slices, axis:int) -> Optional[int]:
+    """Returns `k` if `slices` is `k` at `axis` and full slices before it, e.g. `(slice(None), k)` for axis 1, otherwise None."""
+    if not isinstance(slices, tuple): slices = (slices, )
+    if len(slices) != axis + 1 or any(s != slice(None) for s in slices[:axis]): return None
+    try: return operator.index(slices[axis])
+    except TypeError: return None
+
+def studies_from_slice_containers(ds:list[list[tuple[SliceContainer,SliceContainer]]]) -> list[tuple[torch.Tensor, torch.Tensor]]:
+    """Extracts `(image, seg)` full tensors from the old per-slice `SliceContainer` lists.
+
+    Each study must have one container pair per slice along the first spatial dimension, in order, with image sliced as `image[:, k]`
+    and seg as `seg[k]`, and all containers of a study must share the same tensors, otherwise `SliceTable` would return different samples,
+    so `ValueError` is raised."""
+    studies = []
+    for study_idx, slices in enumerate(ds):
+        if len(slices) == 0: continue
+        image, seg = slices[0][0].obj, slices[0][1].obj
+        if len(slices) != seg.shape[0] or image.shape[1] != seg.shape[0]:
+            raise ValueError(f'study {study_idx} has {len(slices)} slice containers, but image shape is {tuple(image.shape)} and seg shape is {tuple(seg.shape)}, '
+                             'only containers for all slices along the first spatial dimension are supported')
+        for k, (image_container, seg_container) in enumerate(slices):
+            if image_container.obj is not image or seg_container.obj is not seg:
+                raise ValueError(f'slice {k} of study {study_idx} is not a slice of the same tensors as other slices of the study')
+            if _slice_coord(image_container.slices, 1) != k or _slice_coord(seg_container.slices, 0) != k:
+                raise ValueError(f'slice {k} of study {study_idx} indexes image with {image_container.slices} and seg with {seg_container.slices}, '
+                                 f'expected image[:, {k}] and seg[{k}]')
+        studies.append((image, seg))
+    return studies
+
+def _is_slice_containers(ds) -> bool:
+    return len(ds) > 0 and isinstance(ds[0], list) and len(ds[0]) > 0 and isinstance(ds[0][0][0], SliceContainer)
+
+def convert_slice_containers(path, outpath, compress = 0):
+    """Converts a joblib file with `SliceContainer` lists into a joblib file with a list of `(image, seg)` studies that `get_slice_table` loads."""
+    joblib.dump(studies_from_slice_containers(joblib.load(path)), outpath, compress=compress)
+
+def file_hash(path, chunk_size = 2**24) -> str:
+    """blake2b hash of file contents."""
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk: break
+            h.update(chunk)
+    return h.hexdigest()
+
+def _study_slice_rows(study_idx:int, seg:torch.Tensor | np.ndarray, around:int) -> np.ndarray:
+    """Returns `(n, 3)` int32 array of `study, coord, has_seg` rows for all valid slices of one study."""
+    seg = np.asarray(seg)
+    depth = seg.shape[0]
+    coords = np.arange(around, depth - around, dtype=np.int32)
+    has_seg = seg.reshape(depth, -1).any(1)[coords]
+    return np.stack((np.full_like(coords, study_idx), coords, has_seg.astype(np.int32)), 1)
+
+def build_slice_index(studies:Sequence[tuple[torch.Tensor, torch.Tensor]], around = 0) -> np.ndarray:
+    """Builds a flat `(n, 3)` int32 index of `study, coord, has_seg` rows over all slices of all studies.
+
+    Runs in the calling process, one vectorized `any` per study is cheaper than sending segmentations to worker processes."""
+    rows = [_study_slice_rows(i, seg, around) for i, (_, seg) in enumerate(studies)]
+    if len(rows) == 0: return np.zeros((0, 3), dtype=np.int32)
+    return np.concatenate(rows, 0)
+
+
+class SliceTable:
+    """Flat slice index over a list of `(image, seg)` studies, replaces lists of `SliceContainer` objects.
+
+    `image` is C* and `seg` is *, slices are taken along the first spatial dimension.
+    Indexing returns the same samples as `get_ds_2d` when `around` is 0 and as `get_ds_around` otherwise,
+    so `loader_2d` and `loader_around` work unchanged. Each row of `index` is `study, coord, has_seg`."""
+    def __init__(self, studies:Sequence[tuple[torch.Tensor, torch.Tensor]], index:np.ndarray, around = 0):
+        self.studies = studies
+        self.index = index
+        self.around = around
+
+    def __len__(self): return len(self.index)
+
+    def __getitem__(self, i:int | slice):
+        """Integer index returns a sample, slice returns a `SliceTable` with that part of the index."""
+        if isinstance(i, slice): return SliceTable(self.studies, self.index[i], self.around)
+        study, coord, _ = self.index[operator.index(i)]
+        image, seg = self.studies[study]
+        if self.around == 0: return image[:, coord], seg[coord]
+        return [image[:, c] for c in range(coord - self.around, coord + self.around + 1)], seg[coord]
+
+    def __iter__(self):
+        for i in range(len(self)): yield self[i]
+
+    def seg_only(self) -> "SliceTable":
+        """Returns a table with only the slices that contain segmentation."""
+        return SliceTable(self.studies, self.index[self.index[:, 2] > 0], self.around)
+
+
+def get_slice_table(path, around = 0, cache = True, cache_dir:Optional[str] = None) -> SliceTable:
+    """Loads a joblib file with a list of `(image, seg)` studies (see `convert_slice_containers`)
+    or with old `SliceContainer` lists (see `studies_from_slice_containers`) and returns a `SliceTable`.
+
+    The index is cached in `cache_dir` (defaults to the folder of `path`) under the hash of the file, so rebuilding it is free after the first time."""
+    studies = joblib.load(path)
+    if _is_slice_containers(studies): studies = studies_from_slice_containers(studies)
+    if not cache: return SliceTable(studies, build_slice_index(studies, around), around)
+
+    if cache_dir is None: cache_dir = os.path.dirname(os.path.abspath(path))
+    cache_path = os.path.join(cache_dir, f'{os.path.basename(path)}.{file_hash(path)}.around{around}.slices.npy')
+    if os.path.isfile(cache_path): index = np.load(cache_path)
+    else:
+        index = build_slice_index(studies, around)
+        np.save(cache_path, index)
+    return SliceTable(studies, index, around)
+
 def randcrop(x: tuple[torch.Tensor, torch.Tensor], size = (96,96)):
     if x[0].shape[1] == size[0] and x[0].shape[2] == size[1]: return x
     #print(x[0].shape)
@@ -1,12 +1,19 @@
 """Siodj"""
 import math
-from typing import Sequence, Any
+import time
+import threading
+import itertools
+import concurrent.futures
+from collections import deque
+from contextlib import contextmanager
+from typing import Sequence, Any, Optional
 #import polars as pl
 import torch, numpy as np
 from monai import transforms as mtf
 import SimpleITK as sitk
 from glio.loaders.nifti import niireadtensor
 from glio.transforms.intensity import norm, znorm
+from glio.python_tools import sec_to_timestr
 from torchvision.transforms import v2
 
 
@@ -81,75 +88,254 @@ class Preprocessor:
         self.post_img_tfms = post_img_tfms
         self.post_seg_tfms = post_seg_tfms
 
+        self.timings: dict[str, float] = {}
+        """Seconds spent in each stage since creation or last `reset_timings`."""
+        self._lock = threading.Lock()
 
     def __call__(self, *imgs, seg = None, return_nohist=False) ->tuple | Any:
         """With `return_nohist = True`, returns `imgs, imgs_hist, seg`!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!"""
         if self.hist_correction is None: return_nohist = False
 
         # load all images
-        imgs = [norm(_load_if_needed(m)) for m in imgs]
-        if seg is not None: seg = _load_if_needed(seg)
+        with self._time('load'):
+            imgs = [norm(_load_if_needed(m)) for m in imgs]
+            if seg is not None: seg = _load_if_needed(seg)
 
-        # create a stack of modalities + seg for cropping
-        if seg is not None: stacked = torch.stack(imgs + [seg], dim=0)  # 5, 155, 240, 240 #type:ignore
-        else: stacked = torch.stack(imgs, dim=0)  # 4, 155, 240, 240 # type:ignore
+        imgs, seg = self._crop_pad(imgs, seg)
 
-        # crop foreground by selecting values above 0.5, as all images are normalized to 0-1 range
-        if self.crop is not None:
-            stacked = self.crop(stacked)
+        with self._time('zoom'):
+            # zoom to common size
+            # calculate the zoom factor using first size
+            zoom_factor = self.size[0] / imgs.shape[1]
+            # construct the zoom
+            zoom = mtf.Zoom(zoom_factor, mode=self.zoom_mode) # type:ignore
+            zoom_seg = mtf.Zoom(zoom_factor, mode=self.zoom_mode_seg) # type:ignore
+            # apply the zoom
+            imgs = zoom(imgs)
+            if seg is not None: seg = zoom_seg(seg)
 
-        # rotate if needed
-        if self.rotate is not None:
-            stacked = self.rotate(stacked)
+        with self._time('resize'):
+            # make sure the shape is correct
+            pad_crop_resizer = mtf.ResizeWithPadOrCrop(self.size, mode = "constant", constant_values=0) # type:ignore
+            imgs = pad_crop_resizer(imgs)[:,:self.size[0], :self.size[1], :self.size[2]]
+            if seg is not None: seg = pad_crop_resizer(seg)[:, :self.size[0], :self.size[1], :self.size[2]]
 
-        # pad to some common ratio (7,9,7)
-        # so all sizes need to be divisible by 7,9,7 to pad evenly
-        #stacked = stacked[:, stacked.shape[1] - stacked.shape[1] % self.size[0]]
-        pad = mtf.DivisiblePad(self.ratios, mode = "constant", constant_values=0)# type:ignore
-        stacked = pad(stacked)
+        # histogram correction
+        with self._time('hist'):
+            if self.hist_correction is not None:
+                cor_imgs = self.hist_correction(imgs)
+            else: cor_imgs = imgs
 
-        # unstack images and seg
-        if seg is not None:
-            imgs, seg = stacked[:-1], stacked[-1].unsqueeze(0)
-        else: imgs = stacked
+        # z-normalize
+        with self._time('znorm'):
+            if self.z_norm is not None:
+                cor_imgs = self.z_norm(cor_imgs)
+                if return_nohist: imgs = self.z_norm(imgs)
 
-        # zoom to common size
-        # calculate the zoom factor using first size
-        zoom_factor = self.size[0] / imgs.shape[1]
-        # construct the zoom
-        zoom = mtf.Zoom(zoom_factor, mode=self.zoom_mode) # type:ignore
-        zoom_seg = mtf.Zoom(zoom_factor, mode=self.zoom_mode_seg) # type:ignore
-        # apply the zoom
-        imgs = zoom(imgs)
-        if seg is not None: seg = zoom_seg(seg)
+        return self._post(imgs, cor_imgs, seg, return_nohist)
 
+    def _crop_pad(self, imgs:list[torch.Tensor], seg:Optional[torch.Tensor]) -> tuple[torch.Tensor, Optional[torch.Tensor]]:
+        """Crops foreground, rotates and pads to `self.ratios`, returns C* images and 1* seg or None."""
+        with self._time('crop'):
+            # create a stack of modalities + seg for cropping
+            if seg is not None: stacked = torch.stack(imgs + [seg], dim=0)  # 5, 155, 240, 240 #type:ignore
+            else: stacked = torch.stack(imgs, dim=0)  # 4, 155, 240, 240 # type:ignore
 
-        # make sure the shape is correct
-        pad_crop_resizer = mtf.ResizeWithPadOrCrop(self.size, mode = "constant", constant_values=0) # type:ignore
-        imgs = pad_crop_resizer(imgs)[:,:self.size[0], :self.size[1], :self.size[2]]
-        if seg is not None: seg = pad_crop_resizer(seg)[:, :self.size[0], :self.size[1], :self.size[2]]
+            # crop foreground by selecting values above 0.5, as all images are normalized to 0-1 range
+            if self.crop is not None:
+                stacked = self.crop(stacked)
 
+            # rotate if needed
+            if self.rotate is not None:
+                stacked = self.rotate(stacked)
 
-        # histogram correction
-        if self.hist_correction is not None:
-            cor_imgs = self.hist_correction(imgs)
-        else: cor_imgs = imgs
+        with self._time('pad'):
+            # pad to some common ratio (7,9,7)
+            # so all sizes need to be divisible by 7,9,7 to pad evenly
+            #stacked = stacked[:, stacked.shape[1] - stacked.shape[1] % self.size[0]]
+            pad = mtf.DivisiblePad(self.ratios, mode = "constant", constant_values=0)# type:ignore
+            stacked = pad(stacked)
 
-        # z-normalize
-        if self.z_norm is not None:
-            cor_imgs = self.z_norm(cor_imgs)
-            if return_nohist: imgs = self.z_norm(imgs)
+        # unstack images and seg
+        if seg is not None: return stacked[:-1], stacked[-1].unsqueeze(0)
+        return stacked, None
 
+    def _post(self, imgs, cor_imgs, seg, return_nohist):
         # custom tfms
-        if self.post_img_tfms is not None:
-            cor_imgs = self.post_img_tfms(cor_imgs)
-            if return_nohist: imgs = self.post_img_tfms(imgs)
-        if self.post_seg_tfms is not None and seg is not None:
-            seg = self.post_seg_tfms(seg)
+        with self._time('post'):
+            if self.post_img_tfms is not None:
+                cor_imgs = self.post_img_tfms(cor_imgs)
+                if return_nohist: imgs = self.post_img_tfms(imgs)
+            if self.post_seg_tfms is not None and seg is not None:
+                seg = self.post_seg_tfms(seg)
 
         if seg is not None:
             if return_nohist: return imgs, cor_imgs, seg[0]
             else: return imgs, seg[0]
         else:
             if return_nohist: return imgs, cor_imgs
-            else: return imgs
\ No newline at end of file
+            else: return imgs
+
+    @contextmanager
+    def _time(self, stage:str):
+        start = time.perf_counter()
+        yield
+        self.timings[stage] = self.timings.get(stage, 0.) + time.perf_counter() - start
+
+    def reset_timings(self):
+        self.timings = {}
+
+    def timings_str(self) -> str:
+        """Time spent in each stage since creation or last `reset_timings`."""
+        total = sum(self.timings.values())
+        return '\n'.join(f'{k}: {sec_to_timestr(v)} ({v / total * 100:.1f}%)' for k, v in self.timings.items())
+
+    def _load_study(self, study:tuple[Sequence, Any]) -> tuple[list[torch.Tensor], Optional[torch.Tensor]]:
+        """Runs in an I/O thread."""
+        imgs, seg = study
+        start = time.perf_counter()
+        imgs = [norm(_load_if_needed(m)) for m in imgs]
+        if seg is not None: seg = _load_if_needed(seg)
+        with self._lock: self.timings['load'] = self.timings.get('load', 0.) + time.perf_counter() - start
+        return imgs, seg
+
+    def _zoom_resize(self, imgs:torch.Tensor, seg:Optional[torch.Tensor]) -> tuple[torch.Tensor, Optional[torch.Tensor]]:
+        """Same as zoom and resize in `__call__`, but zooms all channels at once.
+
+        `mtf.Zoom` keeps size by default, so zoomed image is cropped or edge-padded back to its size before zoom,
+        and only then it is padded or cropped to `self.size`."""
+        with self._time('zoom'):
+            zoom_factor = self.size[0] / imgs.shape[1]
+            orig_size = imgs.shape[1:]
+            # same as output size of interpolate with scale_factor and recompute_scale_factor=True, which `mtf.Zoom` uses
+            zoomed_size = [int(i * zoom_factor) for i in orig_size]
+            imgs = _interpolate(imgs, zoomed_size, self.zoom_mode)
+            imgs = _center_pad_crop(imgs, orig_size, 'replicate')
+            if seg is not None:
+                seg = _interpolate(seg, zoomed_size, self.zoom_mode_seg)
+                seg = _center_pad_crop(seg, orig_size, 'replicate')
+
+        with self._time('resize'):
+            imgs = _center_pad_crop(imgs, self.size)
+            if seg is not None: seg = _center_pad_crop(seg, self.size)
+        return imgs, seg
+
+    def batched(self, studies:Sequence[tuple[Sequence, Any]], batch_size = 8, device:Optional[torch.device | str] = None, n_io_threads = 4, return_nohist = False,
+                prefetch_batches = 2):
+        """Preprocesses studies in batches, yields outputs in the same format as `__call__`, one study at a time.
+
+        `studies` is a sequence of `(imgs, seg)` tuples, `imgs` is a sequence of modalities and `seg` can be None,
+        both can be paths or arrays. Loading runs in `n_io_threads` threads ahead of processing, at most `batch_size * prefetch_batches`
+        studies are loaded ahead so that memory use doesn't grow with the number of studies.
+        Cropping and padding run per study, zoom runs on all channels of a study at once,
+        and histogram correction and z-normalization run on the whole batch of studies at once on `device`.
+
+        Zoom uses `torch.nn.functional.interpolate` directly with the same output size, cropping and edge padding as `mtf.Zoom` in `__call__`,
+        so outputs are the same as from `__call__` up to floating point differences.
+        Default `hist_correction` and `z_norm` are vectorized, custom ones are applied per study."""
+        if self.hist_correction is None: return_nohist = False
+        window = batch_size * max(1, prefetch_batches)
+        studies_iter = iter(studies)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=n_io_threads) as executor:
+            pending: deque[concurrent.futures.Future] = deque()
+            def top_up():
+                for study in itertools.islice(studies_iter, window - len(pending)):
+                    pending.append(executor.submit(self._load_study, study))
+
+            top_up()
+            while True:
+                batch = [pending.popleft().result() for _ in range(min(batch_size, len(pending)))]
+                if len(batch) == 0: break
+                # start loading next studies while this batch is processed
+                top_up()
+
+                imgs_batch, seg_batch = [], []
+                for imgs, seg in batch:
+                    if device is not None:
+                        imgs = [i.to(device) for i in imgs]
+                        if seg is not None: seg = seg.to(device)
+                    imgs, seg = self._crop_pad(imgs, seg)
+                    imgs, seg = self._zoom_resize(imgs, seg)
+                    imgs_batch.append(imgs)
+                    seg_batch.append(seg)
+                imgs = torch.stack(imgs_batch)
+
+                # histogram correction
+                with self._time('hist'):
+                    if self.hist_correction is _hist_correction: cor_imgs = histogram_normalize_batch(imgs)
+                    elif self.hist_correction is not None: cor_imgs = torch.stack([self.hist_correction(i) for i in imgs])
+                    else: cor_imgs = imgs
+
+                # z-normalize
+                with self._time('znorm'):
+                    if self.z_norm is znorm:
+                        cor_imgs = _znorm_batch(cor_imgs)
+                        if return_nohist: imgs = _znorm_batch(imgs)
+                    elif self.z_norm is not None:
+                        cor_imgs = torch.stack([self.z_norm(i) for i in cor_imgs])
+                        if return_nohist: imgs = torch.stack([self.z_norm(i) for i in imgs])
+
+                for i, seg in enumerate(seg_batch):
+                    yield self._post(imgs[i], cor_imgs[i], seg, return_nohist)
+
+
+def _interpolate(x:torch.Tensor, size:Sequence[int], mode:str) -> torch.Tensor:
+    """Interpolates a C* tensor in float32 and converts back to its dtype, like `mtf.Zoom`."""
+    return torch.nn.functional.interpolate(x.unsqueeze(0).to(torch.float32), size=list(size), mode=mode)[0].to(x.dtype)
+
+def _center_pad_crop(x:torch.Tensor, size:Sequence[int], mode = 'constant') -> torch.Tensor:
+    """Center pads and crops spatial dimensions of a C* tensor to `size` the same way as `mtf.ResizeWithPadOrCrop`.
+
+    `mode` is `constant` to pad with zeros or `replicate` to pad with edge values."""
+    pad = []
+    for cur, target in zip(reversed(x.shape[1:]), reversed(size)):
+        diff = max(target - cur, 0)
+        pad.extend((diff // 2, diff - diff // 2))
+    if any(pad):
+        if mode == 'constant': x = torch.nn.functional.pad(x, pad)
+        else: x = torch.nn.functional.pad(x.unsqueeze(0).to(torch.float32), pad, mode=mode)[0].to(x.dtype)
+
+    # CenterSpatialCrop starts at center minus half of size, which is not always half of the difference
+    slices = [slice(None)]
+    for cur, target in zip(x.shape[1:], size):
+        start = cur // 2 - target // 2 if cur > target else 0
+        slices.append(slice(start, start + target))
+    return x[tuple(slices)]
+
+def _znorm_batch(x:torch.Tensor) -> torch.Tensor:
+    """Global z-normalization of each study in a BC* batch, same as `znorm` applied to each study."""
+    dims = list(range(1, x.ndim))
+    std = x.std(dims, keepdim=True)
+    std[std == 0] = 1
+    return (x - x.mean(dims, keepdim=True)) / std
+
+def histogram_normalize_batch(x:torch.Tensor, num_bins = 256, min = 0., max = 255., spatial_dims = 3) -> torch.Tensor: # pylint:disable=W0622
+    """Histogram equalization of each channel of a BC* or C* tensor at once, same as applying `monai.transforms.HistogramNormalize` to each channel."""
+    shape = x.shape
+    flat = x.reshape(math.prod(shape[:-spatial_dims]), -1).to(torch.float32)
+
+    low = flat.amin(1, keepdim=True)
+    high = flat.amax(1, keepdim=True)
+    width = (high - low) / num_bins
+    width[width == 0] = 1
+
+    # histogram of each row with a single scatter_add
+    bin_idx = ((flat - low) / width).to(torch.int64).clamp_(0, num_bins - 1)
+    hist = torch.zeros((flat.shape[0], num_bins), dtype=torch.float32, device=x.device)
+    hist.scatter_add_(1, bin_idx, torch.ones_like(flat))
+
+    # cdf rescaled to `[min, max]`
+    cdf = hist.cumsum(1)
+    cdf_min = cdf.amin(1, keepdim=True)
+    cdf_range = cdf.amax(1, keepdim=True) - cdf_min
+    cdf_range[cdf_range == 0] = 1
+    cdf = (cdf - cdf_min) / cdf_range * (max - min) + min
+
+    # linear interpolation of cdf between bin centers, clamped at the edges like `np.interp`
+    pos = (flat - low) / width - 0.5
+    left = pos.floor().clamp_(0, num_bins - 1)
+    frac = (pos - left).clamp_(0, 1)
+    left = left.to(torch.int64)
+    right = (left + 1).clamp_(max=num_bins - 1)
+    res = torch.gather(cdf, 1, left) * (1 - frac) + torch.gather(cdf, 1, right) * frac
+    return res.reshape(shape)
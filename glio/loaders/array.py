@@ -0,0 +1,39 @@
+"""Memory-mapped loaders for `.npy` and `.pt` files.
+
+Memory-mapped arrays are backed by the page cache instead of process memory, so only the parts that are accessed are read from disk,
+and preloaded samples are shared between dataloader workers instead of being copied into each of them."""
+from collections.abc import Callable
+import os
+import numpy as np
+import torch
+
+def npyread(path:str, mmap = True) -> np.ndarray:
+    """Memory-maps `.npy` file copy-on-write, so the array is writable but writes never reach the file."""
+    return np.load(path, mmap_mode='c' if mmap else None)
+
+def npyreadtensor(path:str, mmap = True, uint16_to_int32 = False) -> torch.Tensor:
+    """Same as `npyread` but returns a tensor that shares memory with the mapped array.
+
+    uint16 arrays stay uint16, which few torch operations support, so convert the part that is used, e.g. `x[10].to(torch.int32)`.
+    `uint16_to_int32` converts the whole array like `niireadtensor`, which copies it into process memory, so it is no longer zero-copy."""
+    arr = npyread(path, mmap)
+    if uint16_to_int32 and arr.dtype == np.uint16: arr = arr.astype(np.int32)
+    return torch.from_numpy(arr)
+
+def ptread(path:str, mmap = True, map_location = 'cpu'):
+    """Loads `.pt` file with storages memory-mapped instead of read into memory. Files must be saved with `torch.save` new zipfile format (default)."""
+    return torch.load(path, map_location=map_location, mmap=mmap, weights_only=True)
+
+def mmapread(path:str) -> torch.Tensor:
+    """Memory-maps `.npy` or `.pt` file depending on extension."""
+    ext = os.path.splitext(path)[1].lower()
+    if ext == '.npy': return npyreadtensor(path)
+    if ext in ('.pt', '.pth'): return ptread(path)
+    raise ValueError(f'Unsupported extension {ext}')
+
+LOADERS: dict[str, Callable] = {
+    'npy': npyreadtensor,
+    'pt': ptread,
+    'mmap': mmapread,
+}
+"""Loaders that can be passed to `DS.add_sample(s)` by name."""
@@ -1,4 +1,11 @@
+from collections.abc import Sequence
+from typing import Optional
+import concurrent.futures
+import functools
+import math
 import numpy as np
+import torch
+import torch.nn.functional as F
 import pedalboard
 
 def audioread(path) -> tuple[np.ndarray, int]:
@@ -6,3 +13,66 @@ def audioread(path) -> tuple[np.ndarray, int]:
         audio = f.read(f.frames)
         sr = f.samplerate
     return audio, sr
+
+@functools.lru_cache(maxsize=32)
+def resample_kernel(orig_sr:int, new_sr:int, lowpass_filter_width = 6, rolloff = 0.99) -> tuple[torch.Tensor, int, int, int]:
+    """Polyphase windowed sinc kernel for resampling from `orig_sr` to `new_sr`, cached because building it costs more than applying it to a short clip.
+
+    Returns `(kernel, width, orig, new)`, kernel is `(new, 1, 2 * width + orig)` where `orig` and `new` are sample rates divided by their gcd,
+    each of `new` output channels is one phase of the filter."""
+    gcd = math.gcd(orig_sr, new_sr)
+    orig, new = orig_sr // gcd, new_sr // gcd
+    base_freq = min(orig, new) * rolloff
+    width = math.ceil(lowpass_filter_width * orig / base_freq)
+    idx = torch.arange(-width, width + orig, dtype=torch.float64)[None, None] / orig
+    t = torch.arange(0, -new, -1, dtype=torch.float64)[:, None, None] / new + idx
+    t = (t * base_freq).clamp(-lowpass_filter_width, lowpass_filter_width)
+    # hann window
+    window = torch.cos(t * math.pi / lowpass_filter_width / 2) ** 2
+    t = t * math.pi
+    kernel = torch.where(t == 0, torch.tensor(1.0, dtype=torch.float64), torch.sin(t) / t) * window * (base_freq / orig)
+    return kernel.to(torch.float32), width, orig, new
+
+def resample(x:torch.Tensor, orig_sr:int, new_sr:int) -> torch.Tensor:
+    """Resamples `(*, time)` tensor with the cached polyphase kernel from `resample_kernel`, all leading dimensions in one convolution."""
+    if orig_sr == new_sr: return x
+    kernel, width, orig, new = resample_kernel(orig_sr, new_sr)
+    shape = x.shape
+    x = x.reshape(-1, shape[-1]).to(torch.float32)
+    length = x.shape[-1]
+    x = F.pad(x, (width, width + orig))
+    res = F.conv1d(x[:, None], kernel.to(x.device), stride=orig)
+    # interleave phases
+    res = res.transpose(1, 2).reshape(x.shape[0], -1)
+    return res[:, :math.ceil(new * length / orig)].reshape(*shape[:-1], -1)
+
+def audioreadtensor(path, sr:Optional[int] = None, mono = False) -> torch.Tensor:
+    """Reads audio as `(channels, time)` float32 tensor, resampled to `sr` if it is given."""
+    audio, file_sr = audioread(path)
+    x = torch.from_numpy(audio)
+    if mono: x = x.mean(0, keepdim=True)
+    if sr is not None: x = resample(x, file_sr, sr)
+    return x
+
+def _read_into(path, out:torch.Tensor, sr:int, mono:bool, random_crop:bool):
+    x = audioreadtensor(path, sr, mono)
+    if x.shape[0] != out.shape[0]:
+        if x.shape[0] == 1: x = x.expand(out.shape[0], -1)
+        else: x = x[:out.shape[0]]
+    length = out.shape[1]
+    if x.shape[1] >= length:
+        start = int(torch.randint(0, x.shape[1] - length + 1, (1,))) if random_crop else 0
+        out.copy_(x[:, start:start + length])
+    else:
+        out[:, :x.shape[1]] = x
+        out[:, x.shape[1]:] = 0
+
+def audioread_batch(paths:Sequence[str], sr:int, length:int, channels = 1, random_crop = False, n_threads = 8) -> torch.Tensor:
+    """Reads `paths` into a preallocated `(len(paths), channels, length)` float32 tensor, decoding and resampling in a thread pool.
+
+    Each file is resampled to `sr` with a polyphase kernel cached per sample rate pair, then cropped (from the start, or at a random position
+    if `random_crop`) or zero-padded to `length` samples. With `channels = 1` files are averaged to mono, mono files are repeated to fill `channels`."""
+    out = torch.empty((len(paths), channels, length), dtype=torch.float32)
+    with concurrent.futures.ThreadPoolExecutor(n_threads) as executor:
+        list(executor.map(lambda i: _read_into(paths[i], out[i], sr, channels == 1, random_crop), range(len(paths))))
+    return out
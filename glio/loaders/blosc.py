@@ -1,16 +1,176 @@
-# import torch
-# import bloscpack as bp
-
-# def bloscread(filename):
-#     return bp.unpack_ndarray_from_file(filename)
-
-# def bloscreadtensor(filename):
-#     return torch.from_numpy(bloscread(filename))
-
-# def bloscsave(filename, array, clevel = 2, shuffle=True):
-#     if isinstance(array, torch.Tensor):
-#         array = array.numpy()
-#     blosc_args = bp.BloscArgs()
-#     blosc_args.clevel = clevel
-#     blosc_args.shuffle = shuffle
-#     bp.pack_ndarray_to_file(ndarray = array, filename = filename,  blosc_args=blosc_args)
\ No newline at end of file
+"""Chunked compressed array files, like blosc but only needs `zstandard` (or nothing with `zlib` codec).
+
+Array is split into chunks along one axis, each chunk is byte-shuffled and compressed separately,
+so a file can be decompressed by many threads at once and any chunk can be read without reading others.
+
+File layout: `MAGIC`, little-endian uint64 header length, JSON header with shape, dtype, chunking, codec and byte offsets of chunks, then chunks."""
+from collections.abc import Sequence
+from typing import Any, Optional
+import concurrent.futures
+import json, operator, os, struct, zlib
+import numpy as np
+import torch
+
+MAGIC = b'GLIOCHK1'
+
+def _compress(data:bytes, codec:str, clevel:int) -> bytes:
+    if codec == 'zstd':
+        import zstandard
+        return zstandard.ZstdCompressor(level=clevel).compress(data)
+    if codec == 'zlib': return zlib.compress(data, clevel)
+    if codec == 'none': return data
+    raise ValueError(f'Unknown codec {codec}')
+
+def _decompress(data:bytes, codec:str, nbytes:int) -> bytes:
+    if codec == 'zstd':
+        import zstandard
+        return zstandard.ZstdDecompressor().decompress(data, max_output_size=nbytes)
+    if codec == 'zlib': return zlib.decompress(data, bufsize=nbytes)
+    if codec == 'none': return data
+    raise ValueError(f'Unknown codec {codec}')
+
+def _shuffle(arr:np.ndarray) -> bytes:
+    """Groups n-th bytes of all elements together, which makes float and int data much more compressible."""
+    return np.ascontiguousarray(arr).view(np.uint8).reshape(-1, arr.dtype.itemsize).T.tobytes()
+
+def _unshuffle(data:bytes, dtype:np.dtype, shape:Sequence[int]) -> np.ndarray:
+    return np.frombuffer(data, dtype=np.uint8).reshape(dtype.itemsize, -1).T.copy().view(dtype).reshape(shape)
+
+def _chunk_bounds(size:int, chunk_size:int) -> list[tuple[int, int]]:
+    return [(start, min(start + chunk_size, size)) for start in range(0, size, chunk_size)]
+
+def chunked_save(path:str, arr:np.ndarray | torch.Tensor, chunk_size:Optional[int] = None, axis = 0, codec = 'zstd', clevel = 3, shuffle = True, n_threads:Optional[int] = None):
+    """Saves array as chunks of `chunk_size` elements along `axis`, compressed in a thread pool.
+
+    `chunk_size` defaults to about 1 MB of uncompressed data per chunk. `codec` is `zstd` (needs `zstandard`), `zlib` or `none`."""
+    if isinstance(arr, torch.Tensor): arr = arr.detach().cpu().numpy()
+    arr = np.asarray(arr)
+    if arr.ndim == 0: arr = arr.reshape(1)
+    axis = axis % arr.ndim
+    slice_bytes = max(1, arr.nbytes // max(1, arr.shape[axis]))
+    if chunk_size is None: chunk_size = max(1, 2**20 // slice_bytes)
+    bounds = _chunk_bounds(arr.shape[axis], chunk_size)
+
+    def compress(b:tuple[int, int]) -> bytes:
+        chunk = np.take(arr, range(*b), axis=axis)
+        return _compress(_shuffle(chunk) if shuffle else np.ascontiguousarray(chunk).tobytes(), codec, clevel)
+
+    with concurrent.futures.ThreadPoolExecutor(n_threads) as executor:
+        chunks = list(executor.map(compress, bounds))
+
+    offsets = []
+    offset = 0
+    for c in chunks:
+        offsets.append((offset, len(c)))
+        offset += len(c)
+    header = json.dumps({'shape': list(arr.shape), 'dtype': arr.dtype.str, 'axis': axis, 'chunk_size': chunk_size,
+                         'codec': codec, 'shuffle': shuffle, 'chunks': offsets}).encode()
+
+    # write to a temporary file first so that an interrupted write doesn't leave a corrupted file
+    tmp = f'{path}.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<Q', len(header)))
+        f.write(header)
+        for c in chunks: f.write(c)
+    os.replace(tmp, path)
+
+
+class ChunkedReader:
+    def __init__(self, path:str, n_threads:Optional[int] = None):
+        """Reads a file saved by `chunked_save`. Header is read once, chunks are read on demand.
+
+        Each chunk read opens its own file handle, so one reader can be shared by many threads."""
+        self.path = path
+        self.n_threads = n_threads
+        with open(path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC: raise ValueError(f'{path} is not a chunked array file')
+            (header_len,) = struct.unpack('<Q', f.read(8))
+            self.header: dict[str, Any] = json.loads(f.read(header_len))
+        self.data_start = len(MAGIC) + 8 + header_len
+        self.shape = tuple(self.header['shape'])
+        self.dtype = np.dtype(self.header['dtype'])
+        self.axis:int = self.header['axis']
+        self.chunk_size:int = self.header['chunk_size']
+        self.bounds = _chunk_bounds(self.shape[self.axis], self.chunk_size)
+
+    @property
+    def n_chunks(self): return len(self.bounds)
+
+    def _read_bytes(self, offset:int, nbytes:int) -> bytes:
+        with open(self.path, 'rb') as f:
+            f.seek(self.data_start + offset)
+            return f.read(nbytes)
+
+    def read_chunk(self, i:int) -> np.ndarray:
+        """Reads and decompresses chunk `i`, which holds elements `bounds[i]` along `axis`."""
+        offset, nbytes = self.header['chunks'][i]
+        start, stop = self.bounds[i]
+        shape = list(self.shape)
+        shape[self.axis] = stop - start
+        raw_nbytes = int(np.prod(shape)) * self.dtype.itemsize
+        data = _decompress(self._read_bytes(offset, nbytes), self.header['codec'], raw_nbytes)
+        if self.header['shuffle']: return _unshuffle(data, self.dtype, shape)
+        return np.frombuffer(data, dtype=self.dtype).reshape(shape).copy()
+
+    def read(self, start = 0, stop:Optional[int] = None) -> np.ndarray:
+        """Reads elements `start:stop` along `axis`, only decompressing chunks that overlap that range, in a thread pool."""
+        size = self.shape[self.axis]
+        if stop is None: stop = size
+        start = min(max(start, 0), size)
+        stop = max(min(stop, size), start)
+        first = start // self.chunk_size
+        last = max(first, (stop - 1) // self.chunk_size)
+
+        shape = list(self.shape)
+        shape[self.axis] = stop - start
+        out = np.empty(shape, dtype=self.dtype)
+        def read_into(i:int):
+            cstart, cstop = self.bounds[i]
+            lo, hi = max(cstart, start), min(cstop, stop)
+            chunk = self.read_chunk(i)
+            src = [slice(None)] * len(shape)
+            dst = [slice(None)] * len(shape)
+            src[self.axis] = slice(lo - cstart, hi - cstart)
+            dst[self.axis] = slice(lo - start, hi - start)
+            out[tuple(dst)] = chunk[tuple(src)]
+
+        if stop > start:
+            with concurrent.futures.ThreadPoolExecutor(self.n_threads) as executor:
+                list(executor.map(read_into, range(first, last + 1)))
+        return out
+
+    def __getitem__(self, index:int | slice) -> np.ndarray:
+        """Indexes along `axis`, slices with steps read the covering range first."""
+        if not isinstance(index, slice):
+            index = operator.index(index)
+            size = self.shape[self.axis]
+            if index < 0: index += size
+            if not 0 <= index < size: raise IndexError(f'index {index} is out of bounds for axis {self.axis} with size {size}')
+            return np.take(self.read(index, index + 1), 0, axis=self.axis)
+        start, stop, step = index.indices(self.shape[self.axis])
+        if step == 1: return self.read(start, stop)
+        lo, hi = (start, stop) if step > 0 else (stop + 1, start + 1)
+        arr = self.read(lo, hi)
+        return np.take(arr, range(start - lo, stop - lo, step), axis=self.axis)
+
+    def __len__(self): return self.shape[self.axis]
+
+
+def chunkedread(path:str, n_threads:Optional[int] = None) -> np.ndarray:
+    """Reads a whole file saved by `chunked_save`, decompressing chunks in a thread pool."""
+    return ChunkedReader(path, n_threads).read()
+
+def chunkedreadtensor(path:str, n_threads:Optional[int] = None) -> torch.Tensor:
+    arr = chunkedread(path, n_threads)
+    if arr.dtype == np.uint16: arr = arr.astype(np.int32)
+    return torch.from_numpy(arr)
+
+def chunkedread_range(path:str, start:int, stop:int, n_threads:Optional[int] = None) -> np.ndarray:
+    """Reads elements `start:stop` along chunking axis, e.g. a few slices of a volume, without decompressing other chunks."""
+    return ChunkedReader(path, n_threads).read(start, stop)
+
+def chunkedreadtensor_range(path:str, start:int, stop:int, n_threads:Optional[int] = None) -> torch.Tensor:
+    arr = chunkedread_range(path, start, stop, n_threads)
+    if arr.dtype == np.uint16: arr = arr.astype(np.int32)
+    return torch.from_numpy(arr)
@@ -1,11 +1,14 @@
 """dicom tools"""
 
+from typing import Optional
 import logging
 import os
+import concurrent.futures
 import numpy as np
 import torch
 import torchvision.transforms.v2
 import pydicom
+import pydicom.errors, pydicom.multival, pydicom.valuerep
 
 
 def dcmread(path) -> np.ndarray:
@@ -78,6 +81,96 @@ def dcmreadtensor_paths(paths:list[str], dtype=None) -> torch.Tensor:
     return torch.as_tensor(arr, dtype=dtype)
 
 
+def dcmread_paths_into(paths:list[str], out:np.ndarray, n_threads = 8):
+    """Reads an unsorted sequence of DICOM files into preallocated `out` of shape `(slices, rows, columns)`, sorted by `InstanceNumber`.
+
+    Files are parsed and pixel data is decoded in a thread pool, which is faster than `dcmread_paths` because file reads
+    and most of decoding release the GIL.
+
+    Args:
+        paths (list[str]): _description_
+        out (np.ndarray): _description_
+        n_threads (int, optional): _description_. Defaults to 8.
+    """
+    with concurrent.futures.ThreadPoolExecutor(n_threads) as executor:
+        images = sorted(executor.map(pydicom.dcmread, paths), key = lambda x: x.InstanceNumber)
+        def decode(i): out[i] = images[i].pixel_array
+        list(executor.map(decode, range(len(images))))
+
+def dcmread_folder_shape(path) -> tuple[int, int, int]:
+    """`(slices, rows, columns)` of a DICOM series folder from the header of one file."""
+    files = os.listdir(path)
+    ds = pydicom.dcmread(os.path.join(path, files[0]), stop_before_pixels=True)
+    return len(files), int(ds.Rows), int(ds.Columns)
+
+def dcmreadtensor_paths_parallel(paths:list[str], dtype=torch.float32, n_threads = 8) -> torch.Tensor:
+    """Same as `dcmreadtensor_paths`, but reads and decodes files in a thread pool straight into a preallocated tensor.
+
+    Args:
+        paths (list[str]): _description_
+        dtype (_type_, optional): _description_. Defaults to torch.float32.
+        n_threads (int, optional): _description_. Defaults to 8.
+
+    Returns:
+        torch.Tensor: _description_
+    """
+    ds = pydicom.dcmread(paths[0], stop_before_pixels=True)
+    out = torch.empty((len(paths), int(ds.Rows), int(ds.Columns)), dtype=dtype)
+    dcmread_paths_into(paths, out.numpy(), n_threads)
+    return out
+
+def dcmreadtensor_folder_parallel(path, dtype=torch.float32, n_threads = 8) -> torch.Tensor:
+    return dcmreadtensor_paths_parallel([os.path.join(path, i) for i in os.listdir(path)], dtype, n_threads)
+
+
+DICOM_HEADER_TAGS = ('PatientID', 'StudyInstanceUID', 'SeriesInstanceUID', 'SeriesNumber', 'SeriesDescription', 'Modality', 'Manufacturer',
+                     'MagneticFieldStrength', 'Rows', 'Columns', 'PixelSpacing', 'SliceThickness', 'SpacingBetweenSlices',
+                     'ImageOrientationPatient', 'ImagePositionPatient', 'InstanceNumber', 'EchoTime', 'RepetitionTime', 'BitsAllocated')
+"""Tags `dcmread_header` reads by default."""
+
+def _header_value(value):
+    """`IS` and other integer values become int, `DS` and other numbers float, multi-valued tags lists, anything else str."""
+    if value is None: return None
+    if isinstance(value, pydicom.multival.MultiValue): return [_header_value(i) for i in value]
+    # IS is a subclass of int and DSfloat of float
+    if isinstance(value, int): return int(value)
+    if isinstance(value, float): return float(value)
+    return str(value)
+
+def dcmread_header(path, tags:tuple[str, ...] = DICOM_HEADER_TAGS) -> Optional[dict]:
+    """Reads `tags` from a DICOM file without reading pixel data, missing tags are None, multi-valued tags are lists.
+    Integer tags like `InstanceNumber` are int, decimal tags like `SliceThickness` are float.
+    Returns None if `path` is not a DICOM file.
+
+    Args:
+        path (_type_): path to a DICOM file.
+        tags (tuple[str, ...], optional): _description_. Defaults to DICOM_HEADER_TAGS.
+
+    Returns:
+        Optional[dict]: _description_
+    """
+    try: ds = pydicom.dcmread(path, stop_before_pixels=True, specific_tags=list(tags))
+    except (pydicom.errors.InvalidDicomError, OSError): return None
+    header:dict = {'path': path}
+    for tag in tags: header[tag] = _header_value(ds.get(tag, None))
+    return header
+
+def dcmread_headers(paths:list[str], tags:tuple[str, ...] = DICOM_HEADER_TAGS, n_workers:Optional[int] = None, chunksize = 64) -> list[dict]:
+    """Reads `tags` of many files with `dcmread_header` in a process pool, non-DICOM files are skipped.
+
+    Args:
+        paths (list[str]): _description_
+        tags (tuple[str, ...], optional): _description_. Defaults to DICOM_HEADER_TAGS.
+        n_workers (Optional[int], optional): _description_. Defaults to None.
+        chunksize (int, optional): _description_. Defaults to 64.
+
+    Returns:
+        list[dict]: _description_
+    """
+    with concurrent.futures.ProcessPoolExecutor(n_workers) as executor:
+        return [h for h in executor.map(dcmread_header, paths, [tags] * len(paths), chunksize=chunksize) if h is not None]
+
+
 def dcmread_folder(path) -> np.ndarray:
     """Reads all files in a folder, sorts them by `InstanceNumber` and stacks into a np.ndarray.
 
@@ -1,7 +1,11 @@
 "img oladers "
 
+from collections.abc import Callable, Sequence
+from typing import Optional
+import concurrent.futures
 import logging
 import os
+import threading
 import torch
 import torchvision.transforms.v2
 
@@ -47,14 +51,69 @@ def imread_pil(path:str) -> np.ndarray:
 def imreadtensor_pil(path:str) -> torch.Tensor:
     return torch.as_tensor(imread_pil(path))
 
+IMREAD_BACKENDS: dict[str, Callable[[str], np.ndarray]] = {
+    'plt': imread_plt,
+    'skimage': imread_skimage,
+    # 'cv2': imread_cv2,
+    'pil': imread_pil,
+}
+"""Backends `imread` tries, in order."""
+
+_imread_backend_cache: dict[str, str] = {}
+_imread_backend_lock = threading.Lock()
+
+def _probe_imread(path:str, ext:str) -> np.ndarray:
+    errors = []
+    for name, backend in IMREAD_BACKENDS.items():
+        try: image = backend(path)
+        except Exception as e: # pylint:disable=W0718
+            errors.append(f'{name}: {e!r}')
+            continue
+        with _imread_backend_lock: _imread_backend_cache.setdefault(ext, name)
+        return image
+    raise RuntimeError(f"No backend could read {path}: {'; '.join(errors)}")
+
+def imread_backend(path:str) -> Optional[str]:
+    """Name of the backend `imread` uses for extension of `path`, None if no file with that extension was read yet."""
+    return _imread_backend_cache.get(os.path.splitext(path)[1].lower())
+
 def imread(path:str) -> np.ndarray:
-    try: return imread_plt(path)
-    except Exception:
-        try: return imread_skimage(path)
-        except Exception:
-            # try: return imread_cv2(path)
-            # except Exception:
-                return imread_pil(path)
+    """Reads an image with the first of `IMREAD_BACKENDS` that can read it.
+
+    Backends are probed once per file extension and the one that worked is cached, so next files with the same extension
+    go straight to it. If the cached backend fails on some file, the other backends are tried for that file only."""
+    ext = os.path.splitext(path)[1].lower()
+    name = _imread_backend_cache.get(ext)
+    if name is not None:
+        try: return IMREAD_BACKENDS[name](path)
+        except Exception: # pylint:disable=W0718
+            logging.warning("%s backend failed to read %s, trying other backends", name, path)
+    return _probe_imread(path, ext)
+
+def imread_into(path:str, out:np.ndarray) -> np.ndarray:
+    """Reads an image into preallocated `out`, casting to its dtype, and returns `out`."""
+    np.copyto(out, imread(path), casting='unsafe')
+    return out
+
+def imread_batch(paths:Sequence[str], out:Optional[np.ndarray] = None, dtype = None, n_threads = 8) -> np.ndarray:
+    """Reads images of the same shape into a `(N, *shape)` array in a thread pool, decoders release the GIL for most of the work.
+
+    `out` is a preallocated array to read into, otherwise it is allocated with shape of the first image and `dtype` (dtype of the first image by default)."""
+    paths = list(paths)
+    if out is None:
+        first = imread(paths[0])
+        out = np.empty((len(paths), *first.shape), dtype=dtype if dtype is not None else first.dtype)
+        out[0] = first
+        start = 1
+    else: start = 0
+    with concurrent.futures.ThreadPoolExecutor(n_threads) as executor:
+        list(executor.map(lambda i: imread_into(paths[i], out[i]), range(start, len(paths))))
+    return out
+
+def imreadtensor_batch(paths:Sequence[str], dtype = None, n_threads = 8) -> torch.Tensor:
+    arr = imread_batch(paths, dtype=dtype, n_threads=n_threads)
+    if arr.dtype == np.uint16: arr = arr.astype(np.int32)
+    return torch.from_numpy(arr)
 
 def imreadtensor(path:str):
     if path.lower().endswith(('jpg', 'jpeg', 'png', 'gif')): return imreadtensor_torchvision(path)
@@ -1,6 +1,8 @@
 """nifti"""
+from collections.abc import Sequence
 from typing import Optional
 import concurrent.futures
+import os, gzip, hashlib, shutil, tempfile, threading
 import nibabel as nib
 import SimpleITK as sitk
 # import ants
@@ -10,6 +12,121 @@ import torch
 def niiread(path:str) -> np.ndarray:
     return np.asanyarray(nib.load(path).dataobj) # type:ignore
 
+NII_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'glio', 'nii')
+"""Default folder for uncompressed copies made by `nii_uncompressed`, kept out of dataset folders so that file scans don't pick them up."""
+
+_uncompress_locks: dict[str, threading.Lock] = {}
+_uncompress_locks_lock = threading.Lock()
+
+def _uncompressed_path(path:str, cache_dir:Optional[str]) -> str:
+    # files from different folders often have the same name, e.g. `t1.nii.gz` in each study, so name includes hash of the full path
+    path_hash = hashlib.blake2b(os.path.abspath(path).encode(), digest_size=8).hexdigest()
+    name = os.path.basename(path)[:-3]
+    if name.endswith('.nii'): name = name[:-4]
+    return os.path.join(cache_dir if cache_dir is not None else NII_CACHE_DIR, f'{name}.{path_hash}.nii')
+
+def nii_uncompressed(path:str, cache_dir:Optional[str] = None) -> str:
+    """Returns path to an uncompressed copy of a `.nii.gz` file, creating it on first call or when `path` is newer than the copy.
+    The copy is saved in `cache_dir`, or in `NII_CACHE_DIR` if it is None. Uncompressed paths are returned as is.
+
+    `.nii.gz` is the whole `.nii` file gzipped, so the copy is a byte-exact decompression.
+    Safe to call from many threads and processes at once, each decompresses into its own temporary file which is then atomically renamed."""
+    if not path.endswith('.gz'): return path
+    out = _uncompressed_path(path, cache_dir)
+    with _uncompress_locks_lock: lock = _uncompress_locks.setdefault(out, threading.Lock())
+    # threads of this process wait for the first one instead of decompressing the same file again
+    with lock:
+        if os.path.isfile(out) and os.path.getmtime(out) >= os.path.getmtime(path): return out
+        os.makedirs(os.path.dirname(out), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(suffix='.tmp', prefix=f'{os.path.basename(out)}.', dir=os.path.dirname(out))
+        try:
+            with gzip.open(path, 'rb') as fin, os.fdopen(fd, 'wb') as fout: shutil.copyfileobj(fin, fout, 1024 * 1024)
+            os.replace(tmp, out)
+        except BaseException:
+            if os.path.exists(tmp): os.remove(tmp)
+            raise
+    return out
+
+def niiread_roi(path:str, roi:int | slice | tuple[int | slice, ...], cache_dir:Optional[str] = None, uncompress = True) -> np.ndarray:
+    """Reads a region of a nifti file through nibabel array proxy, e.g. `niiread_roi(path, (slice(None), slice(None), 80))` reads one axial slice
+    and `niiread_roi(path, (slice(20, 200, 2), slice(20, 200, 2)))` reads a strided crop. Indexing is in nibabel order.
+
+    For uncompressed files only the bytes of the region are read. Compressed files would have to be decompressed up to the region on each read,
+    so if `uncompress` is True they are read from an uncompressed copy made once by `nii_uncompressed` in `cache_dir`."""
+    if uncompress: path = nii_uncompressed(path, cache_dir)
+    return np.asanyarray(nib.load(path).dataobj[roi]) # type:ignore
+
+def niireadtensor_roi(path:str, roi:int | slice | tuple[int | slice, ...], cache_dir:Optional[str] = None, uncompress = True) -> torch.Tensor:
+    arr = niiread_roi(path, roi, cache_dir, uncompress)
+    if arr.dtype == np.uint16: arr = arr.astype(np.int32)
+    return torch.from_numpy(np.ascontiguousarray(arr))
+
+def niiread_slice(path:str, index:int, axis = 2, cache_dir:Optional[str] = None, uncompress = True) -> np.ndarray:
+    """Reads slice `index` along `axis` (nibabel order), see `niiread_roi`."""
+    roi = [slice(None)] * 3
+    roi[axis] = index # type:ignore
+    return niiread_roi(path, tuple(roi), cache_dir, uncompress)
+
+def niiread_shape(path:str) -> tuple[int, ...]:
+    """Shape from the header without reading data."""
+    return tuple(nib.load(path).shape) # type:ignore
+
+def _niiread_into(path:str, out:np.ndarray):
+    """Reads data in its on-disk dtype into `out` and applies `scl_slope` and `scl_inter` in place,
+    `np.asanyarray(dataobj)` would make a float64 copy of the whole image first when they are set."""
+    # gzip decompression and file reads release the GIL
+    proxy = nib.load(path).dataobj # type:ignore
+    slope, inter = float(proxy.slope), float(proxy.inter)
+    scaled = slope != 1 or inter != 0
+    if scaled and not np.issubdtype(out.dtype, np.floating):
+        np.copyto(out, np.asanyarray(proxy), casting='unsafe')
+        return
+    np.copyto(out, proxy.get_unscaled(), casting='unsafe')
+    if slope != 1: np.multiply(out, slope, out=out, casting='unsafe')
+    if inter != 0: np.add(out, inter, out=out, casting='unsafe')
+
+def read_study(paths:Sequence[str], dtype = torch.float32, n_threads:Optional[int] = None, dicom_threads = 8) -> torch.Tensor:
+    """Reads all modalities of a study concurrently into a preallocated `(C, *spatial)` tensor, `paths` are nifti files or DICOM series folders.
+
+    Shapes are read from headers first, then each file is read straight into its channel in a thread pool,
+    and DICOM folders also decode their slices in `dicom_threads` threads. Nifti files are in nibabel order like `niiread`,
+    DICOM folders in `(slices, rows, columns)` order like `dcmread_folder`, so `paths` can't mix them, and all paths must give the same shape."""
+    from .dicom import dcmread_paths_into, dcmread_folder_shape
+    is_dicom = [os.path.isdir(p) for p in paths]
+    if any(is_dicom) and not all(is_dicom):
+        raise ValueError(f"Nifti files and DICOM folders have different axis order and can't be read into one tensor, got {list(paths)}")
+    if not any(is_dicom):
+        orientations = [''.join(nib.aff2axcodes(nib.load(p).affine)) for p in paths] # type:ignore
+        if len(set(orientations)) != 1: raise ValueError(f"All modalities must have the same orientation, got {orientations}")
+    shapes = [dcmread_folder_shape(p) if d else niiread_shape(p) for p, d in zip(paths, is_dicom)]
+    if len(set(shapes)) != 1: raise ValueError(f"All modalities must have the same shape, got {shapes}")
+    out = torch.empty((len(paths), *shapes[0]), dtype=dtype)
+    arr = out.numpy()
+
+    def read(i:int):
+        if is_dicom[i]: dcmread_paths_into([os.path.join(paths[i], f) for f in os.listdir(paths[i])], arr[i], dicom_threads)
+        else: _niiread_into(paths[i], arr[i])
+
+    with concurrent.futures.ThreadPoolExecutor(n_threads if n_threads is not None else len(paths)) as executor:
+        list(executor.map(read, range(len(paths))))
+    return out
+
+def niiread_header(path:str) -> dict:
+    """Shape, spacing, orientation and dtype from the header without reading image data."""
+    img = nib.load(path)
+    header = img.header # type:ignore
+    shape = tuple(int(i) for i in img.shape) # type:ignore
+    return {
+        'path': path,
+        'shape': list(shape),
+        'ndim': len(shape),
+        'spacing': [float(i) for i in header.get_zooms()],
+        'orientation': ''.join(nib.aff2axcodes(img.affine)), # type:ignore
+        'dtype': str(header.get_data_dtype()),
+        'qform_code': int(header['qform_code']),
+        'sform_code': int(header['sform_code']),
+    }
+
 def niiread_affine(path:str) -> np.ndarray:
     return nib.load(path).affine # type:ignore
 
@@ -27,11 +144,61 @@ def niiwrite_nib(path:str, arr:np.ndarray | torch.Tensor, affine:Optional[np.nda
     if isinstance(arr, torch.Tensor): arr = arr.numpy()
     nib.save((nib.Nifti1Image(arr, affine)), path) # type:ignore
 
-def niiwrite_sitk(path:str, arr:np.ndarray | torch.Tensor, clevel = 9):
+def niiwrite_sitk(path:str, arr:np.ndarray | torch.Tensor | sitk.Image, clevel = 9, writer:Optional["NiftiWriter"] = None):
+    """If `writer` is given, the file is written in its background threads and a future is returned."""
+    if writer is not None: return writer.write(arr, path, clevel)
     if clevel < 1: usec = False
     else: usec = True
-    if isinstance(arr, torch.Tensor): arr = arr.numpy()
-    sitk.WriteImage(sitk.GetImageFromArray(arr), path, useCompression=usec, compressionLevel=clevel) # type:ignore
+    if isinstance(arr, torch.Tensor): arr = arr.detach().cpu().numpy()
+    if not isinstance(arr, sitk.Image): arr = sitk.GetImageFromArray(arr)
+    sitk.WriteImage(arr, path, useCompression=usec, compressionLevel=clevel) # type:ignore
+
+
+class NiftiWriter:
+    def __init__(self, n_threads = 2, max_pending = 8, clevel = 6):
+        """Writes images in background threads so that the caller can move on to the next study while previous outputs are compressed and written.
+
+        `write` blocks when `max_pending` writes are queued, which bounds memory used by images waiting to be written.
+        `clevel` is the default compression level, 0 writes uncompressed. Use as a context manager, on exit it waits for all writes
+        and raises the first error, if any."""
+        self.executor = concurrent.futures.ThreadPoolExecutor(n_threads)
+        self.clevel = clevel
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._futures: list[concurrent.futures.Future] = []
+        self._lock = threading.Lock()
+
+    def _write(self, image:sitk.Image, path:str, clevel:int) -> str:
+        try: sitk.WriteImage(image, path, useCompression=clevel > 0, compressionLevel=clevel)
+        finally: self._slots.release()
+        return path
+
+    def write(self, image:sitk.Image | np.ndarray | torch.Tensor, path:str, clevel:Optional[int] = None) -> concurrent.futures.Future:
+        """Queues `image` to be written to `path`, returns a future with `path` as the result.
+        Arrays are converted to `sitk.Image` (which copies them) before returning, so they can be modified afterwards."""
+        if isinstance(image, torch.Tensor): image = image.detach().cpu().numpy()
+        if not isinstance(image, sitk.Image): image = sitk.GetImageFromArray(image)
+        self._slots.acquire() # pylint:disable=R1732
+        try: future = self.executor.submit(self._write, image, path, clevel if clevel is not None else self.clevel)
+        except BaseException:
+            self._slots.release()
+            raise
+        with self._lock:
+            self._futures = [f for f in self._futures if not f.done() or f.exception() is not None]
+            self._futures.append(future)
+        return future
+
+    def flush(self):
+        """Waits for all queued writes, raises the first error."""
+        with self._lock: futures, self._futures = self._futures, []
+        concurrent.futures.wait(futures)
+        for f in futures: f.result()
+
+    def close(self):
+        try: self.flush()
+        finally: self.executor.shutdown()
+
+    def __enter__(self): return self
+    def __exit__(self, *args): self.close()
 
 def niiread_sitk(path):
     return sitk.GetArrayFromImage(sitk.ReadImage(path))
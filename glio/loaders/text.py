@@ -1,4 +1,7 @@
-import random, torch
+from collections.abc import Callable, Iterable, Sequence
+from typing import Optional
+import random, json, torch
+import numpy as np
 
 def get_char_dict(text:str, mode='random'):
     unique = list(set(text))
@@ -38,3 +41,68 @@ def str_to_2d_tensor(text:str, vmin = 0, vmax = 1, mode = 'random', term = ['.',
 
 
 
+
+
+def tokenize_corpus(texts:Iterable[str], tokenizer:Callable[[str], Sequence[int]], outpath:str, dtype = np.uint32, buffer_tokens = 2**20) -> str:
+    """Tokenizes documents one by one and appends tokens to a flat binary file, so the corpus never has to fit in memory.
+
+    Writes `{outpath}.bin` with tokens, `{outpath}.offsets.npy` with start of each document and total number of tokens at the end,
+    and `{outpath}.json` with dtype. Use `np.uint16` `dtype` if vocabulary has less than 65536 tokens to halve the size. Returns `outpath`."""
+    offsets = [0]
+    buffer:list[int] = []
+    with open(f'{outpath}.bin', 'wb') as f:
+        for text in texts:
+            tokens = tokenizer(text)
+            buffer.extend(tokens)
+            offsets.append(offsets[-1] + len(tokens))
+            if len(buffer) >= buffer_tokens:
+                f.write(np.asarray(buffer, dtype=dtype).tobytes())
+                buffer = []
+        f.write(np.asarray(buffer, dtype=dtype).tobytes())
+    np.save(f'{outpath}.offsets.npy', np.asarray(offsets, dtype=np.int64))
+    with open(f'{outpath}.json', 'w', encoding='utf8') as f: json.dump({'dtype': np.dtype(dtype).str, 'n_tokens': offsets[-1], 'n_docs': len(offsets) - 1}, f)
+    return outpath
+
+def tokenize_files(paths:Iterable[str], tokenizer:Callable[[str], Sequence[int]], outpath:str, dtype = np.uint32, encoding = 'utf8') -> str:
+    """`tokenize_corpus` where each file is a document."""
+    def texts():
+        for path in paths:
+            with open(path, 'r', encoding=encoding) as f: yield f.read()
+    return tokenize_corpus(texts(), tokenizer, outpath, dtype)
+
+class TokenCorpus:
+    def __init__(self, path:str):
+        """Memory-mapped corpus from `tokenize_corpus`, `path` is the `outpath` it was saved to."""
+        with open(f'{path}.json', 'r', encoding='utf8') as f: meta = json.load(f)
+        self.tokens = np.memmap(f'{path}.bin', dtype=np.dtype(meta['dtype']), mode='r', shape=(meta['n_tokens'],))
+        self.offsets = np.load(f'{path}.offsets.npy')
+
+    @property
+    def n_docs(self): return len(self.offsets) - 1
+
+    def __len__(self): return len(self.tokens)
+
+    def document(self, i:int) -> torch.Tensor:
+        return torch.from_numpy(self.tokens[self.offsets[i]:self.offsets[i+1]].astype(np.int64))
+
+class TokenWindows:
+    def __init__(self, corpus:TokenCorpus | str, seq_len:int, stride:Optional[int] = None):
+        """Fixed-length windows over the flat token stream of a `TokenCorpus` (windows can span document boundaries).
+
+        Indexing returns `(inputs, targets)`, each a `seq_len` int64 tensor, targets are inputs shifted by one token.
+        Only the window is read from the memory map. Instances are callable with an index, so they can be used as a `DS` loader:
+        `ds.add_samples(range(len(windows)), loader=windows)`."""
+        self.corpus = TokenCorpus(corpus) if isinstance(corpus, str) else corpus
+        self.seq_len = seq_len
+        self.stride = stride if stride is not None else seq_len
+
+    def __len__(self): return max(0, (len(self.corpus) - self.seq_len - 1) // self.stride + 1)
+
+    def __getitem__(self, i:int) -> tuple[torch.Tensor, torch.Tensor]:
+        if i < 0: i += len(self)
+        if not 0 <= i < len(self): raise IndexError(i)
+        start = i * self.stride
+        window = torch.from_numpy(self.corpus.tokens[start:start + self.seq_len + 1].astype(np.int64))
+        return window[:-1], window[1:]
+
+    def __call__(self, i:int): return self[i]
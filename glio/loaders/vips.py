@@ -2,8 +2,121 @@
 # vipsbin = r'c:\Apps\vips-dev-web-8.15-static\bin'
 # add_dll_dir = getattr(os, 'add_dll_directory', None)
 # os.environ['PATH'] = os.pathsep.join((vipsbin, os.environ['PATH']))
+"""Whole and tiled reads of large images (whole-slide images, pyramidal tiffs, big mosaics) through libvips, which decodes only requested regions."""
+from collections import deque
+from collections.abc import Iterator
+import concurrent.futures
+import threading
+import numpy as np
+import torch
+import pyvips
 
-# import pyvips, torch
-# def read(path):
-#     return torch.from_numpy(pyvips.Image.new_from_file(path))
+_FORMATS = {'uchar': np.uint8, 'char': np.int8, 'ushort': np.uint16, 'short': np.int16,
+            'uint': np.uint32, 'int': np.int32, 'float': np.float32, 'double': np.float64}
 
+def _to_numpy(data:bytes, fmt:str, h:int, w:int, bands:int) -> np.ndarray:
+    return np.frombuffer(data, dtype=_FORMATS[fmt]).reshape(h, w, bands)
+
+def _to_tensor(arr:np.ndarray) -> torch.Tensor:
+    """`(H, W, C)` array to `(C, H, W)` tensor."""
+    if arr.dtype == np.uint16: arr = arr.astype(np.int32)
+    elif arr.dtype == np.uint32: arr = arr.astype(np.int64)
+    return torch.from_numpy(np.ascontiguousarray(arr.transpose(2, 0, 1)))
+
+def _is_downscale(page:pyvips.Image, base:pyvips.Image) -> bool:
+    """Pages of pyramidal tiffs are smaller copies of the first page with the same aspect ratio, pages of other multi-page tiffs are not."""
+    if page.width >= base.width or page.height >= base.height or page.bands != base.bands: return False
+    scale_x, scale_y = base.width / page.width, base.height / page.height
+    return abs(scale_x - scale_y) <= 0.05 * scale_x
+
+def vipsopen(path:str, level = 0) -> pyvips.Image:
+    """Opens image at pyramid `level` (0 is full resolution) without decoding it.
+
+    Uses openslide levels for whole-slide formats, pages for pyramidal tiffs, otherwise the image is shrunk by `2 ** level` on the fly."""
+    base = pyvips.Image.new_from_file(path, access='random')
+    if level == 0: return base
+    try: return pyvips.Image.new_from_file(path, level=level, access='random')
+    except pyvips.Error: pass
+    try:
+        page = pyvips.Image.new_from_file(path, page=level, access='random')
+        if _is_downscale(page, base): return page
+    except pyvips.Error: pass
+    return base.shrink(2 ** level, 2 ** level)
+
+def vipsread(path:str) -> np.ndarray:
+    """Reads the whole image as `(H, W, C)` array."""
+    image = vipsopen(path)
+    return _to_numpy(image.write_to_memory(), image.format, image.height, image.width, image.bands)
+
+def vipsreadtensor(path:str) -> torch.Tensor:
+    return _to_tensor(vipsread(path))
+
+def vipsread_region(image:str | pyvips.Image, x:int, y:int, w:int, h:int, level = 0) -> torch.Tensor:
+    """Reads `(C, h, w)` region with top left corner at `x, y` in `level` coordinates, parts outside of the image are zeros."""
+    if isinstance(image, str): image = vipsopen(image, level)
+    return _to_tensor(_fetch(pyvips.Region.new(image), image, x, y, w, h))
+
+def _fetch(region:pyvips.Region, image:pyvips.Image, x:int, y:int, w:int, h:int) -> np.ndarray:
+    x0, y0 = max(x, 0), max(y, 0)
+    x1, y1 = min(x + w, image.width), min(y + h, image.height)
+    out = np.zeros((h, w, image.bands), dtype=_FORMATS[image.format])
+    if x1 > x0 and y1 > y0:
+        out[y0 - y:y1 - y, x0 - x:x1 - x] = _to_numpy(region.fetch(x0, y0, x1 - x0, y1 - y0), image.format, y1 - y0, x1 - x0, image.bands)
+    return out
+
+
+class VipsTiles:
+    def __init__(self, path:str, tile_size:int | tuple[int, int], overlap:int | tuple[int, int] = 0, level = 0, prefetch = 2, n_threads = 1):
+        """Tiles of a large image at pyramid `level`, `tile_size` and `overlap` are `(h, w)` or an int for both.
+        Edge tiles are zero-padded to full size. Only the requested tiles are ever decoded.
+
+        Indexing returns a `(C, h, w)` tensor, `coords(i)` gives its `x, y`, so it can be used as a `DS` loader:
+        `ds.add_samples(range(len(tiles)), loader=tiles)`. Iterating reads the next `prefetch` tiles in background threads."""
+        self.path = path
+        self.level = level
+        self.tile_h, self.tile_w = (tile_size, tile_size) if isinstance(tile_size, int) else tile_size
+        overlap_h, overlap_w = (overlap, overlap) if isinstance(overlap, int) else overlap
+        self.stride_h, self.stride_w = self.tile_h - overlap_h, self.tile_w - overlap_w
+        if self.stride_h <= 0 or self.stride_w <= 0: raise ValueError(f'overlap {overlap} must be smaller than tile size {tile_size}')
+        self.prefetch = prefetch
+        self.n_threads = n_threads
+
+        self.image = vipsopen(path, level)
+        self.n_rows = max(1, -(-(self.image.height - overlap_h) // self.stride_h))
+        self.n_cols = max(1, -(-(self.image.width - overlap_w) // self.stride_w))
+        # regions aren't thread safe, each thread gets its own
+        self._local = threading.local()
+
+    def _region(self) -> pyvips.Region:
+        if not hasattr(self._local, 'region'): self._local.region = pyvips.Region.new(self.image)
+        return self._local.region
+
+    def __len__(self): return self.n_rows * self.n_cols
+
+    def coords(self, i:int) -> tuple[int, int]:
+        """`x, y` of top left corner of tile `i` in `level` coordinates, tiles go row by row."""
+        row, col = divmod(i, self.n_cols)
+        return col * self.stride_w, row * self.stride_h
+
+    def __getitem__(self, i:int) -> torch.Tensor:
+        if i < 0: i += len(self)
+        if not 0 <= i < len(self): raise IndexError(i)
+        x, y = self.coords(i)
+        return _to_tensor(_fetch(self._region(), self.image, x, y, self.tile_w, self.tile_h))
+
+    def __call__(self, i:int): return self[i]
+
+    def __iter__(self) -> Iterator[tuple[tuple[int, int], torch.Tensor]]:
+        """Yields `(x, y), tile` for all tiles, reading the next `prefetch` tiles in the background."""
+        with concurrent.futures.ThreadPoolExecutor(self.n_threads) as executor:
+            pending:deque[concurrent.futures.Future] = deque()
+            next_i = 0
+            for i in range(len(self)):
+                while next_i < len(self) and next_i <= i + self.prefetch:
+                    pending.append(executor.submit(self.__getitem__, next_i))
+                    next_i += 1
+                yield self.coords(i), pending.popleft().result()
+
+    def region(self, x:int, y:int, w:int, h:int) -> torch.Tensor:
+        """Arbitrary `(C, h, w)` region in `level` coordinates."""
+        return _to_tensor(_fetch(self._region(), self.image, x, y, w, h))
@@ -0,0 +1,129 @@
+"""Binary morphology and geometry on tensors, vectorized over all leading (batch, class) dimensions.
+
+All functions take a `(*, spatial)` tensor, where the last `spatial_dims` dimensions are spatial, and work on any device."""
+from typing import Literal
+import torch
+import torch.nn.functional as F
+
+Connectivity = Literal['cross', 'box']
+"""`cross` - only face neighbours (6 in 3D, 4 in 2D), `box` - all neighbours (26 in 3D, 8 in 2D)."""
+
+def _max_filter_1d(x: torch.Tensor, dim: int, pad_value: float) -> torch.Tensor:
+    """Max over a window of 3 along spatial `dim` of a N1(spatial) tensor, outside voxels are `pad_value`."""
+    spatial_dims = x.ndim - 2
+    kernel = [1] * spatial_dims
+    kernel[dim] = 3
+    pad = [0] * (spatial_dims * 2)
+    # F.pad goes from last dimension
+    pad[(spatial_dims - 1 - dim) * 2] = 1
+    pad[(spatial_dims - 1 - dim) * 2 + 1] = 1
+    x = F.pad(x, pad, value=pad_value)
+    if spatial_dims == 3: return F.max_pool3d(x, kernel, stride=1)
+    if spatial_dims == 2: return F.max_pool2d(x, kernel, stride=1)
+    if spatial_dims == 1: return F.max_pool1d(x, kernel, stride=1)
+    raise NotImplementedError(f'{spatial_dims} spatial dimensions')
+
+def _max_filter(x: torch.Tensor, connectivity: Connectivity, pad_value: float) -> torch.Tensor:
+    """3^n max filter of a N1(spatial) tensor. `box` is separable, `cross` is the union of 1D filters along each axis."""
+    spatial_dims = x.ndim - 2
+    if connectivity == 'box':
+        for dim in range(spatial_dims): x = _max_filter_1d(x, dim, pad_value)
+        return x
+    if connectivity == 'cross':
+        res = _max_filter_1d(x, 0, pad_value)
+        for dim in range(1, spatial_dims): res = torch.maximum(res, _max_filter_1d(x, dim, pad_value))
+        return res
+    raise ValueError(f'Unknown connectivity {connectivity}')
+
+def _to_pool(x: torch.Tensor, spatial_dims: int, dtype = torch.float32) -> torch.Tensor:
+    return x.reshape(-1, 1, *x.shape[x.ndim - spatial_dims:]).to(dtype)
+
+def binary_dilate(x: torch.Tensor, n = 1, spatial_dims = 3, connectivity: Connectivity = 'cross') -> torch.Tensor:
+    """Binary dilation `n` times with a 3^n structuring element. Returns a tensor of the same shape and dtype."""
+    res = _to_pool(x != 0, spatial_dims)
+    for _ in range(n): res = _max_filter(res, connectivity, 0)
+    return res.reshape(x.shape).to(x.dtype)
+
+def binary_erode(x: torch.Tensor, n = 1, spatial_dims = 3, connectivity: Connectivity = 'cross') -> torch.Tensor:
+    """Binary erosion `n` times with a 3^n structuring element, voxels outside the tensor are background. Returns a tensor of the same shape and dtype."""
+    # erosion is dilation of the background, outside counts as background
+    res = _to_pool(x == 0, spatial_dims)
+    for _ in range(n): res = _max_filter(res, connectivity, 1)
+    return (res == 0).reshape(x.shape).to(x.dtype)
+
+def binary_open(x: torch.Tensor, n = 1, spatial_dims = 3, connectivity: Connectivity = 'cross') -> torch.Tensor:
+    """Erosion followed by dilation, removes small objects and thin protrusions."""
+    return binary_dilate(binary_erode(x, n, spatial_dims, connectivity), n, spatial_dims, connectivity)
+
+def binary_close(x: torch.Tensor, n = 1, spatial_dims = 3, connectivity: Connectivity = 'cross') -> torch.Tensor:
+    """Dilation followed by erosion, fills small holes and gaps."""
+    return binary_erode(binary_dilate(x, n, spatial_dims, connectivity), n, spatial_dims, connectivity)
+
+def connected_components(x: torch.Tensor, spatial_dims = 3, connectivity: Connectivity = 'cross', max_iter = 10_000) -> torch.Tensor:
+    """Labels connected components of a binary tensor by iterative max-label propagation.
+
+    Returns int64 tensor of the same shape, background is 0, each component gets a label unique within its sample.
+    Labels are not consecutive. Number of iterations is the largest component's geodesic diameter."""
+    spatial_shape = x.shape[x.ndim - spatial_dims:]
+    numel = spatial_shape.numel()
+    # float32 represents integers exactly up to 2^24
+    dtype = torch.float32 if numel < 2**24 else torch.float64
+    fg = _to_pool(x != 0, spatial_dims, dtype)
+    labels = torch.arange(1, numel + 1, dtype=dtype, device=x.device).reshape(1, 1, *spatial_shape) * fg
+    for _ in range(max_iter):
+        new_labels = _max_filter(labels, connectivity, 0) * fg
+        if torch.equal(new_labels, labels): break
+        labels = new_labels
+    return labels.reshape(x.shape).to(torch.int64)
+
+def component_sizes(labels: torch.Tensor, spatial_dims = 3) -> torch.Tensor:
+    """Takes labels from `connected_components` and returns a tensor of the same shape where each voxel holds the size of its component (0 for background)."""
+    numel = labels.shape[labels.ndim - spatial_dims:].numel()
+    flat = labels.reshape(-1, numel)
+    # make labels unique across samples
+    offset = flat + (torch.arange(flat.shape[0], device=labels.device) * (numel + 1)).unsqueeze(1)
+    _, inverse, counts = torch.unique(offset, return_inverse=True, return_counts=True)
+    return (counts[inverse] * (flat != 0)).reshape(labels.shape)
+
+def remove_small_components(x: torch.Tensor, min_size: int, spatial_dims = 3, connectivity: Connectivity = 'cross') -> torch.Tensor:
+    """Removes connected components with less than `min_size` voxels from a binary tensor. Returns a tensor of the same shape and dtype."""
+    sizes = component_sizes(connected_components(x, spatial_dims, connectivity), spatial_dims)
+    return torch.where(sizes >= min_size, x, torch.zeros_like(x))
+
+def largest_component(x: torch.Tensor, spatial_dims = 3, connectivity: Connectivity = 'cross') -> torch.Tensor:
+    """Keeps only the largest connected component of each sample of a binary tensor."""
+    sizes = component_sizes(connected_components(x, spatial_dims, connectivity), spatial_dims)
+    max_sizes = sizes.reshape(*sizes.shape[:sizes.ndim - spatial_dims], -1).amax(-1)
+    max_sizes = max_sizes.reshape(*max_sizes.shape, *[1] * spatial_dims)
+    return torch.where((sizes == max_sizes) & (sizes > 0), x, torch.zeros_like(x))
+
+def center_of_mass(x: torch.Tensor, spatial_dims = 3) -> torch.Tensor:
+    """Center of mass of each sample of a `(*, spatial)` tensor, returns a `(*, spatial_dims)` float tensor, `nan` for empty samples."""
+    x = x.to(torch.float32)
+    first = x.ndim - spatial_dims
+    total = x.sum(list(range(first, x.ndim)))
+    coords = []
+    for dim in range(first, x.ndim):
+        # marginal along this axis
+        other = [d for d in range(first, x.ndim) if d != dim]
+        marginal = x.sum(other) if len(other) > 0 else x
+        coords.append((marginal * torch.arange(x.shape[dim], dtype=torch.float32, device=x.device)).sum(-1) / total)
+    return torch.stack(coords, -1)
+
+def bounding_boxes(x: torch.Tensor, spatial_dims = 3) -> torch.Tensor:
+    """Bounding box of nonzero voxels of each sample of a `(*, spatial)` tensor.
+
+    Returns `(*, spatial_dims, 2)` int64 tensor of `start, stop` for each axis (stop is exclusive, so `x[start:stop]` slices the box), all zeros for empty samples."""
+    nonzero = x != 0
+    first = x.ndim - spatial_dims
+    boxes = []
+    for dim in range(first, x.ndim):
+        other = [d for d in range(first, x.ndim) if d != dim]
+        profile = nonzero.to(torch.float32).amax(other) if len(other) > 0 else nonzero.to(torch.float32)
+        size = profile.shape[-1]
+        # argmax returns first occurence of max value
+        start = profile.argmax(-1)
+        stop = size - profile.flip(-1).argmax(-1)
+        empty = profile.amax(-1) == 0
+        boxes.append(torch.stack((start.masked_fill(empty, 0), stop.masked_fill(empty, 0)), -1))
+    return torch.stack(boxes, -2)
@@ -0,0 +1,68 @@
+"""Content-addressed on-disk cache of pipeline stage outputs."""
+from collections.abc import Callable, Sequence
+from typing import Any, Optional
+import hashlib, os
+import numpy as np
+import SimpleITK as sitk
+
+def image_hash(image:sitk.Image) -> str:
+    """Hash of pixel data, pixel type and spatial metadata of an image."""
+    h = hashlib.blake2b(digest_size=16)
+    h.update(repr((image.GetPixelIDValue(), image.GetSize(), image.GetSpacing(), image.GetOrigin(), image.GetDirection())).encode())
+    h.update(np.ascontiguousarray(sitk.GetArrayViewFromImage(image)).tobytes())
+    return h.hexdigest()
+
+def tool_version(module:str) -> str:
+    """Installed version of a package, or `unknown`."""
+    from importlib.metadata import version, PackageNotFoundError
+    try: return version(module)
+    except PackageNotFoundError: return 'unknown'
+
+class StageCache:
+    def __init__(self, cache_dir:str, ext = '.nii'):
+        """Stores outputs of pipeline stages in `cache_dir` under a hash of stage name, input images, parameters and tool version.
+
+        Files are written uncompressed by default because cache reads should be faster than recomputing."""
+        self.cache_dir = cache_dir
+        self.ext = ext
+        os.makedirs(cache_dir, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, stage:str, images:Sequence[sitk.Image], params:Any = None, version:str = '') -> str:
+        h = hashlib.blake2b(digest_size=16)
+        h.update(f'{stage}|{version}|{params!r}'.encode())
+        for image in images: h.update(image_hash(image).encode())
+        return f'{stage}-{h.hexdigest()}'
+
+    def _paths(self, key:str, n:int) -> list[str]:
+        return [os.path.join(self.cache_dir, f'{key}_{i}{self.ext}') for i in range(n)]
+
+    def get(self, key:str, n:int) -> Optional[list[sitk.Image]]:
+        """Returns `n` cached images under `key` or None if any of them is missing."""
+        paths = self._paths(key, n)
+        if not all(os.path.isfile(p) for p in paths): return None
+        return [sitk.ReadImage(p) for p in paths]
+
+    def put(self, key:str, images:Sequence[sitk.Image]):
+        for image, path in zip(images, self._paths(key, len(images))):
+            # write to a temporary file first so that an interrupted write doesn't leave a corrupted cache entry
+            tmp = f'{path}.tmp{self.ext}'
+            sitk.WriteImage(image, tmp, useCompression=False)
+            os.replace(tmp, path)
+
+    def __call__(self, stage:str, func:Callable[..., Sequence[sitk.Image]], images:Sequence[sitk.Image], n_outputs:int, params:Any = None, version:str = '') -> list[sitk.Image]:
+        """Returns cached outputs of `func(*images)` or runs it and caches the outputs."""
+        key = self.key(stage, images, params, version)
+        cached = self.get(key, n_outputs)
+        if cached is not None:
+            self.hits += 1
+            return cached
+        self.misses += 1
+        outputs = list(func(*images))
+        self.put(key, outputs)
+        return outputs
+
+    def clear(self):
+        for f in os.listdir(self.cache_dir):
+            if f.endswith(self.ext): os.remove(os.path.join(self.cache_dir, f))
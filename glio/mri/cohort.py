@@ -0,0 +1,258 @@
+"""Preprocessing of whole cohorts with the `pipeline` stages scheduled across studies."""
+from collections import Counter, deque
+from collections.abc import Callable, Mapping, Sequence
+from typing import Any, Optional
+from functools import partial
+import concurrent.futures
+from concurrent.futures.process import BrokenProcessPool
+import json, logging, os, time
+import SimpleITK as sitk
+from .pipeline import _toImage, _register, _register_shared, _register_params, _skullstrip
+from .normalize import znormalize_imgs
+from .crop_bg import crop_bg_imgs
+from .cache import StageCache, tool_version
+from .skullstrip import HDBETService
+from ..python_tools import find_file_containing, sec_to_timestr
+
+MODALITIES = ('t1', 't1ce', 'flair', 't2w')
+
+def _register_study(paths:Sequence[str | sitk.Image], cache_dir:Optional[str], shared_registration = False, preset = 'standard',
+                    n_threads:Optional[int] = None, register = True) -> tuple[list[sitk.Image], float]:
+    """Runs in the CPU pool. Takes `t1, t1ce, flair, t2w` and optionally `seg`, returns them registered to SRI24 and seconds it took.
+    If `register` is False, images are only loaded.
+
+    `n_threads` is the number of threads for elastix and other SimpleITK filters in this worker."""
+    start = time.perf_counter()
+    if n_threads is not None: sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(n_threads)
+    images = [_toImage(i) for i in paths]
+    if not register: return images, time.perf_counter() - start
+    stage, func = ('register_shared', _register_shared) if shared_registration else ('register', _register)
+    func = partial(func, preset=preset, n_threads=n_threads)
+    if cache_dir is not None:
+        res = StageCache(cache_dir)(stage, func, images, len(images), params=_register_params(preset), version=sitk.Version_VersionString())
+    else: res = func(*images)
+    return res, time.perf_counter() - start
+
+def _skullstrip_study(images:Sequence[sitk.Image], erode:int, cache_dir:Optional[str], service:Optional[HDBETService] = None) -> tuple[list[sitk.Image], float]:
+    """Runs in the skullstrip pool. Takes `t1, t1ce, flair, t2w` and optionally `seg`, returns them in the same order
+    with modalities skullstripped and seconds it took."""
+    start = time.perf_counter()
+    t1, t1ce, flair, t2w, *seg = images
+    func = partial(_skullstrip, erode=erode, service=service)
+    if cache_dir is not None:
+        # service settings change the mask, so they are part of the key
+        params = erode if service is None else (erode, service.mode, service.do_tta, service.postprocess)
+        res = StageCache(cache_dir)('skullstrip', func, (t1ce, t1, flair, t2w), 4, params=params, version=tool_version('HD_BET'))
+    else: res = func(t1ce, t1, flair, t2w)
+    t1ce, t1, flair, t2w = res
+    return [t1, t1ce, flair, t2w, *seg], time.perf_counter() - start
+
+def znorm_crop_study(images:Sequence[sitk.Image], cropbg = True) -> list[sitk.Image]:
+    """Default `CohortRunner` normalization, same as `pipeline`: z-normalizes `t1, t1ce, flair, t2w`,
+    then crops background of them and `seg` if given to the bounding box of t1."""
+    norm = znormalize_imgs(images[:4])
+    seg = list(images[4:])
+    if cropbg: return crop_bg_imgs(norm + seg)
+    return norm + seg
+
+def _normalize_study(images:Sequence[sitk.Image], folder:str, normalize:Callable[[Sequence[sitk.Image]], Sequence[sitk.Image]],
+                     compression:bool) -> tuple[list[str], tuple[float, float]]:
+    """Runs in the CPU pool. Normalizes images, saves them to `folder`, returns output paths and seconds normalization and saving took."""
+    start = time.perf_counter()
+    images = normalize(images)
+    normalize_sec = time.perf_counter() - start
+
+    start = time.perf_counter()
+    os.makedirs(folder, exist_ok=True)
+    outputs = []
+    for name, image in zip((*MODALITIES, 'seg'), images):
+        path = os.path.join(folder, f'{name}.nii.gz')
+        sitk.WriteImage(image, path, useCompression=compression)
+        outputs.append(path)
+    return outputs, (normalize_sec, time.perf_counter() - start)
+
+
+class CohortRunner:
+    def __init__(self, outdir:str, register_workers = 4, skullstrip_workers = 1, erode = 1, cropbg = True, cache_dir:Optional[str] = None,
+                 manifest = 'manifest.json', compression = True, skullstrip_service:Optional[HDBETService] = None,
+                 shared_registration = False, registration_preset = 'standard', max_in_flight:Optional[int] = None, max_restarts = 2,
+                 register = True, skullstrip = True, normalize:Optional[Callable[[Sequence[sitk.Image]], Sequence[sitk.Image]]] = None):
+        """Runs `pipeline` on many studies with stages scheduled across studies.
+
+        Registration runs in a pool of `register_workers` processes, each elastix gets cpu count divided by `register_workers` threads,
+        skullstripping runs in a separate pool of `skullstrip_workers` processes because HD-BET needs a lot of memory,
+        normalization, background cropping and saving run in the registration pool as soon as a study is skullstripped.
+        `register` and `skullstrip` can be disabled for cohorts that are already registered or skullstripped, then studies are only loaded.
+
+        `normalize` takes `t1, t1ce, flair, t2w` (and `seg`) after skullstripping and returns images to save, it runs in worker processes
+        so it must be picklable. Defaults to `znorm_crop_study` with `cropbg`, which is the same as `pipeline`.
+
+        At most `max_in_flight` studies are submitted to each stage at once, by default twice the number of workers of that stage.
+        Studies waiting for later stages count towards the registration limit, so they don't pile up in memory
+        when skullstripping is slower than registration.
+
+        If a worker dies (e.g. HD-BET killed by the OOM killer), its pool is recreated and studies that were in it are requeued,
+        a study that was in a broken pool more than `max_restarts` times is marked as failed.
+        Finished and failed studies are recorded in `manifest` in `outdir` after each study, so an interrupted run resumes where it stopped,
+        and a failing study doesn't stop the others. Outputs are saved to `outdir/{study}/{modality}.nii.gz`.
+
+        If `skullstrip_service` is given, skullstripping runs in a single thread of this process using it,
+        so HD-BET weights are loaded once for the whole cohort, and `skullstrip_workers` is ignored.
+
+        If `shared_registration` is True, modalities of each study must be co-registered in native space,
+        only t1ce is registered to SRI24 and its transform is applied to other modalities.
+        Studies can have a fifth `seg` path, which is registered with nearest neighbour interpolation (requires `shared_registration`),
+        not skullstripped or normalized, cropped with the modalities and saved to `seg.nii.gz`.
+
+        `registration_preset` is passed to `pipeline`, `auto` registers with the fast preset and only escalates poorly aligned studies."""
+        self.outdir = outdir
+        self.register_workers = register_workers
+        self.skullstrip_workers = skullstrip_workers
+        self.erode = erode
+        self.cropbg = cropbg
+        self.cache_dir = cache_dir
+        self.manifest_path = os.path.join(outdir, manifest)
+        self.compression = compression
+        self.skullstrip_service = skullstrip_service
+        self.shared_registration = shared_registration
+        self.registration_preset = registration_preset
+        self.max_in_flight = max_in_flight
+        self.max_restarts = max_restarts
+        self.register = register
+        self.skullstrip = skullstrip
+        self.normalize = normalize if normalize is not None else partial(znorm_crop_study, cropbg=cropbg)
+        self.stages = ['register' if register else 'load', *(['skullstrip'] if skullstrip else []), 'normalize']
+
+        os.makedirs(outdir, exist_ok=True)
+        self.manifest: dict[str, dict[str, Any]] = {}
+        if os.path.isfile(self.manifest_path):
+            with open(self.manifest_path, 'r', encoding='utf8') as f: self.manifest = json.load(f)
+
+        self.timings: dict[str, float] = {stage: 0. for stage in self.stages}
+        self.timings['save'] = 0.
+
+    def _save_manifest(self):
+        tmp = f'{self.manifest_path}.tmp'
+        with open(tmp, 'w', encoding='utf8') as f: json.dump(self.manifest, f, indent=1)
+        os.replace(tmp, self.manifest_path)
+
+    def _fail(self, study:str, stage:str, e:BaseException):
+        logging.error("study %s failed at %s: %r", study, stage, e)
+        self.manifest[study] = {'status': 'failed', 'stage': stage, 'error': repr(e)}
+        self._save_manifest()
+
+    def pending(self, studies:Mapping[str, Sequence[str]], retry_failed = False) -> list[str]:
+        """Studies that are not done, optionally including failed ones."""
+        return [s for s in studies if s not in self.manifest or (retry_failed and self.manifest[s]['status'] == 'failed')]
+
+    def _new_pool(self, pool:str) -> concurrent.futures.Executor:
+        if pool == 'cpu': return concurrent.futures.ProcessPoolExecutor(self.register_workers)
+        if self.skullstrip_service is not None: return concurrent.futures.ThreadPoolExecutor(1)
+        return concurrent.futures.ProcessPoolExecutor(self.skullstrip_workers)
+
+    def run(self, studies:Mapping[str, Sequence[str]], retry_failed = False, log = True) -> dict[str, Any]:
+        """`studies` maps study name to `t1, t1ce, flair, t2w` and optionally `seg` paths (nifti files or DICOM folders). Returns `summary()`."""
+        todo = self.pending(studies, retry_failed)
+        if self.register and not self.shared_registration and any(len(studies[s]) > 4 for s in todo):
+            raise ValueError("`seg` can only be registered with `shared_registration=True`")
+        start = time.perf_counter()
+        done = 0
+        n_threads = max(1, (os.cpu_count() or 1) // self.register_workers)
+        skullstrip_workers = 1 if self.skullstrip_service is not None else self.skullstrip_workers
+        first = self.stages[0]
+        # skullstripping has its own pool, other stages share the CPU pool
+        pool_of = {stage: 'skullstrip' if stage == 'skullstrip' else 'cpu' for stage in self.stages}
+        caps = {stage: self.max_in_flight or 2 * (skullstrip_workers if stage == 'skullstrip' else self.register_workers) for stage in self.stages}
+
+        pools = {pool: self._new_pool(pool) for pool in set(pool_of.values())}
+        # studies waiting for each stage, first stage takes paths, other stages take images
+        queues: dict[str, deque[tuple[str, Any]]] = {stage: deque() for stage in self.stages}
+        queues[first].extend((s, studies[s]) for s in todo)
+        # future -> study, stage, inputs and the pool it was submitted to, inputs are kept to requeue the study if the pool breaks
+        futures: dict[concurrent.futures.Future, tuple[str, str, Any, concurrent.futures.Executor]] = {}
+        restarts: Counter[str] = Counter()
+
+        def restart(stage:str, pool:concurrent.futures.Executor):
+            # all futures of a broken pool fail, only recreate it once
+            if pools[pool_of[stage]] is not pool: return
+            logging.warning("%s pool is broken, recreating it", pool_of[stage])
+            pool.shutdown(wait=False, cancel_futures=True)
+            pools[pool_of[stage]] = self._new_pool(pool_of[stage])
+
+        def submit(stage:str, study:str, inputs):
+            if stage == first: args = (_register_study, inputs, self.cache_dir, self.shared_registration, self.registration_preset, n_threads, self.register)
+            elif stage == 'skullstrip': args = (_skullstrip_study, inputs, self.erode, self.cache_dir, self.skullstrip_service)
+            else: args = (_normalize_study, inputs, os.path.join(self.outdir, study), self.normalize, self.compression)
+            try: future = pools[pool_of[stage]].submit(*args)
+            except BrokenProcessPool:
+                restart(stage, pools[pool_of[stage]])
+                future = pools[pool_of[stage]].submit(*args)
+            futures[future] = (study, stage, inputs, pools[pool_of[stage]])
+
+        def top_up():
+            in_flight = Counter(stage for _, stage, _, _ in futures.values())
+            # later stages first so that studies leave the pipeline before new ones enter it
+            for stage in reversed(self.stages[1:]):
+                while len(queues[stage]) > 0 and in_flight[stage] < caps[stage]:
+                    submit(stage, *queues[stage].popleft())
+                    in_flight[stage] += 1
+            waiting = sum(len(queues[stage]) for stage in self.stages[1:])
+            while len(queues[first]) > 0 and in_flight[first] + waiting < caps[first]:
+                submit(first, *queues[first].popleft())
+                in_flight[first] += 1
+
+        try:
+            top_up()
+            while len(futures) > 0:
+                finished, _ = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in finished:
+                    study, stage, inputs, pool = futures.pop(future)
+                    try: res, sec = future.result()
+                    except BrokenProcessPool as e:
+                        restart(stage, pool)
+                        restarts[study] += 1
+                        if restarts[study] > self.max_restarts: self._fail(study, stage, e)
+                        else: queues[stage].appendleft((study, inputs))
+                        continue
+                    except Exception as e: # pylint:disable=W0718
+                        self._fail(study, stage, e)
+                        continue
+
+                    if stage != 'normalize':
+                        self.timings[stage] += sec
+                        queues[self.stages[self.stages.index(stage) + 1]].append((study, res))
+                        continue
+                    self.timings['normalize'] += sec[0]
+                    self.timings['save'] += sec[1]
+                    self.manifest[study] = {'status': 'done', 'outputs': res}
+                    self._save_manifest()
+                    done += 1
+                    if log: print(f'\r{done}/{len(todo)} studies, {sec_to_timestr(time.perf_counter() - start)}', end='')
+                top_up()
+        finally:
+            for pool in pools.values(): pool.shutdown(cancel_futures=True)
+        if log: print()
+        return self.summary()
+
+    def summary(self) -> dict[str, Any]:
+        """Number of done and failed studies, failed study names and time spent in each stage summed over studies."""
+        failed = [s for s, v in self.manifest.items() if v['status'] == 'failed']
+        return {
+            'done': sum(1 for v in self.manifest.values() if v['status'] == 'done'),
+            'failed': len(failed),
+            'failed_studies': failed,
+            'timings': {k: sec_to_timestr(v) for k, v in self.timings.items()},
+        }
+
+
+def studies_from_folders(root:str, contains:Sequence[str], folder_filter:Optional[Callable[[str], bool]] = None) -> dict[str, list[str]]:
+    """Maps each subfolder of `root` to paths of files containing each of `contains` substrings, e.g. `("t1n.", "t1c.", "t2f.", "t2w.")` for BraTS 2024."""
+    studies = {}
+    for folder in sorted(os.listdir(root)):
+        path = os.path.join(root, folder)
+        if not os.path.isdir(path) or (folder_filter is not None and not folder_filter(path)): continue
+        studies[folder] = [find_file_containing(path, c) for c in contains]
+    return studies
+
+RHUH_CONTAINS = ("t1.", "t1ce.", "flair.", "t2.")
+BRATS2024_CONTAINS = ("t1n.", "t1c.", "t2f.", "t2w.")
@@ -1,5 +1,8 @@
 from collections.abc import Sequence
+import numpy as np
+import torch
 import SimpleITK as sitk
+from ..morphology import bounding_boxes
 def crop_bg(input:str | sitk.Image) -> sitk.Image:
     if isinstance(input, str): input = sitk.ReadImage(input)
     tissue_filter = sitk.LabelShapeStatisticsImageFilter()
@@ -13,4 +16,57 @@ def crop_bg_imgs(inputs:str | sitk.Image | Sequence[str | sitk.Image]) -> list[s
     tissue_filter = sitk.LabelShapeStatisticsImageFilter()
     tissue_filter.Execute(sitk.OtsuThreshold(inputs[0], 0, 255))
     tissue = tissue_filter.GetBoundingBox(255)
-    return [sitk.RegionOfInterest(i, tissue[int(len(tissue) / 2) :],  tissue[0 : int(len(tissue) / 2)],) for i in inputs]
\ No newline at end of file
+    return [sitk.RegionOfInterest(i, tissue[int(len(tissue) / 2) :],  tissue[0 : int(len(tissue) / 2)],) for i in inputs]
+
+def otsu_thresholds(x:torch.Tensor | np.ndarray, bins = 128, downsample = 2, spatial_dims = 3) -> torch.Tensor:
+    """Otsu threshold of each channel of a `(*, spatial)` tensor computed from a histogram of every `downsample`-th voxel along each axis.
+
+    All channels are processed at once, returns a tensor of thresholds of shape `(*)`."""
+    x = torch.as_tensor(x)
+    lead = x.shape[:x.ndim - spatial_dims]
+    x = x[(..., *[slice(None, None, downsample)] * spatial_dims)].reshape(lead.numel(), -1).to(torch.float32)
+
+    mins = x.amin(1, keepdim=True)
+    maxs = x.amax(1, keepdim=True)
+    width = (maxs - mins).clamp_min(1e-12) / bins
+    idx = ((x - mins) / width).to(torch.int64).clamp_(0, bins - 1)
+    # histograms of all channels with one bincount by offsetting bin indices of each channel
+    idx += torch.arange(x.shape[0], device=x.device).unsqueeze(1) * bins
+    hist = torch.bincount(idx.ravel(), minlength=x.shape[0] * bins).reshape(x.shape[0], bins).to(torch.float64)
+
+    centers = mins + width * (torch.arange(bins, device=x.device) + 0.5)
+    p = hist / hist.sum(1, keepdim=True)
+    omega = p.cumsum(1)
+    mu = (p * centers).cumsum(1)
+    mu_t = mu[:, -1:]
+    # between-class variance for each threshold
+    sigma_b = (mu_t * omega - mu) ** 2 / (omega * (1 - omega))
+    sigma_b = torch.nan_to_num(sigma_b, nan=0, posinf=0, neginf=0)
+    thresholds = centers.gather(1, sigma_b.argmax(1, keepdim=True))
+    return thresholds.reshape(lead).to(torch.float32)
+
+def foreground_bbox(x:torch.Tensor | np.ndarray, bins = 128, downsample = 2, margin = 0, spatial_dims = 3) -> tuple[slice, ...]:
+    """Bounding box of voxels above Otsu threshold in any channel of a `(*, spatial)` tensor, so it is the union of bounding boxes of all modalities.
+
+    Returns a tuple of `slice` for spatial dimensions, use `x[..., *slices]` to crop without copying. Full volume if there is no foreground."""
+    x = torch.as_tensor(x)
+    thresholds = otsu_thresholds(x, bins, downsample, spatial_dims)
+    mask = x > thresholds.reshape(*thresholds.shape, *[1] * spatial_dims)
+    mask = mask.reshape(-1, *x.shape[x.ndim - spatial_dims:]).any(0)
+    box = bounding_boxes(mask, spatial_dims).tolist()
+    if all(stop == 0 for _, stop in box): return tuple(slice(None) for _ in box)
+    return tuple(slice(max(start - margin, 0), min(stop + margin, size)) for (start, stop), size in zip(box, mask.shape))
+
+def crop_bg_tensor(x:torch.Tensor, bins = 128, downsample = 2, margin = 0, spatial_dims = 3) -> torch.Tensor:
+    """Crops `(*, spatial)` tensor to `foreground_bbox`, result is a view of `x`."""
+    return x[(..., *foreground_bbox(x, bins, downsample, margin, spatial_dims))]
+
+def crop_bg_imgs_union(inputs:str | sitk.Image | Sequence[str | sitk.Image], bins = 128, downsample = 2, margin = 0) -> list[sitk.Image]:
+    """Same as `crop_bg_imgs`, but crops all images to the union of their foreground bounding boxes instead of the first image's,
+    images must have the same size. Origin of cropped images is updated so they stay in the same physical space."""
+    if not isinstance(inputs, Sequence) or isinstance(inputs, str): inputs = [inputs]
+    inputs = [sitk.ReadImage(i) if isinstance(i, str) else i for i in inputs]
+    stacked = torch.stack([torch.from_numpy(sitk.GetArrayViewFromImage(i).astype(np.float32)) for i in inputs])
+    slices = foreground_bbox(stacked, bins, downsample, margin)
+    # sitk indexing is in x, y, z order, reverse of array order
+    return [i[tuple(reversed(slices))] for i in inputs]
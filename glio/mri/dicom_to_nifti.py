@@ -1,9 +1,15 @@
-import os, subprocess
-import tempfile
+from collections.abc import Sequence
+from typing import Any, Optional
+import os, subprocess, logging
+import concurrent.futures
+import numpy as np
+import pydicom
 import SimpleITK as sitk
+from .images import tool_tempdir
+from ..loaders.dicom import dcmread_headers
 
-def dicom2nifti(inpath:str, outfolder:str, outfname:str, mkdirs=True, save_BIDS=False) -> str:
-    """Convert dicom folder to nii.gz and return path to the output file, uses dcm2niix (https://github.com/rordenlab/dcm2niix) which needs to be installed.
+def dicom2nifti(inpath:str, outfolder:str, outfname:str, mkdirs=True, save_BIDS=False, compress=True) -> str:
+    """Convert dicom folder to nii.gz (or .nii if `compress` is False) and return path to the output file, uses dcm2niix (https://github.com/rordenlab/dcm2niix) which needs to be installed.
 
     Args:
         inpath (str): Path to the dicom files of a single study and single modality.
@@ -17,6 +23,8 @@ def dicom2nifti(inpath:str, outfolder:str, outfname:str, mkdirs=True, save_BIDS=
         mkdirs (bool, optional): Whether to create `outfolder` if it doesn't exist, otherwise throws an error. Defaults to True.
 
         save_BIDS (bool, optional): Whether to save extra BIDS sidecar - extra info in JSON format that can't be saved into nifti. Defaults to False.
+
+        compress (bool, optional): Whether to gzip the output. Defaults to True.
     """
     # create output dir if not exists
     if outfolder != '':
@@ -30,7 +38,7 @@ def dicom2nifti(inpath:str, outfolder:str, outfname:str, mkdirs=True, save_BIDS=
     # run dcm2niix
     BIDS = 'y' if save_BIDS else 'n'
     subprocess.run(["dcm2niix", 
-                    "-z", "y", # compression
+                    "-z", "y" if compress else "n", # compression
                     "-m", "n", # disable stacking images from different studies
                     "-b", BIDS, # save additional JSON info that can't be saved into nifti (https://bids.neuroimaging.io/ BIDS sidecar format)
                     "-o", outfolder, # output folder
@@ -42,7 +50,7 @@ def dicom2nifti(inpath:str, outfolder:str, outfname:str, mkdirs=True, save_BIDS=
     files_after = os.listdir(outfolder)
     # find what new nifti files were created
     new_files = list(set(files_after) - set(files_before))
-    new_nii_files = [i for i in new_files if '.nii.gz' in i]
+    new_nii_files = [i for i in new_files if i.endswith(('.nii.gz', '.nii'))]
     if len(new_nii_files) > 1: print(f"More than one nifti file was created in {outfolder}, path to the first one will be returned. Something may be wrong.")
     if len(new_nii_files) == 0: print(f"No nifti files were created in {outfolder}")
 
@@ -50,7 +58,94 @@ def dicom2nifti(inpath:str, outfolder:str, outfname:str, mkdirs=True, save_BIDS=
     return os.path.join(outfolder, new_nii_files[0])
 
 
-def dicom2sitk(inpath:str) -> sitk.Image:
-    with tempfile.TemporaryDirectory() as tmpdir:
-        nifti_path = dicom2nifti(inpath=inpath, outfolder=tmpdir, outfname='temp', mkdirs=False, save_BIDS=False)
-        return sitk.ReadImage(nifti_path)
\ No newline at end of file
+def dicom2sitk(inpath:str, use_tmpfs=True) -> sitk.Image:
+    """Converts dicom folder to `sitk.Image` through an uncompressed nifti in a temporary directory, in memory-backed `/dev/shm` when available."""
+    with tool_tempdir(use_tmpfs) as tmpdir:
+        nifti_path = dicom2nifti(inpath=inpath, outfolder=tmpdir, outfname='temp', mkdirs=False, save_BIDS=False, compress=False)
+        return sitk.ReadImage(nifti_path)
+
+SERIES_TAGS = ('SeriesInstanceUID', 'SeriesNumber', 'SeriesDescription', 'ImagePositionPatient', 'ImageOrientationPatient', 'PixelSpacing', 'InstanceNumber')
+"""Tags `scan_dicom_series` reads, headers have the same schema as `loaders.dicom.dcmread_header` and `mri.metadata.scan_dicom`."""
+
+def _slice_normal(orientation:Sequence[float]) -> np.ndarray:
+    return np.cross(orientation[:3], orientation[3:])
+
+def group_dicom_series(headers:Sequence[dict[str, Any]]) -> dict[str, list[dict[str, Any]]]:
+    """Groups headers from `dcmread_header` by `SeriesInstanceUID`, skipping files without position and orientation (e.g. DICOMDIR),
+    and sorts slices of each series by `ImagePositionPatient` projected on the slice normal, which unlike `InstanceNumber` is always in space order.
+
+    Returns a dictionary that maps series UID to a list of slice headers."""
+    series: dict[str, list[dict[str, Any]]] = {}
+    for header in headers:
+        if header.get('SeriesInstanceUID') is None or header.get('ImagePositionPatient') is None or header.get('ImageOrientationPatient') is None: continue
+        series.setdefault(header['SeriesInstanceUID'], []).append(header)
+
+    for slices in series.values():
+        normal = _slice_normal(slices[0]['ImageOrientationPatient'])
+        slices.sort(key = lambda x: (float(np.dot(normal, x['ImagePositionPatient'])), x['InstanceNumber'] or 0))
+    return series
+
+def scan_dicom_series(root:str, n_workers:Optional[int] = None, chunksize = 64) -> dict[str, list[dict[str, Any]]]:
+    """Reads `SERIES_TAGS` of all files under `root` in a process pool without decoding pixel data, see `group_dicom_series`."""
+    paths = [os.path.join(dirpath, f) for dirpath, _, files in os.walk(root) for f in files]
+    return group_dicom_series(dcmread_headers(paths, SERIES_TAGS, n_workers, chunksize))
+
+def _decode_slice(path:str) -> np.ndarray:
+    ds = pydicom.dcmread(path)
+    arr = ds.pixel_array
+    slope, intercept = float(ds.get('RescaleSlope', 1)), float(ds.get('RescaleIntercept', 0))
+    if slope != 1 or intercept != 0: arr = arr * np.float32(slope) + np.float32(intercept)
+    return arr
+
+def series_to_sitk(headers:Sequence[dict[str, Any]], n_threads = 4) -> sitk.Image:
+    """Decodes sorted slices from `scan_dicom_series` in a thread pool and stacks them into `sitk.Image` with geometry from the headers."""
+    with concurrent.futures.ThreadPoolExecutor(n_threads) as executor:
+        slices = list(executor.map(_decode_slice, [h['path'] for h in headers]))
+    if len({s.shape for s in slices}) != 1: raise ValueError(f"Slices of series {headers[0]['SeriesInstanceUID']} have different shapes")
+    arr = np.stack(slices)
+    # like dcm2niix, uint16 is stored as int16 only if no value overflows it
+    if arr.dtype == np.uint16: arr = arr.astype(np.int16 if arr.max(initial=0) < 32768 else np.int32)
+    if arr.dtype == np.float64: arr = arr.astype(np.float32)
+
+    image = sitk.GetImageFromArray(arr)
+    orientation = headers[0]['ImageOrientationPatient']
+    normal = _slice_normal(orientation)
+    if len(headers) > 1: slice_spacing = abs(float(np.dot(normal, np.subtract(headers[-1]['ImagePositionPatient'], headers[0]['ImagePositionPatient'])))) / (len(headers) - 1)
+    else: slice_spacing = 1.
+    # PixelSpacing is row spacing, column spacing
+    spacing = headers[0]['PixelSpacing'] or (1., 1.)
+    image.SetSpacing((spacing[1], spacing[0], slice_spacing or 1.))
+    image.SetOrigin(headers[0]['ImagePositionPatient'])
+    # columns of direction matrix are directions of x, y and z axes
+    image.SetDirection(np.stack((orientation[:3], orientation[3:], normal), 1).ravel().tolist())
+    return image
+
+def _series_fname(headers:Sequence[dict[str, Any]]) -> str:
+    description = ''.join(c if c.isalnum() or c in '-_' else '_' for c in headers[0]['SeriesDescription'] or '')
+    return f"{headers[0]['SeriesNumber'] or 0}_{description}_{headers[0]['SeriesInstanceUID'][-8:]}"
+
+def _convert_series(headers:Sequence[dict[str, Any]], outfolder:str, compress:bool, n_threads:int) -> str:
+    """Runs in the series pool."""
+    path = os.path.join(outfolder, f"{_series_fname(headers)}{'.nii.gz' if compress else '.nii'}")
+    sitk.WriteImage(series_to_sitk(headers, n_threads), path, useCompression=compress)
+    return path
+
+def dicom_dump2nifti(root:str, outfolder:str, max_series = 4, threads_per_series = 4, n_scan_workers:Optional[int] = None, compress = True, min_slices = 2) -> dict[str, str]:
+    """Converts every series in a DICOM dump (any folder structure, any number of patients and series) to nifti without dcm2niix.
+
+    Headers are scanned in parallel with `scan_dicom_series`, then up to `max_series` series are converted at a time in a process pool,
+    each decoding its slices with `threads_per_series` threads, so memory use is bounded by `max_series` volumes.
+    Series with less than `min_slices` slices (localizers) are skipped, series that fail to convert are logged and skipped.
+
+    Returns a dictionary that maps series UID to path of the nifti file."""
+    os.makedirs(outfolder, exist_ok=True)
+    series = {k: v for k, v in scan_dicom_series(root, n_scan_workers).items() if len(v) >= min_slices}
+    outputs = {}
+    with concurrent.futures.ProcessPoolExecutor(max_series) as executor:
+        futures = {executor.submit(_convert_series, headers, outfolder, compress, threads_per_series): uid for uid, headers in series.items()}
+        for future in concurrent.futures.as_completed(futures):
+            uid = futures[future]
+            try: outputs[uid] = future.result()
+            except Exception as e: # pylint:disable=W0718
+                logging.error("failed to convert series %s: %r", uid, e)
+    return outputs
@@ -0,0 +1,33 @@
+"""Conversions between in-memory image types and temporary files for external tools."""
+from typing import Optional
+from contextlib import contextmanager
+import os, tempfile
+import numpy as np
+import torch
+import SimpleITK as sitk
+
+def _shm_dir() -> Optional[str]:
+    """`/dev/shm` if it is a writable tmpfs (Linux), otherwise None."""
+    if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK): return '/dev/shm'
+    return None
+
+@contextmanager
+def tool_tempdir(use_tmpfs = True):
+    """Temporary directory for external tools that strictly need files (HD-BET, dcm2niix).
+    It is created in memory-backed `/dev/shm` when available and `use_tmpfs` is True, so files never touch the disk."""
+    with tempfile.TemporaryDirectory(dir=_shm_dir() if use_tmpfs else None) as tmpdir:
+        yield tmpdir
+
+def as_image(x:sitk.Image | np.ndarray | torch.Tensor | str, reference:Optional[sitk.Image] = None) -> sitk.Image:
+    """Converts a path, array or tensor to `sitk.Image`, copying origin, spacing and direction from `reference` if given.
+    Arrays are in sitk order, i.e. `(D, H, W)` as returned by `sitk.GetArrayFromImage`."""
+    if isinstance(x, sitk.Image): return x
+    if isinstance(x, str): return sitk.ReadImage(x)
+    if isinstance(x, torch.Tensor): x = x.detach().cpu().numpy()
+    image = sitk.GetImageFromArray(x)
+    if reference is not None: image.CopyInformation(reference)
+    return image
+
+def image_to_tensor(image:sitk.Image, dtype = torch.float32) -> torch.Tensor:
+    """Converts `sitk.Image` to a tensor in sitk array order."""
+    return torch.from_numpy(sitk.GetArrayFromImage(image)).to(dtype)
@@ -0,0 +1,39 @@
+"""Header-only metadata tables of nifti and DICOM files for cohort QA and dataset filtering."""
+from collections.abc import Sequence
+from typing import Optional
+import concurrent.futures
+import os
+import polars as pl
+from ..loaders.nifti import niiread_header
+from ..loaders.dicom import dcmread_headers, DICOM_HEADER_TAGS
+
+def _find_files(root:str, extensions:Optional[Sequence[str]] = None) -> list[str]:
+    return [os.path.join(dirpath, f) for dirpath, _, files in os.walk(root) for f in sorted(files)
+            if extensions is None or f.lower().endswith(tuple(extensions))]
+
+def scan_nifti(root:str, n_workers:Optional[int] = None, chunksize = 16) -> pl.DataFrame:
+    """Reads headers of all `.nii` and `.nii.gz` files under `root` in a process pool.
+
+    Returns a table with `path`, `folder` (relative to `root`), `shape`, `ndim`, `spacing`, `orientation` (e.g. `RAS`), `dtype`, `qform_code` and `sform_code`,
+    plus `spacing_0`... columns for filtering, e.g. `df.filter(pl.col('spacing_2') <= 5)`."""
+    paths = _find_files(root, ('.nii', '.nii.gz'))
+    with concurrent.futures.ProcessPoolExecutor(n_workers) as executor:
+        rows = list(executor.map(niiread_header, paths, chunksize=chunksize))
+    for row in rows:
+        row['folder'] = os.path.relpath(os.path.dirname(row['path']), root)
+        for i, s in enumerate(row['spacing'][:3]): row[f'spacing_{i}'] = s
+    return pl.DataFrame(rows, infer_schema_length=None)
+
+def scan_dicom(root:str, tags:tuple[str, ...] = DICOM_HEADER_TAGS, n_workers:Optional[int] = None, chunksize = 64) -> pl.DataFrame:
+    """Reads `tags` of all DICOM files under `root` in a process pool with `stop_before_pixels`, non-DICOM files are skipped.
+    Returns a table with one row per file, use `dicom_series_table` to get one row per series."""
+    return pl.DataFrame(dcmread_headers(_find_files(root), tags, n_workers, chunksize), infer_schema_length=None)
+
+def dicom_series_table(files:pl.DataFrame) -> pl.DataFrame:
+    """Groups table from `scan_dicom` by `SeriesInstanceUID`, keeping first value of each tag and adding `n_slices`,
+    e.g. `dicom_series_table(df).filter(pl.col('SliceThickness') <= 5)`."""
+    return files.group_by('SeriesInstanceUID', maintain_order=True).agg(
+        pl.exclude('SeriesInstanceUID', 'path', 'ImagePositionPatient', 'InstanceNumber').first(),
+        pl.len().alias('n_slices'),
+        pl.col('path').first().str.extract(r'^(.*)[\\/][^\\/]*$').alias('folder'),
+    )
@@ -1,8 +1,28 @@
 from collections.abc import Sequence
+from typing import Optional
+import torch
 import SimpleITK as sitk
+from ..transforms.intensity import robust_znorm
 def znormalize(input: str | sitk.Image) -> sitk.Image:
     if isinstance(input, str): input = sitk.ReadImage(input)
     return sitk.Normalize(input)
 
 def znormalize_imgs(inputs: str | sitk.Image | Sequence[str | sitk.Image]) -> list[sitk.Image]:
-    return [znormalize(i) for i in inputs]
\ No newline at end of file
+    return [znormalize(i) for i in inputs]
+
+def robust_znormalize_imgs(inputs: str | sitk.Image | Sequence[str | sitk.Image], mask: Optional[str | sitk.Image] = 'nonzero',
+                           clip: Optional[tuple[float, float]] = (0.5, 99.5), fill_outside: Optional[float] = 0) -> list[sitk.Image]:
+    """Z-normalizes all images of a study in one vectorized call with statistics inside `mask` (a brain mask image, or `nonzero` for skullstripped images)
+    after clipping to `clip` percentiles, unlike `sitk.Normalize` which also counts background. Images must have the same size. Outputs are float32."""
+    if isinstance(inputs, (str, sitk.Image)): inputs = [inputs]
+    inputs = [sitk.ReadImage(i) if isinstance(i, str) else i for i in inputs]
+    if isinstance(mask, str) and mask != 'nonzero': mask = sitk.ReadImage(mask)
+    x = torch.stack([torch.from_numpy(sitk.GetArrayFromImage(i)).to(torch.float32) for i in inputs])
+    m = torch.from_numpy(sitk.GetArrayFromImage(mask)) if isinstance(mask, sitk.Image) else mask
+    norm = robust_znorm(x, m, clip, fill_outside)
+    outputs = []
+    for arr, image in zip(norm.numpy(), inputs):
+        out = sitk.GetImageFromArray(arr)
+        out.CopyInformation(image)
+        outputs.append(out)
+    return outputs
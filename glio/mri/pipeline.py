@@ -1,81 +1,155 @@
+from typing import Optional
+from functools import partial
 import logging, os
 import torch
 import numpy as np
 import SimpleITK as sitk
 from .dicom_to_nifti import dicom2sitk
-from .registration import register_imgs_to_SRI24, register_with
+from .registration import register_imgs_to_SRI24, register_imgs_to_SRI24_parallel, register_imgs_shared_to_SRI24, register_with, get_pmap, pmap_to_list, SRI24, MIN_QUALITY
 from .skullstrip import skullstrip_imgs
 from .normalize import znormalize_imgs
 from .crop_bg import crop_bg_imgs
+from .cache import StageCache, tool_version
+from .images import as_image, image_to_tensor
+from ..loaders.nifti import NiftiWriter
 
 
 def _toImage(x) -> sitk.Image:
-    if isinstance(x, sitk.Image): return x
+    if isinstance(x, (sitk.Image, np.ndarray, torch.Tensor)): return as_image(x)
     elif os.path.isfile(x): return sitk.ReadImage(x)
     elif os.path.isdir(x): return dicom2sitk(x)
     else: raise ValueError(f"x either dir file or sitk image but its {type(x) = }")
 
-def pipeline(t1:str|sitk.Image, t1ce:str|sitk.Image, flair:str|sitk.Image, t2w:str|sitk.Image,
-             register=True, skullstrip=True, erode=1, cropbg=True) -> tuple[list[sitk.Image],list[sitk.Image]]:
+def _register(t1, t1ce, flair, t2w, register_workers = 1, preset = 'standard', n_threads:Optional[int] = None) -> list[sitk.Image]:
+    if register_workers > 1:
+        images, times = register_imgs_to_SRI24_parallel(t1, (t1ce, flair, t2w), n_workers=register_workers, pmap=preset)
+        logging.info("registration took %s seconds for t1, t1ce, flair, t2w", [round(i, 2) for i in times])
+        return images
+    return register_imgs_to_SRI24(t1, (t1ce, flair, t2w), pmap=preset, n_threads=n_threads)
+
+def _register_shared(t1, t1ce, flair, t2w, seg = None, preset = 'standard', n_threads:Optional[int] = None) -> list[sitk.Image]:
+    """Registers t1ce to SRI24 once and applies the transform to other modalities and `seg`. Returns `t1, t1ce, flair, t2w` and `seg` if given."""
+    (t1ce, t1, flair, t2w), seg = register_imgs_shared_to_SRI24(t1ce, (t1, flair, t2w), seg, pmap=preset, n_threads=n_threads)
+    return [t1, t1ce, flair, t2w, *seg]
+
+def _register_params(preset:str):
+    """Registration parameters for the stage cache key."""
+    if preset == 'auto': return (SRI24, preset, [pmap_to_list(get_pmap(p)) for p in ('fast', 'standard', 'high')], MIN_QUALITY)
+    return (SRI24, pmap_to_list(get_pmap(preset)))
+
+def _skullstrip(t1ce, t1, flair, t2w, erode = 1, service = None) -> list[sitk.Image]:
+    return list(skullstrip_imgs(t1ce, (t1, flair, t2w), erode=erode, service=service))
+
+def pipeline(t1:str|sitk.Image|np.ndarray|torch.Tensor, t1ce:str|sitk.Image|np.ndarray|torch.Tensor, flair:str|sitk.Image|np.ndarray|torch.Tensor, t2w:str|sitk.Image|np.ndarray|torch.Tensor,
+             register=True, skullstrip=True, erode=1, cropbg=True, register_workers = 1, cache_dir:Optional[str] = None,
+             shared_registration = False, seg:Optional[str|sitk.Image|np.ndarray|torch.Tensor] = None, registration_preset = 'standard') -> tuple[list[sitk.Image],list[sitk.Image]]:
+    """`register_workers` - number of processes to register modalities concurrently with, 1 registers them one after another.
+
+    `registration_preset` - `fast`, `standard` or `high` from `registration.PRESETS`, or `auto` to start with `fast`
+    and escalate to slower presets only for images whose registration quality is poor, see `registration.register_escalate`.
+
+    `shared_registration` - use when all modalities are already co-registered in native space, t1ce is registered to SRI24 once
+    and the same transform is applied to other modalities, so there is one elastix optimization per study instead of four.
+    `register_workers` is ignored.
+
+    `seg` - segmentation in native space of t1ce, requires `shared_registration` if `register` is True.
+    It is registered with nearest neighbor interpolation, not skullstripped or normalized, and appended to both returned lists.
+
+    `cache_dir` - if specified, outputs of registration and skullstripping are cached there under a hash of input images, parameters and tool version,
+    so rerunning the pipeline with different normalization or cropping skips them. Normalization and cropping are cheap and always run."""
     t1_orig = _toImage(t1)
     t1ce_orig = _toImage(t1ce)
     flair_orig = _toImage(flair)
     t2w_orig = _toImage(t2w)
+    seg_orig = [_toImage(seg)] if seg is not None else []
+    if register and len(seg_orig) > 0 and not shared_registration:
+        raise ValueError("`seg` can only be registered with `shared_registration=True`")
+
+    cache = StageCache(cache_dir) if cache_dir is not None else None
 
     logging.info("registering to SRI24")
-    if register: t1_sri, t1ce_sri, flair_sri, t2w_sri = register_imgs_to_SRI24(t1_orig, (t1ce_orig, flair_orig, t2w_orig))
+    seg_sri = seg_orig
+    if register and shared_registration:
+        inputs = (t1_orig, t1ce_orig, flair_orig, t2w_orig, *seg_orig)
+        if cache is not None:
+            res = cache('register_shared', partial(_register_shared, preset=registration_preset), inputs, len(inputs),
+                        params=_register_params(registration_preset), version=sitk.Version_VersionString())
+        else: res = _register_shared(*inputs, preset=registration_preset)
+        t1_sri, t1ce_sri, flair_sri, t2w_sri = res[:4]
+        seg_sri = res[4:]
+    elif register:
+        if cache is not None:
+            t1_sri, t1ce_sri, flair_sri, t2w_sri = cache('register', partial(_register, register_workers=register_workers, preset=registration_preset),
+                (t1_orig, t1ce_orig, flair_orig, t2w_orig), 4, params=_register_params(registration_preset), version=sitk.Version_VersionString())
+        else: t1_sri, t1ce_sri, flair_sri, t2w_sri = _register(t1_orig, t1ce_orig, flair_orig, t2w_orig, register_workers, registration_preset)
     else: t1_sri, t1ce_sri, flair_sri, t2w_sri = t1_orig, t1ce_orig, flair_orig, t2w_orig
 
     logging.info("skullstripping")
-    if skullstrip: t1ce_skullstrip, t1_skullstrip, flair_skullstrip, t2w_skullstrip = skullstrip_imgs(t1ce_sri, (t1_sri, flair_sri, t2w_sri), erode=erode)
+    if skullstrip:
+        if cache is not None:
+            t1ce_skullstrip, t1_skullstrip, flair_skullstrip, t2w_skullstrip = cache('skullstrip', partial(_skullstrip, erode=erode),
+                (t1ce_sri, t1_sri, flair_sri, t2w_sri), 4, params=erode, version=tool_version('HD_BET'))
+        else: t1ce_skullstrip, t1_skullstrip, flair_skullstrip, t2w_skullstrip = _skullstrip(t1ce_sri, t1_sri, flair_sri, t2w_sri, erode)
     else: t1ce_skullstrip, t1_skullstrip, flair_skullstrip, t2w_skullstrip = t1ce_sri, t1_sri, flair_sri, t2w_sri
 
     logging.info("normalization")
     norm = znormalize_imgs((t1_skullstrip,t1ce_skullstrip,flair_skullstrip, t2w_skullstrip))
 
-    if cropbg: return [t1_sri, t1ce_sri, flair_sri, t2w_sri], crop_bg_imgs(norm)
-    else: return [t1_sri, t1ce_sri, flair_sri, t2w_sri, t2w_skullstrip], norm
+    if cropbg: return [t1_sri, t1ce_sri, flair_sri, t2w_sri, *seg_sri], crop_bg_imgs(norm + seg_sri)
+    else: return [t1_sri, t1ce_sri, flair_sri, t2w_sri, t2w_skullstrip, *seg_sri], norm + seg_sri
 
 
 class Pipeline:
-    def __init__(self, t1:str, t1ce:str, flair:str, t2w:str, register=True, skullstrip=True, erode=1, cropbg=True):
+    def __init__(self, t1:str|sitk.Image|np.ndarray|torch.Tensor, t1ce:str|sitk.Image|np.ndarray|torch.Tensor, flair:str|sitk.Image|np.ndarray|torch.Tensor, t2w:str|sitk.Image|np.ndarray|torch.Tensor, register=True, skullstrip=True, erode=1, cropbg=True, register_workers = 1, cache_dir:Optional[str] = None,
+                 shared_registration = False, seg:Optional[str|sitk.Image|np.ndarray|torch.Tensor] = None, registration_preset = 'standard'):
         self.register = register
+        self.registration_preset = registration_preset
+        self.shared_registration = shared_registration
+        self.cache_dir = cache_dir
+        self.register_workers = register_workers
         self.skullstrip = skullstrip
         self.erode = erode
         self.cropbg = cropbg
 
         self.t1_native, self.t1ce_native, self.flair_native, self.t2w_native = [_toImage(i) for i in (t1,t1ce,flair,t2w)]
+        self.seg_native = _toImage(seg) if seg is not None else None
 
     def preprocess(self) -> torch.Tensor:
-        (self.t1_sri, self.t1ce_sri, self.flair_sri, self.t2w_sri), \
-        (self.t1_final, self.t1ce_final, self.flair_final, self.t2w_final) = \
-            pipeline(self.t1_native, self.t1ce_native, self.flair_native, self.t2w_native, self.register, self.skullstrip, self.erode, self.cropbg)
+        sri, final = pipeline(self.t1_native, self.t1ce_native, self.flair_native, self.t2w_native, self.register, self.skullstrip, self.erode, self.cropbg,
+                              self.register_workers, self.cache_dir, self.shared_registration, self.seg_native, self.registration_preset)
+        self.t1_sri, self.t1ce_sri, self.flair_sri, self.t2w_sri = sri[:4]
+        self.t1_final, self.t1ce_final, self.flair_final, self.t2w_final = final[:4]
+        if self.seg_native is not None: self.seg_sri, self.seg_final = sri[-1], final[-1]
 
-        return torch.from_numpy(np.stack(
-            [sitk.GetArrayFromImage(i) for i in (self.t1_final, self.t1ce_final, self.flair_final, self.t2w_final)]
-            ).astype(np.float32))
+        return torch.stack([image_to_tensor(i) for i in (self.t1_final, self.t1ce_final, self.flair_final, self.t2w_final)])
 
-    def save(self, path, mkdirs=True):
+    def save(self, path, mkdirs=True, writer:Optional[NiftiWriter] = None):
+        """If `writer` is given, images are compressed and written in its background threads, and this returns immediately."""
         if mkdirs: os.makedirs(path, exist_ok=True)
-
-        sitk.WriteImage(self.t1_native, os.path.join(path, 't1_native.nii.gz'))
-        sitk.WriteImage(self.t1ce_native, os.path.join(path, 't1ce_native.nii.gz'))
-        sitk.WriteImage(self.flair_native, os.path.join(path, 'flair_native.nii.gz'))
-        sitk.WriteImage(self.t2w_native, os.path.join(path, 't2w_native.nii.gz'))
-
-        sitk.WriteImage(self.t1_sri, os.path.join(path, 't1_sri.nii.gz'))
-        sitk.WriteImage(self.t1ce_sri, os.path.join(path, 't1ce_sri.nii.gz'))
-        sitk.WriteImage(self.flair_sri, os.path.join(path, 'flair_sri.nii.gz'))
-        sitk.WriteImage(self.t2w_sri, os.path.join(path, 't2w_sri.nii.gz'))
-
-        sitk.WriteImage(self.t1_final, os.path.join(path, 't1_final.nii.gz'))
-        sitk.WriteImage(self.t1ce_final, os.path.join(path, 't1ce_final.nii.gz'))
-        sitk.WriteImage(self.flair_final, os.path.join(path, 'flair_final.nii.gz'))
-        sitk.WriteImage(self.t2w_final, os.path.join(path, 't2w_final.nii.gz'))
-
+        write = writer.write if writer is not None else sitk.WriteImage
+
+        write(self.t1_native, os.path.join(path, 't1_native.nii.gz'))
+        write(self.t1ce_native, os.path.join(path, 't1ce_native.nii.gz'))
+        write(self.flair_native, os.path.join(path, 'flair_native.nii.gz'))
+        write(self.t2w_native, os.path.join(path, 't2w_native.nii.gz'))
+
+        write(self.t1_sri, os.path.join(path, 't1_sri.nii.gz'))
+        write(self.t1ce_sri, os.path.join(path, 't1ce_sri.nii.gz'))
+        write(self.flair_sri, os.path.join(path, 'flair_sri.nii.gz'))
+        write(self.t2w_sri, os.path.join(path, 't2w_sri.nii.gz'))
+
+        write(self.t1_final, os.path.join(path, 't1_final.nii.gz'))
+        write(self.t1ce_final, os.path.join(path, 't1ce_final.nii.gz'))
+        write(self.flair_final, os.path.join(path, 'flair_final.nii.gz'))
+        write(self.t2w_final, os.path.join(path, 't2w_final.nii.gz'))
+
+        if hasattr(self, 'seg_final'):
+            write(self.seg_native, os.path.join(path, 'seg_native.nii.gz'))
+            write(self.seg_sri, os.path.join(path, 'seg_sri.nii.gz'))
+            write(self.seg_final, os.path.join(path, 'seg_final.nii.gz'))
         if hasattr(self, 'seg'):
-            sitk.WriteImage(self.seg, os.path.join(path, 'seg.nii.gz'))
-            sitk.WriteImage(self.seg_native, os.path.join(path, 'seg_native.nii.gz'))
+            write(self.seg, os.path.join(path, 'seg.nii.gz'))
+            write(self.seg_native, os.path.join(path, 'seg_native.nii.gz'))
 
     def unregister_seg(self, seg:str|sitk.Image|np.ndarray|torch.Tensor, to = 't1') -> sitk.Image:
         if isinstance(seg, torch.Tensor): seg = seg.detach().cpu().numpy()
@@ -1,14 +1,22 @@
 from typing import Optional
+from collections.abc import Sequence
+from functools import partial
 import SimpleITK as sitk
 import numpy as np
 from .crop_bg import crop_bg_imgs
 from .normalize import znormalize_imgs
 from ..python_tools import find_file_containing
 
-def preprocess_images_seg(t1:str, t1ce:str, flair:str, t2w:str, seg:str, cropbg=True):
+def crop_znorm_study(images:Sequence[str | sitk.Image], cropbg=True) -> list[sitk.Image]:
+    """Takes `t1, t1ce, flair, t2w, seg`, crops black background to the bounding box of t1ce and applies znormalization to each modality.
+    Returns them in the same order. Can be passed as `normalize` to `CohortRunner`."""
+    t1, t1ce, flair, t2w, seg = images
     if cropbg: t1ce_crop, t1_crop, flair_crop, t2w_crop, seg_crop = crop_bg_imgs([t1ce, t1, flair, t2w, seg])
-    else: t1ce_crop, t1_crop, flair_crop, t2w_crop, seg_crop = t1ce, t1, flair, t2w, sitk.ReadImage(seg)
-    t1_norm, t1ce_norm, flair_norm, t2w_norm = znormalize_imgs([t1_crop, t1ce_crop, flair_crop, t2w_crop])
+    else: t1ce_crop, t1_crop, flair_crop, t2w_crop, seg_crop = t1ce, t1, flair, t2w, sitk.ReadImage(seg) if isinstance(seg, str) else seg
+    return [*znormalize_imgs([t1_crop, t1ce_crop, flair_crop, t2w_crop]), seg_crop]
+
+def preprocess_images_seg(t1:str, t1ce:str, flair:str, t2w:str, seg:str, cropbg=True):
+    t1_norm, t1ce_norm, flair_norm, t2w_norm, seg_crop = crop_znorm_study([t1, t1ce, flair, t2w, seg], cropbg=cropbg)
     return (np.stack([sitk.GetArrayFromImage(t1_norm),
                      sitk.GetArrayFromImage(t1ce_norm),
                      sitk.GetArrayFromImage(flair_norm),
@@ -89,4 +97,32 @@ def preprocess_brats2024gli_tensor(path:str, cropbg=True):
     Returns: torch.Tensor[t1, t1ce, flair, t2w], torch.Tensor[seg]."""
     import torch
     images, seg = preprocess_brats2024goat(path, cropbg=cropbg)
-    return torch.from_numpy(images).to(torch.float32), torch.from_numpy(seg.astype(np.int32))
\ No newline at end of file
+    return torch.from_numpy(images).to(torch.float32), torch.from_numpy(seg.astype(np.int32))
+
+
+RHUH_SEG_CONTAINS = ("t1.", "t1ce.", "flair.", "t2.", "segmentations.")
+BRATS2024_SEG_CONTAINS = ("t1n.", "t1c.", "t2f.", "t2w.", "seg.")
+
+def preprocess_cohort(root:str, outdir:str, contains:Sequence[str], n_workers=4, cropbg=True, **kwargs):
+    """Same as `preprocess_images_seg` for each study folder in `root`, with studies processed in parallel by `CohortRunner`.
+    Studies are saved to `outdir/{study}/{t1, t1ce, flair, t2w, seg}.nii.gz`, an interrupted run resumes where it stopped.
+
+    `contains` are substrings of `t1, t1ce, flair, t2w, seg` file names, `kwargs` are passed to `CohortRunner`.
+
+    Returns: `CohortRunner.summary()`."""
+    from .cohort import CohortRunner, studies_from_folders
+    runner = CohortRunner(outdir, register_workers=n_workers, register=False, skullstrip=False,
+                          normalize=partial(crop_znorm_study, cropbg=cropbg), **kwargs)
+    return runner.run(studies_from_folders(root, contains))
+
+def preprocess_rhuh_cohort(root:str, outdir:str, n_workers=4, **kwargs):
+    """`preprocess_rhuh` for every study in `root` in parallel, see `preprocess_cohort`."""
+    return preprocess_cohort(root, outdir, RHUH_SEG_CONTAINS, n_workers=n_workers, **kwargs)
+
+def preprocess_brats2024goat_cohort(root:str, outdir:str, n_workers=4, cropbg=True, **kwargs):
+    """`preprocess_brats2024goat` for every study in `root` in parallel, see `preprocess_cohort`."""
+    return preprocess_cohort(root, outdir, BRATS2024_SEG_CONTAINS, n_workers=n_workers, cropbg=cropbg, **kwargs)
+
+def preprocess_brats2024gli_cohort(root:str, outdir:str, n_workers=4, cropbg=True, **kwargs):
+    """`preprocess_brats2024gli` for every study in `root` in parallel, see `preprocess_cohort`."""
+    return preprocess_cohort(root, outdir, BRATS2024_SEG_CONTAINS, n_workers=n_workers, cropbg=cropbg, **kwargs)
@@ -1,4 +1,8 @@
 from collections.abc import Sequence
+from typing import Optional
+import os, time, logging
+import concurrent.futures
+import numpy as np
 import SimpleITK as sitk
 
 MNI152 = r"F:\Stuff\Programming\AI\glio_diff\glio\mri\mni_icbm152_t1_tal_nlin_asym_09a.nii"
@@ -31,52 +35,136 @@ def default_pmap():
     pmap.append(sitk.GetDefaultParameterMap("affine"))
     return pmap
 
-def register_to(input:str | sitk.Image, reference: str | sitk.Image, pmap = default_pmap()) -> sitk.Image:
-    """Register `input` to `reference`, both can be either a `sitk.Image` or a path to a nifti file that will be loaded. Returns `input` registered to `reference`.
+def fast_pmap():
+    """Rigid only, with aggressive downsampling and few iterations, for images that are roughly aligned already."""
+    p = sitk.GetDefaultParameterMap("rigid")
+    p["NumberOfResolutions"] = ["3"]
+    p["FixedImagePyramidSchedule"] = ["8", "8", "8", "4", "4", "4", "2", "2", "2"]
+    p["MovingImagePyramidSchedule"] = ["8", "8", "8", "4", "4", "4", "2", "2", "2"]
+    p["MaximumNumberOfIterations"] = ["200"]
+    p["NumberOfSpatialSamples"] = ["2048"]
+    pmap = sitk.VectorOfParameterMap()
+    pmap.append(p)
+    return pmap
 
-    Registering means input image is transformed using affine transforms or some deformations
-    (whatever elastix is using) to match the reference, it will have the same size, orientation, etc, and the should be perfectly alligned."""
-    # load inputs
+def high_quality_pmap():
+    """Same stages as `default_pmap` with an extra resolution level, more iterations and more samples."""
+    pmap = sitk.VectorOfParameterMap()
+    for name in ("translation", "rigid", "affine"):
+        p = sitk.GetDefaultParameterMap(name)
+        p["NumberOfResolutions"] = ["5"]
+        p["MaximumNumberOfIterations"] = ["1000"]
+        p["NumberOfSpatialSamples"] = ["8192"]
+        pmap.append(p)
+    return pmap
+
+PRESETS = {"fast": fast_pmap, "standard": default_pmap, "high": high_quality_pmap}
+"""Registration presets for `pmap` argument of registration functions. `auto` runs `register_escalate` with default settings."""
+
+def get_pmap(pmap):
+    """Returns parameter map for a preset name, other values are returned as is."""
+    if isinstance(pmap, str): return PRESETS[pmap]()
+    return pmap
+
+def _nmi(a, b, bins:int) -> float:
+    """Normalized mutual information `(H(a) + H(b)) / H(a, b)`, 1 for independent, 2 for identical."""
+    joint, _, _ = np.histogram2d(a, b, bins)
+    joint = joint / joint.sum()
+    def entropy(p): p = p[p > 0]; return -(p * np.log(p)).sum()
+    return float((entropy(joint.sum(0)) + entropy(joint.sum(1))) / entropy(joint))
+
+def _ncc(a, b) -> float:
+    a = a - a.mean()
+    b = b - b.mean()
+    return float((a * b).sum() / (np.sqrt((a ** 2).sum() * (b ** 2).sum()) + 1e-12))
+
+def registration_quality(registered:sitk.Image, reference:str | sitk.Image, mask:Optional[sitk.Image] = None, metric = "nmi", bins = 32) -> float:
+    """Similarity of `registered` and `reference` inside `mask`, nonzero voxels of `reference` by default (brain for skullstripped atlases like SRI24).
+
+    `nmi` - normalized mutual information, works across modalities, from 1 (unrelated) to 2 (identical).
+    `ncc` - normalized cross correlation, only meaningful for the same modality, from -1 to 1."""
+    if isinstance(reference, str): reference = sitk.ReadImage(reference)
+    reg = sitk.GetArrayViewFromImage(registered).astype(np.float32)
+    ref = sitk.GetArrayViewFromImage(reference).astype(np.float32)
+    m = (sitk.GetArrayViewFromImage(mask) if mask is not None else ref) != 0
+    if metric == "nmi": return _nmi(reg[m], ref[m], bins)
+    if metric == "ncc": return _ncc(reg[m], ref[m])
+    raise ValueError(f"Unknown metric {metric}")
+
+MIN_QUALITY = {"nmi": 1.1, "ncc": 0.5}
+"""Default `min_quality` for each metric in `register_escalate`, rough values below which registration is usually visibly off."""
+
+def register_escalate(input:str | sitk.Image, reference: str | sitk.Image, presets:Sequence[str] = ("fast", "standard", "high"),
+                      min_quality:Optional[float] = None, metric = "nmi", mask:Optional[sitk.Image] = None, n_threads:Optional[int] = None):
+    """Register with each of `presets` in order until `registration_quality` reaches `min_quality`.
+    If no preset reaches it, a warning is logged and the best registration is returned.
+
+    Returns registered `input`, transform parameter map, name of the preset that was used and its quality."""
     if isinstance(input, str): input = sitk.ReadImage(input)
     if isinstance(reference, str): reference = sitk.ReadImage(reference)
+    if min_quality is None: min_quality = MIN_QUALITY[metric]
 
-    # create elastix filter
-    elastix = sitk.ElastixImageFilter()
-    elastix.SetFixedImage(reference)
-    elastix.SetMovingImage(input)
+    best = None
+    for preset in presets:
+        res, tmap = register_get_transform(input, reference, preset, n_threads)
+        quality = registration_quality(res, reference, mask, metric)
+        logging.info("%s registration %s = %.3f", preset, metric, quality)
+        if best is None or quality > best[3]: best = (res, tmap, preset, quality)
+        if quality >= min_quality: return best
+    assert best is not None
+    logging.warning("registration %s = %.3f with %s preset is below %s", metric, best[3], best[2], min_quality)
+    return best
 
-    # set it to elastix filter and execute
-    if pmap is not None: elastix.SetParameterMap(pmap)
-    elastix.Execute()
-    return elastix.GetResultImage()
+def register_to(input:str | sitk.Image, reference: str | sitk.Image, pmap = default_pmap(), n_threads:Optional[int] = None) -> sitk.Image:
+    """Register `input` to `reference`, both can be either a `sitk.Image` or a path to a nifti file that will be loaded. Returns `input` registered to `reference`.
 
+    Registering means input image is transformed using affine transforms or some deformations
+    (whatever elastix is using) to match the reference, it will have the same size, orientation, etc, and the should be perfectly alligned.
 
-def register_with(input:str | sitk.Image, other: str | sitk.Image, reference: str | sitk.Image, pmap = default_pmap(), label=True) -> tuple[sitk.Image,sitk.Image]:
-    """Register `input` to reference, then use that transformation to also register `other`, which is usually segmentation."""
-    # load inputs
+    `pmap` can also be a name from `PRESETS` or `auto`."""
+    return register_get_transform(input, reference, pmap, n_threads)[0]
+
+
+def register_get_transform(input:str | sitk.Image, reference: str | sitk.Image, pmap = default_pmap(), n_threads:Optional[int] = None):
+    """Register `input` to `reference` and return registered `input` and the transform parameter map,
+    which `apply_transform` can apply to any image in the same native space as `input`.
+
+    `pmap` can also be a name from `PRESETS` or `auto`."""
     if isinstance(input, str): input = sitk.ReadImage(input)
-    if isinstance(other, str): other = sitk.ReadImage(other)
     if isinstance(reference, str): reference = sitk.ReadImage(reference)
+    if isinstance(pmap, str) and pmap == "auto": return register_escalate(input, reference, n_threads=n_threads)[:2]
 
-    # create elastix filter
     elastix = sitk.ElastixImageFilter()
     elastix.SetFixedImage(reference)
     elastix.SetMovingImage(input)
-
-    # set it to elastix filter and execute
-    if pmap is not None: elastix.SetParameterMap(pmap)
+    if pmap is not None: elastix.SetParameterMap(get_pmap(pmap))
+    if n_threads is not None: elastix.SetNumberOfThreads(n_threads)
     input_reg = elastix.Execute()
+    return input_reg, elastix.GetTransformParameterMap()
+
+def apply_transform(input:str | sitk.Image, tmap, label = False, n_threads:Optional[int] = None) -> sitk.Image:
+    """Apply transform parameter map from `register_get_transform` to `input`, this is a single resampling pass without any optimization.
+
+    If `label` is True, nearest neighbor interpolation is used and the result is cast back to pixel type of `input`, so labels stay intact.
+    `tmap` isn't modified."""
+    if isinstance(input, str): input = sitk.ReadImage(input)
+    # copy so that setting the interpolator doesn't change the map the caller reuses for other images
+    tmap = pmap_from_list(pmap_to_list(tmap))
+    if label:
+        for p in tmap: p["ResampleInterpolator"] = ["FinalNearestNeighborInterpolator"]
 
     transform = sitk.TransformixImageFilter()
-    tmap = elastix.GetTransformParameterMap()
-    if label: 
-        tmap[0]["ResampleInterpolator"] = ["FinalNearestNeighborInterpolator"]
-        tmap[1]["ResampleInterpolator"] = ["FinalNearestNeighborInterpolator"]
-        tmap[2]["ResampleInterpolator"] = ["FinalNearestNeighborInterpolator"]
     transform.SetTransformParameterMap(tmap)
-    transform.SetMovingImage(other)
- 
-    return input_reg, transform.Execute()
+    transform.SetMovingImage(input)
+    if n_threads is not None: transform.SetNumberOfThreads(n_threads)
+    res = transform.Execute()
+    if label: res = sitk.Cast(res, input.GetPixelID())
+    return res
+
+def register_with(input:str | sitk.Image, other: str | sitk.Image, reference: str | sitk.Image, pmap = default_pmap(), label=True) -> tuple[sitk.Image,sitk.Image]:
+    """Register `input` to reference, then use that transformation to also register `other`, which is usually segmentation."""
+    input_reg, tmap = register_get_transform(input, reference, pmap)
+    return input_reg, apply_transform(other, tmap, label=label)
 
 
 
@@ -88,22 +176,94 @@ def register_t1_to_SRI24(input:str|sitk.Image, reference=SRI24) -> sitk.Image:
     """Register `input` to SRI24. `input` must be path/sitk.Image of a T1 scan. Returns `input` registered to SRI24."""
     return register_to(input, reference)
 
-def register_imgs_to(template_input: str | sitk.Image, other_inputs: str|sitk.Image | Sequence[str|sitk.Image], reference: str | sitk.Image) -> list[sitk.Image]:
+def register_imgs_to(template_input: str | sitk.Image, other_inputs: str|sitk.Image | Sequence[str|sitk.Image], reference: str | sitk.Image, pmap = default_pmap(),
+                     n_threads:Optional[int] = None) -> list[sitk.Image]:
     """Register `template_input` to `reference`, then register `other_inputs` to registered `template_input`.
 
     Returns registered `[template_input, *other_inputs]`."""
     if not isinstance(other_inputs, Sequence): other_inputs = [other_inputs]
 
     # Register `template_input` to `reference`
-    registered_template_input = register_to(template_input, reference)
+    registered_template_input = register_to(template_input, reference, pmap, n_threads)
 
     # register `other_inputs` to registered `template_input`.
-    registered_other_inputs = [register_to(i, registered_template_input) for i in other_inputs]
+    registered_other_inputs = [register_to(i, registered_template_input, pmap, n_threads) for i in other_inputs]
 
     return [registered_template_input, *registered_other_inputs]
 
 def register_imgs_to_MNI152(t1:str|sitk.Image, other: str|sitk.Image | Sequence[str|sitk.Image], reference=MNI152) -> list[sitk.Image]:
     return register_imgs_to(t1, other, reference)
 
-def register_imgs_to_SRI24(t1:str|sitk.Image, other: str|sitk.Image | Sequence[str|sitk.Image], reference=SRI24) -> list[sitk.Image]:
-    return register_imgs_to(t1, other, reference)
\ No newline at end of file
+def register_imgs_to_SRI24(t1:str|sitk.Image, other: str|sitk.Image | Sequence[str|sitk.Image], reference=SRI24, pmap = default_pmap(), n_threads:Optional[int] = None) -> list[sitk.Image]:
+    return register_imgs_to(t1, other, reference, pmap, n_threads)
+
+
+def pmap_to_list(pmap) -> Optional[str | list[dict[str, tuple[str, ...]]]]:
+    """Parameter maps are SWIG objects, this converts them to a picklable list of dicts. Preset names are returned as is."""
+    if pmap is None or isinstance(pmap, str): return pmap
+    return [{k: tuple(v) for k, v in p.items()} for p in pmap]
+
+def pmap_from_list(pmaps:Optional[str | list[dict[str, tuple[str, ...]]]]):
+    if pmaps is None: return default_pmap()
+    if isinstance(pmaps, str): return pmaps
+    vec = sitk.VectorOfParameterMap()
+    for p in pmaps: vec.append(p)
+    return vec
+
+def _register_to_timed(input:str | sitk.Image, reference: str | sitk.Image, pmaps, n_threads:Optional[int]) -> tuple[sitk.Image, float]:
+    """Runs in a worker process, returns registered image and seconds it took."""
+    start = time.perf_counter()
+    if n_threads is not None: sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(n_threads)
+    res = register_to(input, reference, pmap_from_list(pmaps), n_threads=n_threads)
+    return res, time.perf_counter() - start
+
+def register_imgs_to_parallel(template_input: str | sitk.Image, other_inputs: str|sitk.Image | Sequence[str|sitk.Image], reference: str | sitk.Image,
+                              pmap = None, n_workers:Optional[int] = None, threads_per_worker:Optional[int] = None) -> tuple[list[sitk.Image], list[float]]:
+    """Same as `register_imgs_to`, but `other_inputs` are registered to registered `template_input` concurrently in a process pool.
+
+    Each elastix instance gets `threads_per_worker` threads, by default cpu count divided by `n_workers` so that cores aren't oversubscribed.
+    `n_workers` defaults to the number of `other_inputs`.
+
+    Returns registered `[template_input, *other_inputs]` and seconds each registration took."""
+    if not isinstance(other_inputs, Sequence) or isinstance(other_inputs, str): other_inputs = [other_inputs]
+    if n_workers is None: n_workers = max(1, len(other_inputs))
+    if threads_per_worker is None: threads_per_worker = max(1, (os.cpu_count() or 1) // n_workers)
+    pmaps = pmap_to_list(pmap)
+
+    # Register `template_input` to `reference` using all threads
+    start = time.perf_counter()
+    registered_template_input = register_to(template_input, reference, pmap_from_list(pmaps))
+    template_time = time.perf_counter() - start
+
+    # register `other_inputs` to registered `template_input`.
+    with concurrent.futures.ProcessPoolExecutor(max_workers=n_workers) as executor:
+        results = list(executor.map(_register_to_timed, other_inputs, [registered_template_input] * len(other_inputs),
+                                    [pmaps] * len(other_inputs), [threads_per_worker] * len(other_inputs)))
+
+    return [registered_template_input, *[i[0] for i in results]], [template_time, *[i[1] for i in results]]
+
+def register_imgs_to_SRI24_parallel(t1:str|sitk.Image, other: str|sitk.Image | Sequence[str|sitk.Image], reference=SRI24,
+                                    n_workers:Optional[int] = None, threads_per_worker:Optional[int] = None, pmap = None) -> tuple[list[sitk.Image], list[float]]:
+    return register_imgs_to_parallel(t1, other, reference, pmap, n_workers=n_workers, threads_per_worker=threads_per_worker)
+
+def register_imgs_shared(template_input: str | sitk.Image, other_inputs: str|sitk.Image | Sequence[str|sitk.Image], reference: str | sitk.Image,
+                         labels: Optional[str|sitk.Image | Sequence[str|sitk.Image]] = None, pmap = default_pmap(), n_threads:Optional[int] = None) -> tuple[list[sitk.Image], list[sitk.Image]]:
+    """Register `template_input` to `reference` once and apply the same transform to `other_inputs` and `labels`,
+    which must already be in the same native space as `template_input` (e.g. modalities of one co-registered study and its segmentation).
+
+    That is one elastix optimization per study instead of one per image, other images only go through transformix resampling,
+    labels with nearest neighbor interpolation.
+
+    Returns registered `[template_input, *other_inputs]` and registered `labels`."""
+    if not isinstance(other_inputs, Sequence) or isinstance(other_inputs, str): other_inputs = [other_inputs]
+    if labels is None: labels = []
+    elif not isinstance(labels, Sequence) or isinstance(labels, str): labels = [labels]
+
+    registered_template_input, tmap = register_get_transform(template_input, reference, pmap, n_threads=n_threads)
+    registered_other_inputs = [apply_transform(i, tmap, n_threads=n_threads) for i in other_inputs]
+    registered_labels = [apply_transform(i, tmap, label=True, n_threads=n_threads) for i in labels]
+    return [registered_template_input, *registered_other_inputs], registered_labels
+
+def register_imgs_shared_to_SRI24(t1ce:str|sitk.Image, other: str|sitk.Image | Sequence[str|sitk.Image], labels: Optional[str|sitk.Image | Sequence[str|sitk.Image]] = None,
+                                  reference=SRI24, n_threads:Optional[int] = None, pmap = default_pmap()) -> tuple[list[sitk.Image], list[sitk.Image]]:
+    return register_imgs_shared(t1ce, other, reference, labels, pmap, n_threads=n_threads)
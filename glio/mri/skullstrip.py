@@ -1,52 +1,147 @@
-from typing import Any
-from collections.abc import Sequence
-import os, subprocess, shutil
-import tempfile
+from typing import Any, Optional
+from collections.abc import Sequence, Iterable, Iterator
+import os
+import concurrent.futures
+import numpy as np
+import torch
 import SimpleITK as sitk
+from .images import tool_tempdir, as_image
 
-def get_brain_mask(input:str | sitk.Image, mode='accurate', do_tta=True) -> sitk.Image:
+def get_brain_mask(input:str | sitk.Image | np.ndarray | torch.Tensor, mode='accurate', do_tta=True, use_tmpfs=True) -> sitk.Image:
     """Runs skullstripping using HD BET (https://github.com/MIC-DKFZ/HD-BET). Requires it to be installed.
 
-    Returns `outpath` which is path to brain mask for convenience.
+    Returns brain mask as `sitk.Image`.
 
     Args:
-        inputs (str | sitk.Image): Path to a nifti file or a sitk.Image of the image to generate brain mask from, all inputs must be in MNI152 space.
-        outpaths (str): Path to output file, must include `.nii.gz`.
-        mkdirs (bool, optional): Whether to create `outfolder` if it doesn't exist, otherwise throws an error. Defaults to True.
+        input (str | sitk.Image | np.ndarray | torch.Tensor): Path to a nifti file or an image/array to generate brain mask from, all inputs must be in MNI152 space.
+        use_tmpfs (bool, optional): HD-BET needs files, they are written uncompressed to memory-backed `/dev/shm` when available. Defaults to True.
     """
     from HD_BET.run import run_hd_bet
 
-    with tempfile.TemporaryDirectory() as temp, tempfile.TemporaryDirectory() as temp2:
+    with tool_tempdir(use_tmpfs) as temp:
 
-        if isinstance(input, sitk.Image): sitk.WriteImage(input, os.path.join(temp, 't1.nii.gz'))
-        else: shutil.copyfile(input, os.path.join(temp, 't1.nii.gz'))
+        # nifti files are passed to HD-BET as is, images are written uncompressed
+        if isinstance(input, str) and input.lower().endswith(('.nii', '.nii.gz')): inpath = input
+        else:
+            inpath = os.path.join(temp, 'input.nii')
+            sitk.WriteImage(as_image(input), inpath, useCompression=False)
 
-        # run skullstripping
-        run_hd_bet(os.path.join(temp, 't1.nii.gz'), os.path.join(temp2, 't1.nii.gz'), mode=mode, do_tta=do_tta)
+        # run skullstripping, HD-BET requires output to end with `.nii.gz`
+        run_hd_bet(inpath, os.path.join(temp, 't1.nii.gz'), mode=mode, do_tta=do_tta)
 
         # return sitk image
-        #print(os.listdir(temp2))
-        return sitk.ReadImage(os.path.join(temp2, 't1_mask.nii.gz'))
+        return sitk.ReadImage(os.path.join(temp, 't1_mask.nii.gz'))
 
-def apply_brain_mask(input:str | sitk.Image, mask:str | sitk.Image) -> sitk.Image:
+def apply_brain_mask(input:str | sitk.Image | np.ndarray | torch.Tensor, mask:str | sitk.Image) -> sitk.Image:
     """Applies brain mask to input image.
 
     Args:
         input (str | sitk.Image): Path to a nifti file or a sitk.Image of the image to generate brain mask from, all inputs must be in MNI152 space.
         mask (str | sitk.Image): Path to a nifti file or a sitk.Image of the brain mask to apply to the input image.
     """
-    if isinstance(input, str): input = sitk.ReadImage(input)
     if isinstance(mask, str): mask = sitk.ReadImage(mask)
+    input = as_image(input, mask)
     mask = sitk.Cast(mask, sitk.sitkFloat32)
     return sitk.Multiply(input, mask)
 
 
-def skullstrip(input:str | sitk.Image) -> sitk.Image:
+def skullstrip(input:str | sitk.Image | np.ndarray | torch.Tensor) -> sitk.Image:
     mask = get_brain_mask(input)
     return apply_brain_mask(input, mask)
 
-def skullstrip_imgs(template:str | sitk.Image, other: str | sitk.Image | Sequence[str | sitk.Image], erode=0) -> Sequence[sitk.Image]:
-    if not isinstance(other, Sequence): other = [other]
-    mask = get_brain_mask(template)
+def skullstrip_imgs(template:str | sitk.Image, other: str | sitk.Image | Sequence[str | sitk.Image], erode=0, service:"Optional[HDBETService]" = None) -> Sequence[sitk.Image]:
+    """Generates brain mask from `template` and applies it to `template` and `other`. If `service` is given, it is used instead of loading HD-BET each time."""
+    if not isinstance(other, Sequence) or isinstance(other, str): other = [other]
+    mask = get_brain_mask(template) if service is None else service.mask(template)
     if erode > 0: mask = sitk.BinaryErode(mask, [erode, erode, erode])
-    return [apply_brain_mask(i, mask) for i in [template, *other]]
\ No newline at end of file
+    return [apply_brain_mask(i, mask) for i in [template, *other]]
+
+
+class HDBETService:
+    def __init__(self, mode:str = 'accurate', device:int | str = 'cpu', do_tta = True, postprocess = False, n_threads:Optional[int] = None,
+                 prefetch = 2, use_tmpfs = True):
+        """HD-BET (https://github.com/MIC-DKFZ/HD-BET) with the network and weights loaded once and kept resident, unlike `get_brain_mask`.
+
+        Args:
+            mode (str, optional): `accurate` uses an ensemble of 5 networks, `fast` uses 1. Defaults to 'accurate'.
+            device (int | str, optional): `cpu` or CUDA device index. Defaults to 'cpu'.
+            do_tta (bool, optional): Test-time augmentation by mirroring, 8 times slower. Defaults to True.
+            postprocess (bool, optional): Keep only the largest connected component. Defaults to False.
+            n_threads (Optional[int], optional): torch CPU threads. Defaults to None.
+            prefetch (int, optional): How many images `imap` loads and preprocesses in background threads while the network runs. Defaults to 2.
+            use_tmpfs (bool, optional): HD-BET preprocessing reads files, images are written uncompressed to `/dev/shm` when available. Defaults to True.
+        """
+        import HD_BET.utils as hdbet_utils
+        from HD_BET.config import config
+
+        if mode == 'fast': param_ids = [0]
+        elif mode == 'accurate': param_ids = list(range(5))
+        else: raise ValueError(f"Unknown mode {mode}, must be 'fast' or 'accurate'")
+
+        if n_threads is not None: torch.set_num_threads(n_threads)
+
+        self.cf = config()
+        self.net, _ = self.cf.get_network(self.cf.val_use_train_mode, None)
+        if device == 'cpu': self.net = self.net.cpu()
+        else: self.net = self.net.cuda(device)
+
+        self.params = []
+        for i in param_ids:
+            hdbet_utils.maybe_download_parameters(i)
+            self.params.append(torch.load(hdbet_utils.get_params_fname(i), map_location=lambda storage, loc: storage))
+
+        self.mode = mode
+        self.device = device
+        self.do_tta = do_tta
+        self.postprocess = postprocess
+        self.prefetch = prefetch
+        self.use_tmpfs = use_tmpfs
+
+    def _preprocess(self, input:str | sitk.Image | np.ndarray | torch.Tensor) -> tuple[np.ndarray, dict]:
+        """HD-BET preprocessing (reorientation, resampling and normalization), thread-safe."""
+        from HD_BET.data_loading import load_and_preprocess
+        if isinstance(input, str) and input.lower().endswith(('.nii', '.nii.gz')): return load_and_preprocess(input)
+        with tool_tempdir(self.use_tmpfs) as temp:
+            path = os.path.join(temp, 'input.nii')
+            sitk.WriteImage(as_image(input), path, useCompression=False)
+            return load_and_preprocess(path)
+
+    @torch.no_grad()
+    def _predict(self, data:np.ndarray, properties:dict) -> sitk.Image:
+        from HD_BET.data_loading import save_segmentation_nifti
+        from HD_BET.predict_case import predict_case_3D_net
+        from HD_BET.utils import postprocess_prediction, SetNetworkToVal
+
+        softmax_preds = []
+        for p in self.params:
+            self.net.load_state_dict(p)
+            self.net.eval()
+            self.net.apply(SetNetworkToVal(False, False))
+            _, _, softmax_pred, _ = predict_case_3D_net(self.net, data, self.do_tta, self.cf.val_num_repeats, self.cf.val_batch_size,
+                                                        self.cf.net_input_must_be_divisible_by, self.cf.val_min_size, self.device, self.cf.da_mirror_axes)
+            softmax_preds.append(softmax_pred[None])
+        seg = np.argmax(np.vstack(softmax_preds).mean(0), 0)
+        if self.postprocess: seg = postprocess_prediction(seg)
+
+        # HD-BET resamples the mask back to original space while saving it
+        with tool_tempdir(self.use_tmpfs) as temp:
+            path = os.path.join(temp, 'mask.nii')
+            save_segmentation_nifti(seg, properties, path)
+            return sitk.ReadImage(path)
+
+    def mask(self, input:str | sitk.Image | np.ndarray | torch.Tensor) -> sitk.Image:
+        """Returns brain mask of a single image."""
+        return self._predict(*self._preprocess(input))
+
+    def imap(self, inputs:Iterable[str | sitk.Image | np.ndarray | torch.Tensor]) -> Iterator[sitk.Image]:
+        """Yields brain masks of `inputs` in order. Next `prefetch` images are preprocessed in background threads while the network runs."""
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, self.prefetch)) as executor:
+            queue: list[concurrent.futures.Future] = []
+            for input in inputs:
+                queue.append(executor.submit(self._preprocess, input))
+                if len(queue) > self.prefetch: yield self._predict(*queue.pop(0).result())
+            for future in queue: yield self._predict(*future.result())
+
+    def skullstrip_imgs(self, template:str | sitk.Image, other: str | sitk.Image | Sequence[str | sitk.Image], erode=0) -> Sequence[sitk.Image]:
+        """Same as `skullstrip_imgs` using this service."""
+        return skullstrip_imgs(template, other, erode=erode, service=self)
\ No newline at end of file
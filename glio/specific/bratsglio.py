@@ -1,4 +1,4 @@
-from typing import Literal
+from typing import Literal, Optional
 from collections.abc import Sequence, Callable
 from functools import partial
 import os
@@ -14,6 +14,7 @@ from ..datasets.mri_preloaded2 import *
 from ..torch_tools import one_hot_mask, raw_preds_to_one_hot
 from ..python_tools import get0, get1, perf_counter_context, find_file_containing
 from ..jupyter_tools import clean_mem
+from ..loaders.nifti import NiftiWriter
 from ..transforms.intensity import norm
 from ..mri.preprocess_datasets import preprocess_brats2024gli_tensor, znormalize_imgs, crop_bg_imgs
 from ..transforms.intensity import RandScale, RandShift
@@ -552,7 +553,7 @@ def get_mri_from_folder(path, cropbg=True):
                      sitk.GetArrayFromImage(t2f_norm),
                      sitk.GetArrayFromImage(t2w_norm)])).to(torch.float32)
 
-def predict_cropped(model, path, outfile, around, printp=False):
+def predict_cropped(model, path, outfile, around, printp=False, writer:Optional[NiftiWriter] = None):
     t1c = find_file_containing(path, 't1c.')
     t1n = find_file_containing(path, 't1n.')
     t2f = find_file_containing(path, 't2f.')
@@ -569,10 +570,11 @@ def predict_cropped(model, path, outfile, around, printp=False):
     resampled_sitk_preds = resample_to(sitk_preds, t1c)
     resampled_sitk_preds.CopyInformation(sitk.ReadImage(t1c))
     resampled_sitk_preds.SetOrigin((-90., 126., -72.))
-    sitk.WriteImage(resampled_sitk_preds, outfile)
+    if writer is not None: writer.write(resampled_sitk_preds, outfile)
+    else: sitk.WriteImage(resampled_sitk_preds, outfile)
     return resampled_sitk_preds
 
-def predict_full(model, path, outfile, around, printp=False):
+def predict_full(model, path, outfile, around, printp=False, writer:Optional[NiftiWriter] = None):
     t1c = find_file_containing(path, 't1c.')
     t1n = find_file_containing(path, 't1n.')
     t2f = find_file_containing(path, 't2f.')
@@ -587,12 +589,15 @@ def predict_full(model, path, outfile, around, printp=False):
     sitk_preds = sitk.GetImageFromArray(preds.to(torch.uint8).numpy())
     sitk_preds.CopyInformation(sitk.ReadImage(t1c))
     sitk_preds.SetOrigin((-90., 126., -72.))
-    sitk.WriteImage(sitk_preds, outfile)
+    if writer is not None: writer.write(sitk_preds, outfile)
+    else: sitk.WriteImage(sitk_preds, outfile)
     return sitk_preds
 
 
 def predict_dataset(model, path, outdir, around, ):
     from glio.progress_bar import PBar # type:ignore pylint:disable=W0621
-    for dir in PBar(os.listdir(path), step=1):
-        full_dir = os.path.join(path, dir)
-        predict_cropped(model, full_dir, os.path.join(outdir, 'seg-' + dir + '.nii.gz'), around = around, printp=False)
\ No newline at end of file
+    # next study is predicted while previous prediction is compressed and written
+    with NiftiWriter() as writer:
+        for dir in PBar(os.listdir(path), step=1):
+            full_dir = os.path.join(path, dir)
+            predict_cropped(model, full_dir, os.path.join(outdir, 'seg-' + dir + '.nii.gz'), around = around, printp=False, writer=writer)
\ No newline at end of file
@@ -14,6 +14,7 @@ import torch.utils.hooks, torch.utils.data
 import numpy as np
 import matplotlib.pyplot as plt
 from .python_tools import type_str, try_copy, EndlessContinuingIterator, Compose, reduce_dim
+from .morphology import binary_erode
 CUDA_IF_AVAILABLE = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
 
 def ensure_device(x, device:Optional[torch.device]) -> Any:
@@ -466,10 +467,7 @@ def binary_erode3d(tensor, n = 1):
     """
     Erodes a 3D binary tensor.
     """
-    if n > 1: tensor = binary_erode3d(tensor, n-1)
-    kernel = torch.tensor([[[[[0,0,0],[0,1,0],[0,0,0]],[[0,1,0],[1,1,1],[0,1,0]],[[0,0,0],[0,1,0],[0,0,0]]]]], dtype=torch.int64)
-    convolved = torch.nn.functional.conv3d(input = tensor.unsqueeze(0), weight = kernel, padding=1) # pylint:disable=E1102
-    return torch.where(convolved==7, 1, 0)[0]
+    return binary_erode(tensor, n, spatial_dims=3, connectivity='cross').to(torch.int64)
 
 
 
@@ -517,26 +515,45 @@ def area_around(tensor:torch.Tensor, coord, size) -> torch.Tensor:
     else: raise NotImplementedError
 
 
-def one_hot_mask(mask: torch.Tensor, num_classes:int) -> torch.Tensor:
+def _one_hot_scatter_(mask: torch.Tensor, out: torch.Tensor, dim:int, ignore_index:Optional[int]) -> torch.Tensor:
+    """Zeroes `out` and scatters ones along `dim` at class indexes from `mask`."""
+    out.zero_()
+    index = mask.to(torch.int64).unsqueeze(dim)
+    if ignore_index is None: return out.scatter_(dim, index, 1)
+    ignored = index == ignore_index
+    out.scatter_(dim, index.masked_fill(ignored, 0), 1)
+    # ignored voxels got written to class 0, unset them
+    out.narrow(dim, 0, 1).masked_fill_(ignored, 0)
+    return out
+
+def one_hot_mask_(mask: torch.Tensor, out: torch.Tensor, ignore_index:Optional[int] = None) -> torch.Tensor:
+    """Writes one-hot encoding of a (*) mask into a preallocated C(*) `out` tensor of any dtype and returns it.
+    Voxels equal to `ignore_index` are all zeros. Reuse `out` across batches to avoid allocations."""
+    return _one_hot_scatter_(mask, out, 0, ignore_index)
+
+def one_hot_mask(mask: torch.Tensor, num_classes:int, dtype = torch.float32, ignore_index:Optional[int] = None) -> torch.Tensor:
     """Takes a mask (*) and one-hot encodes into C(*)
 
     Args:
-        mask (torch.Tensor): B(*) tensor.
+        mask (torch.Tensor): (*) tensor.
         num_classes (int): _description_
-
-    Raises:
-        NotImplementedError: _description_
+        dtype (torch.dtype, optional): output dtype, e.g. `torch.uint8` or `torch.bool` to save memory. Defaults to torch.float32.
+        ignore_index (int, optional): voxels with this value are all zeros. Defaults to None.
 
     Returns:
         torch.Tensor: _description_
     """
-    if mask.ndim == 3:
-        return torch.nn.functional.one_hot(mask.to(torch.int64), num_classes).permute(3, 0, 1, 2).to(torch.float32) # pylint:disable=E1102 #type:ignore
-    elif mask.ndim == 2:
-        return torch.nn.functional.one_hot(mask.to(torch.int64), num_classes).permute(2, 0, 1).to(torch.float32) # pylint:disable=E1102 #type:ignore
-    else: raise NotImplementedError(f'one_hot_mask: mask.ndim = {mask.ndim}')
+    out = torch.empty((num_classes, *mask.shape), dtype=dtype, device=mask.device)
+    return _one_hot_scatter_(mask, out, 0, ignore_index)
+
+def batched_one_hot_mask_(mask: torch.Tensor, out: torch.Tensor, ignore_index:Optional[int] = None) -> torch.Tensor:
+    """Writes one-hot encoding of a B(*) mask into a preallocated BC(*) `out` tensor of any dtype and returns it."""
+    return _one_hot_scatter_(mask, out, 1, ignore_index)
 
-batched_one_hot_mask = torch.vmap(one_hot_mask)
+def batched_one_hot_mask(mask: torch.Tensor, num_classes:int, dtype = torch.float32, ignore_index:Optional[int] = None) -> torch.Tensor:
+    """Takes a B(*) mask and one-hot encodes into BC(*)."""
+    out = torch.empty((mask.shape[0], num_classes, *mask.shape[1:]), dtype=dtype, device=mask.device)
+    return _one_hot_scatter_(mask, out, 1, ignore_index)
 
 def raw_preds_to_one_hot(raw: torch.Tensor) -> torch.Tensor:
     """Takes raw model predictions in C(*) format and turns into one-hot encoding in C(*) format.
@@ -550,7 +567,9 @@ def raw_preds_to_one_hot(raw: torch.Tensor) -> torch.Tensor:
     mask = torch.argmax(raw, dim=0)
     return one_hot_mask(mask, raw.shape[0])
 
-batched_raw_preds_to_one_hot = torch.vmap(raw_preds_to_one_hot)
+def batched_raw_preds_to_one_hot(raw: torch.Tensor) -> torch.Tensor:
+    """Takes raw model predictions in BC(*) format and turns into one-hot encoding in BC(*) format."""
+    return batched_one_hot_mask(torch.argmax(raw, dim=1), raw.shape[1])
 
 def count_parameters(model):
     return sum([p.numel() for p in model.parameters() if p.requires_grad])
@@ -597,7 +616,7 @@ def unonehot(mask: torch.Tensor, batch = False) -> torch.Tensor:
 
 
 def preds_batch_to_onehot(preds:torch.Tensor):
-    return one_hot_mask(preds.argmax(1), preds.shape[1]).swapaxes(0,1)
+    return batched_one_hot_mask(preds.argmax(1), preds.shape[1])
 
 
 def angle(a, b, dim=-1):
@@ -37,6 +37,11 @@ __all__ = [
     "Contrast",
     "rand_contrast",
     "RandContrast",
+    "masked_quantiles",
+    "robust_znorm",
+    "RobustZNorm",
+    "histogram_match",
+    "HistogramMatch",
 ]
 
 def znorm(x:torch.Tensor | np.ndarray, mean=0., std=1.) -> Any:
@@ -245,3 +250,95 @@ class RandContrast(RandomTransform):
         self.max = max
         self.p = p
     def forward(self, x): return rand_contrast(x, self.min, self.max)
+
+
+def _flatten_masked(x:torch.Tensor, mask:Optional[torch.Tensor | str], spatial_dims:int) -> tuple[torch.Tensor, torch.Tensor]:
+    """Reshapes `(*, spatial)` tensor to `(N, voxels)` and returns it with a boolean mask of the same shape."""
+    flat = x.reshape(-1, x.shape[x.ndim - spatial_dims:].numel())
+    if mask is None: m = torch.ones_like(flat, dtype=torch.bool)
+    elif isinstance(mask, str):
+        if mask != 'nonzero': raise ValueError(f'Unknown mask {mask}')
+        m = flat != 0
+    else: m = torch.broadcast_to(mask.to(device=x.device, dtype=torch.bool), x.shape).reshape(flat.shape)
+    # channels with empty mask use all voxels
+    return flat, m | ~m.any(1, keepdim=True)
+
+def masked_quantiles(x:torch.Tensor, q:torch.Tensor | list[float], mask:Optional[torch.Tensor | str] = None, spatial_dims = 3) -> torch.Tensor:
+    """Quantiles `q` (in `[0, 1]`) of each channel of a `(*, spatial)` tensor computed only over voxels in `mask`, all channels in one sort.
+
+    `mask` is a tensor broadcastable to `x`, `nonzero` to use nonzero voxels of each channel, or None to use all voxels.
+    Returns `(*, len(q))` tensor, nearest-rank quantiles."""
+    flat, m = _flatten_masked(x, mask, spatial_dims)
+    q = torch.as_tensor(q, dtype=torch.float32, device=x.device)
+    # masked out values go to the end of each row
+    values = flat.to(torch.float32).masked_fill(~m, float('inf')).sort(1).values
+    count = m.sum(1, keepdim=True).clamp_min(1)
+    idx = ((count - 1) * q.unsqueeze(0)).round().to(torch.int64)
+    return values.gather(1, idx).reshape(*x.shape[:x.ndim - spatial_dims], len(q))
+
+def robust_znorm(x:torch.Tensor, mask:Optional[torch.Tensor | str] = None, clip:Optional[tuple[float, float]] = (0.5, 99.5),
+                 fill_outside:Optional[float] = None, spatial_dims = 3, dtype:Optional[torch.dtype] = None) -> torch.Tensor:
+    """Channel-wise z-normalization with statistics computed only inside `mask`, after clipping each channel to `clip` percentiles,
+    vectorized over all leading dimensions, so `(C, spatial)` and `(B, C, spatial)` are normalized in one call.
+
+    `mask` - tensor broadcastable to `x` (e.g. a brain mask), `nonzero` for nonzero voxels of each channel (skullstripped images), or None for all voxels.
+    `fill_outside` - if not None, voxels outside of the mask are set to this value.
+    `dtype` - output dtype, e.g. `torch.float16` to halve memory, statistics are always computed in float32."""
+    flat, m = _flatten_masked(x, mask, spatial_dims)
+    flat = flat.to(torch.float32)
+    if clip is not None:
+        bounds = masked_quantiles(x, [clip[0] / 100, clip[1] / 100], m.reshape(x.shape), spatial_dims).reshape(flat.shape[0], 2)
+        flat = flat.clamp(bounds[:, :1], bounds[:, 1:])
+    mf = m.to(torch.float32)
+    count = mf.sum(1, keepdim=True).clamp_min(1)
+    mean = (flat * mf).sum(1, keepdim=True) / count
+    std = (((flat - mean) ** 2) * mf).sum(1, keepdim=True).div(count).sqrt()
+    std[std == 0] = 1
+    res = (flat - mean) / std
+    if fill_outside is not None: res = res.masked_fill(~m, fill_outside)
+    return res.reshape(x.shape).to(dtype if dtype is not None else x.dtype if x.is_floating_point() else torch.float32)
+
+class RobustZNorm(Transform):
+    def __init__(self, mask:Optional[str] = 'nonzero', clip:Optional[tuple[float, float]] = (0.5, 99.5), fill_outside:Optional[float] = None, spatial_dims = 3, dtype:Optional[torch.dtype] = None):
+        """Channel-wise z-normalization inside a mask with percentile clipping, works on a sample or on a batch on any device"""
+        self.mask = mask
+        self.clip = clip
+        self.fill_outside = fill_outside
+        self.spatial_dims = spatial_dims
+        self.dtype = dtype
+    def forward(self, x): return robust_znorm(x, self.mask, self.clip, self.fill_outside, self.spatial_dims, self.dtype)
+
+def histogram_match(x:torch.Tensor, reference_quantiles:torch.Tensor, mask:Optional[torch.Tensor | str] = None,
+                    spatial_dims = 3, dtype:Optional[torch.dtype] = None) -> torch.Tensor:
+    """Piecewise-linear histogram matching of each channel of a `(*, spatial)` tensor to `reference_quantiles`.
+
+    `reference_quantiles` is `(*, Q)` or `(Q,)` tensor of reference intensities at `Q` evenly spaced quantiles from 0 to 1,
+    e.g. `masked_quantiles(reference, torch.linspace(0, 1, Q))`. Source quantiles are computed inside `mask`,
+    and all voxels are mapped by interpolating between matching quantiles, values outside the source range are clamped."""
+    reference_quantiles = torch.as_tensor(reference_quantiles, device=x.device, dtype=torch.float32)
+    n_quantiles = reference_quantiles.shape[-1]
+    src = masked_quantiles(x, torch.linspace(0, 1, n_quantiles), mask, spatial_dims)
+    src = src.reshape(-1, n_quantiles)
+    ref = torch.broadcast_to(reference_quantiles, (*x.shape[:x.ndim - spatial_dims], n_quantiles)).reshape(-1, n_quantiles)
+    # repeated quantiles (e.g. a lot of zeros) would give zero-width segments,
+    # epsilon is relative to magnitude because an absolute one is below float32 resolution for large intensities
+    eps = src.abs().amax(1, keepdim=True).clamp(min=1) * 1e-6
+    src = src + torch.arange(n_quantiles, device=x.device) * eps
+
+    flat = x.reshape(src.shape[0], -1).to(torch.float32)
+    flat = flat.clamp(src[:, :1], src[:, -1:])
+    idx = torch.searchsorted(src.contiguous(), flat.contiguous()).clamp_(1, n_quantiles - 1)
+    lo, hi = src.gather(1, idx - 1), src.gather(1, idx)
+    width = hi - lo
+    w = torch.where(width > 0, (flat - lo) / torch.where(width > 0, width, 1), 0).clamp_(0, 1)
+    res = ref.gather(1, idx - 1) * (1 - w) + ref.gather(1, idx) * w
+    return res.reshape(x.shape).to(dtype if dtype is not None else x.dtype if x.is_floating_point() else torch.float32)
+
+class HistogramMatch(Transform):
+    def __init__(self, reference_quantiles:torch.Tensor, mask:Optional[str] = 'nonzero', spatial_dims = 3, dtype:Optional[torch.dtype] = None):
+        """Piecewise-linear histogram matching to reference quantiles, works on a sample or on a batch on any device"""
+        self.reference_quantiles = reference_quantiles
+        self.mask = mask
+        self.spatial_dims = spatial_dims
+        self.dtype = dtype
+    def forward(self, x): return histogram_match(x, self.reference_quantiles, self.mask, self.spatial_dims, self.dtype)